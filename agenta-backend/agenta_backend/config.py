@@ -34,6 +34,62 @@ class Settings(BaseSettings):
     docker_registry_loc: str
     docker_hub_repo_owner: str
     docker_hub_repo_name: str
+    mongodb_max_pool_size: int = 100
+    mongodb_min_pool_size: int = 0
+    mongodb_max_idle_time_ms: Optional[int] = None
+    mongodb_connect_timeout_ms: int = 20000
+    mongodb_server_selection_timeout_ms: int = 30000
+    mongodb_socket_timeout_ms: Optional[int] = None
+    mongodb_wait_queue_timeout_ms: Optional[int] = None
+    mongodb_read_preference: str = "primary"
+    mongodb_compressors: str = "zlib"
+    user_cache_ttl_seconds: float = 60.0
+    user_cache_max_size: int = 1024
+    soft_deleted_sweep_interval_seconds: float = 300.0
+    evaluation_scenarios_batch_size: int = 1000
+    evaluation_results_reconcile_interval_seconds: float = 3600.0
+    evaluation_scenarios_max_page_size: int = 1000
+    testset_rows_chunk_size: int = 1000
+    testset_rows_chunk_bytes: int = 4 * 1024 * 1024
+    testset_upload_chunk_bytes: int = 64 * 1024
+    http_client_max_connections: int = 100
+    http_client_max_keepalive_connections: int = 20
+    http_client_timeout_seconds: float = 30.0
+    http_client_retries: int = 3
+    testset_import_lease_seconds: float = 300.0
+    testset_upload_lease_seconds: float = 300.0
+    testset_selection_max_strata: int = 1000
+    evaluation_export_flush_bytes: int = 64 * 1024
+    cleanup_delete_batch_size: int = 10000
+    orphan_cleanup_grace_seconds: float = 3600.0
+    testset_import_max_age_seconds: float = 7 * 24 * 3600.0
+    evaluation_archive_after_seconds: float = 7 * 24 * 3600.0
+    evaluation_archive_interval_seconds: float = 3600.0
+    evaluation_archive_chunk_size: int = 5000
+    evaluation_archive_chunk_bytes: int = 8 * 1024 * 1024
+    evaluation_runner_concurrency: int = 16
+    evaluation_runner_write_batch_size: int = 100
+    evaluation_runner_lease_seconds: float = 300.0
+    evaluation_materialization_lease_seconds: float = 300.0
+    evaluation_materialization_check_interval_seconds: float = 300.0
+    auto_evaluation_cache_size: int = 65536
+    auto_evaluation_regex_budget_seconds: float = 30.0
+    ai_critique_api_base: str = "https://api.openai.com/v1"
+    ai_critique_model: str = "text-davinci-003"
+    ai_critique_max_tokens: int = 256
+    ai_critique_concurrency: int = 8
+    ai_critique_requests_per_second: float = 3.0
+    ai_critique_burst: int = 10
+    ai_critique_retries: int = 5
+    ai_critique_timeout_seconds: float = 60.0
+    ai_critique_cache_ttl_seconds: float = 30 * 24 * 3600.0
+    ai_critique_cache_max_entries: int = 100000
+    ai_critique_cache_trim_interval_seconds: float = 3600.0
+    custom_evaluation_cache_size: int = 256
+    variant_parameters_cache_size: int = 1024
+    variant_parameters_cache_ttl_seconds: float = 60.0
+    custom_evaluation_cache_ttl_seconds: float = 60.0
+    compiled_evaluator_cache_ttl_seconds: float = 3600.0
 
 
 settings = Settings()
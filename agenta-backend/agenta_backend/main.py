@@ -11,6 +11,7 @@ from agenta_backend.routers import (
     container_router,
     environment_router,
     evaluation_router,
+    health_router,
     testset_router,
 )
 from agenta_backend.services.cache_manager import (
@@ -18,7 +19,26 @@ from agenta_backend.services.cache_manager import (
     retrieve_templates_info_from_dockerhub_cached,
 )
 from agenta_backend.services.container_manager import pull_image_from_docker_hub, retrieve_manifests_from_dockerhub
-from agenta_backend.services.db_manager import add_template, remove_old_template_from_db
+from agenta_backend.services.db_manager import (
+    add_template,
+    begin_request_scope,
+    end_request_scope,
+    remove_old_template_from_db,
+)
+from agenta_backend.services.db_indexes import bootstrap_indexes
+from agenta_backend.services.cleanup_service import clean_orphans
+from agenta_backend.services.background_tasks import (
+    cancel_background_tasks,
+    spawn_background_task,
+    start_ai_critique_cache_trimmer,
+    start_evaluation_archiver,
+    start_materialization_checker,
+    start_result_counters_reconciler,
+    start_soft_deleted_variants_sweeper,
+)
+from agenta_backend.services.ai_critique import close_critique_client
+from agenta_backend.services.http_client import close_http_client
+from agenta_backend.services.testset_service import migrate_inline_testsets
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -42,6 +62,26 @@ async def lifespan(application: FastAPI, cache=False):
         application: FastAPI application.
         cache: A boolean value that indicates whether to use the cached data or not.
     """
+    # Ensure the collection indexes exist and report the query plans
+    try:
+        await bootstrap_indexes()
+    except Exception as e:
+        logger.error(f"Index bootstrap failed: {e}")
+
+    # Remove orphaned soft-deleted variants in the background
+    sweeper_task = start_soft_deleted_variants_sweeper()
+    reconciler_task = start_result_counters_reconciler()
+    archiver_task = start_evaluation_archiver()
+    critique_cache_task = start_ai_critique_cache_trimmer()
+    # Fail the evaluations left materializing by a previous process
+    materialization_task = start_materialization_checker()
+
+    # Test set rows used to be stored inline in the test set document
+    spawn_background_task(migrate_inline_testsets())
+
+    # Remove the documents left behind by interrupted or older deletions
+    spawn_background_task(clean_orphans())
+
     # Get docker hub config
     repo_user = settings.docker_registry_user
     repo_pass = settings.docker_registry_pass
@@ -97,14 +137,36 @@ async def lifespan(application: FastAPI, cache=False):
     except Exception as e:
         logger.error(e)
     yield
+    sweeper_task.cancel()
+    reconciler_task.cancel()
+    archiver_task.cancel()
+    critique_cache_task.cancel()
+    materialization_task.cancel()
+    # Stop the materializations in progress, failed by the next process
+    await cancel_background_tasks()
+    await close_http_client()
+    await close_critique_client()
 
 
 app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def user_request_scope(request, call_next):
+    """Memoizes the users resolved by `get_user_object` for the duration of a request."""
+    token = begin_request_scope()
+    try:
+        return await call_next(request)
+    finally:
+        end_request_scope(token)
+
+
 app.include_router(app_variant.router, prefix="/app_variant")
 app.include_router(evaluation_router.router, prefix="/evaluations")
 app.include_router(testset_router.router, prefix="/testsets")
 app.include_router(container_router.router, prefix="/containers")
 app.include_router(environment_router.router, prefix="/environments")
+app.include_router(health_router.router, prefix="/health")
 
 allow_headers = ["Content-Type"]
 
@@ -120,6 +182,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=allow_headers,
+    expose_headers=["X-Next-Cursor"],
 )
 
 if __name__ == "__main__":
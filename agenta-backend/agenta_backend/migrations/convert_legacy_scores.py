@@ -0,0 +1,12 @@
+"""Converts the scenario scores stored as numeric strings, by the versions
+storing them as strings, to numbers. Run it once after upgrading:
+
+    python -m agenta_backend.migrations.convert_legacy_scores
+"""
+import asyncio
+
+from agenta_backend.services.results_service import convert_legacy_scores
+
+if __name__ == "__main__":
+    converted = asyncio.run(convert_legacy_scores())
+    print(f"Converted {converted} scenario score(s) to numbers")
@@ -1,7 +1,9 @@
 from enum import Enum
 from datetime import datetime
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
+
+from agenta_backend.models.api.testset_model import TestsetRowsSelection
 
 
 class EvaluationTypeSettings(BaseModel):
@@ -23,10 +25,28 @@ class EvaluationType(str, Enum):
 
 
 class EvaluationStatusEnum(str, Enum):
+    EVALUATION_MATERIALIZING = "EVALUATION_MATERIALIZING"
     EVALUATION_INITIALIZED = "EVALUATION_INITIALIZED"
     EVALUATION_STARTED = "EVALUATION_STARTED"
     COMPARISON_RUN_STARTED = "COMPARISON_RUN_STARTED"
     EVALUATION_FINISHED = "EVALUATION_FINISHED"
+    EVALUATION_FAILED = "EVALUATION_FAILED"
+
+
+class EvaluationMaterialization(BaseModel):
+    total: int
+    materialized: int
+    rows_per_second: Optional[float]
+
+
+class EvaluationRun(BaseModel):
+    total: int
+    completed: int
+    failed: int
+    rows_per_second: Optional[float]
+    error: Optional[str]
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
 
 
 class Evaluation(BaseModel):
@@ -41,6 +61,9 @@ class Evaluation(BaseModel):
     variants: Optional[List[str]]
     app_name: str
     testset: Dict[str, str] = Field(...)
+    materialization: Optional[EvaluationMaterialization]
+    run: Optional[EvaluationRun]
+    critique: Optional[EvaluationRun]
     created_at: datetime
     updated_at: datetime
 
@@ -65,7 +88,7 @@ class EvaluationScenario(BaseModel):
     inputs: List[EvaluationScenarioInput]
     outputs: List[EvaluationScenarioOutput]
     vote: Optional[str]
-    score: Optional[str]
+    score: Optional[Union[float, str]]
     evaluation: Optional[str]
     correct_answer: Optional[str]
     id: Optional[str]
@@ -84,6 +107,13 @@ class EvaluationScenarioScoreUpdate(BaseModel):
     score: float
 
 
+class EvaluationCritique(BaseModel):
+    evaluation_prompt_template: str
+    open_ai_key: str
+    # Critique again the scenarios already critiqued
+    rescore: bool = False
+
+
 class NewEvaluation(BaseModel):
     evaluation_type: EvaluationType
     custom_code_evaluation_id: Optional[
@@ -94,6 +124,8 @@ class NewEvaluation(BaseModel):
     variants: List[str]
     inputs: List[str]
     testset: Dict[str, str] = Field(...)
+    # Only the selected rows get a scenario, every row by default
+    rows_selection: Optional[TestsetRowsSelection] = None
     status: str = Field(...)
     llm_app_prompt_template: Optional[str]
 
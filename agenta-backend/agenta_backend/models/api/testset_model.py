@@ -1,5 +1,6 @@
 from datetime import datetime
-from typing import Any, List, Dict
+from enum import Enum
+from typing import Any, List, Dict, Optional, Union
 from pydantic import BaseModel, Field
 
 
@@ -44,6 +45,51 @@ class NewTestset(BaseModel):
     csvdata: List[Dict[str, str]]
 
 
+class TestsetRowUpdate(BaseModel):
+    index: int
+    row: Dict[str, str]
+
+
+class TestsetRowInsert(BaseModel):
+    # Appended when not given
+    index: Optional[int] = None
+    row: Dict[str, str]
+
+
+# A TestsetRowsPatch edits some rows of a test set.
+# Updates and deletes refer to the row indexes before the patch, inserts are
+# applied next, in order.
+class TestsetRowsPatch(BaseModel):
+    name: Optional[str] = None
+    updates: List[TestsetRowUpdate] = []
+    deletes: List[int] = []
+    inserts: List[TestsetRowInsert] = []
+
+
+class TestsetRowFilterOperator(str, Enum):
+    eq = "eq"
+    ne = "ne"
+    in_ = "in"
+    not_in = "not_in"
+    contains = "contains"
+
+
+class TestsetRowFilter(BaseModel):
+    column: str
+    operator: TestsetRowFilterOperator = TestsetRowFilterOperator.eq
+    # A list for the in and not_in operators
+    value: Union[str, List[str]]
+
+
+# A TestsetRowsSelection selects the rows of a test set matching every filter,
+# then a seeded random sample of them, stratified by a column if given.
+class TestsetRowsSelection(BaseModel):
+    filters: List[TestsetRowFilter] = []
+    sample_size: Optional[int] = Field(default=None, ge=1)
+    stratify_by: Optional[str] = None
+    seed: int = Field(default=0, ge=0)
+
+
 class TestSetOutputResponse(BaseModel):
     id: str = Field(..., alias="_id")
     name: str
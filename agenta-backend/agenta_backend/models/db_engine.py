@@ -1,15 +1,162 @@
 import os
 import logging
+import threading
+from typing import Any, Dict, Optional
 
 from odmantic import AIOEngine
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from agenta_backend.config import settings
+
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener keeping per-server pool utilization counters
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pools: Dict[str, Dict[str, int]] = {}
+
+    def _incr(self, address: Any, key: str, value: int = 1) -> None:
+        name = "%s:%s" % address
+        with self._lock:
+            pool = self._pools.setdefault(
+                name,
+                {
+                    "open_connections": 0,
+                    "checked_out": 0,
+                    "total_created": 0,
+                    "total_checkouts": 0,
+                    "failed_checkouts": 0,
+                    "pool_cleared": 0,
+                },
+            )
+            pool[key] += value
+
+    def pool_created(self, event):
+        self._incr(event.address, "open_connections", 0)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr(event.address, "pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr(event.address, "open_connections")
+        self._incr(event.address, "total_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr(event.address, "open_connections", -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr(event.address, "failed_checkouts")
+
+    def connection_checked_out(self, event):
+        self._incr(event.address, "checked_out")
+        self._incr(event.address, "total_checkouts")
+
+    def connection_checked_in(self, event):
+        self._incr(event.address, "checked_out", -1)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {name: dict(pool) for name, pool in self._pools.items()}
+
+
+pool_stats_listener = PoolStatsListener()
+
+_clients: Dict[str, AsyncIOMotorClient] = {}
+_sync_clients: Dict[str, MongoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def client_options() -> Dict[str, Any]:
+    """
+    Returns the pool, timeout, read preference and compression options \
+        shared by every mongo client of the process.
+    """
+
+    options = {
+        "maxPoolSize": settings.mongodb_max_pool_size,
+        "minPoolSize": settings.mongodb_min_pool_size,
+        "connectTimeoutMS": settings.mongodb_connect_timeout_ms,
+        "serverSelectionTimeoutMS": settings.mongodb_server_selection_timeout_ms,
+        "readPreference": settings.mongodb_read_preference,
+        "event_listeners": [pool_stats_listener],
+    }
+    if settings.mongodb_max_idle_time_ms is not None:
+        options["maxIdleTimeMS"] = settings.mongodb_max_idle_time_ms
+    if settings.mongodb_socket_timeout_ms is not None:
+        options["socketTimeoutMS"] = settings.mongodb_socket_timeout_ms
+    if settings.mongodb_wait_queue_timeout_ms is not None:
+        options["waitQueueTimeoutMS"] = settings.mongodb_wait_queue_timeout_ms
+    if settings.mongodb_compressors:
+        options["compressors"] = settings.mongodb_compressors
+    return options
+
+
+def get_client(db_url: Optional[str] = None) -> AsyncIOMotorClient:
+    """
+    Returns the process-wide `AsyncIOMotorClient` for `db_url`, \
+        creating it on first use.
+    """
+
+    db_url = db_url or os.environ["MONGODB_URI"]
+    with _clients_lock:
+        client = _clients.get(db_url)
+        if client is None:
+            client = AsyncIOMotorClient(db_url, **client_options())
+            _clients[db_url] = client
+            logger.info(
+                f"Created mongo client with maxPoolSize={settings.mongodb_max_pool_size}"
+            )
+        return client
+
+
+def get_sync_client(db_url: Optional[str] = None) -> MongoClient:
+    """
+    Returns the process-wide synchronous `MongoClient` for `db_url`. \
+        Only used outside of the event loop, e.g. by the test fixtures.
+    """
+
+    db_url = db_url or os.environ["MONGODB_URI"]
+    with _clients_lock:
+        client = _sync_clients.get(db_url)
+        if client is None:
+            client = MongoClient(db_url, **client_options())
+            _sync_clients[db_url] = client
+        return client
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """
+    Returns the configured pool size and the utilization of each server pool.
+    """
+
+    return {
+        "max_pool_size": settings.mongodb_max_pool_size,
+        "min_pool_size": settings.mongodb_min_pool_size,
+        "clients": len(_clients) + len(_sync_clients),
+        "pools": pool_stats_listener.snapshot(),
+    }
+
+
 class DBEngine(object):
     """
     Database engine to initialize client and return engine based on mode
@@ -22,12 +169,11 @@ class DBEngine(object):
     @property
     def initialize_client(self) -> AsyncIOMotorClient:
         """
-        Returns an instance of `AsyncIOMotorClient` initialized \
-            with the provided `db_url`.
+        Returns the shared instance of `AsyncIOMotorClient` for \
+            the provided `db_url`.
         """
 
-        client = AsyncIOMotorClient(self.db_url)
-        return client
+        return get_client(self.db_url)
 
     def engine(self) -> AIOEngine:
         """
@@ -46,7 +192,7 @@ class DBEngine(object):
             return aio_engine
 
     def remove_db(self) -> None:
-        client = MongoClient(self.db_url)
+        client = get_sync_client(self.db_url)
         if self.mode == "default":
             client.drop_database("agenta")
         elif self.mode == "test":
@@ -1,7 +1,9 @@
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
-from odmantic import EmbeddedModel, Field, Model, Reference
+from bson import ObjectId
+from odmantic import EmbeddedModel, Field, Index, Model, Reference
+from pymongo import IndexModel
 
 
 class OrganizationDB(Model):
@@ -34,6 +36,10 @@ class ImageDB(Model):
     class Config:
         collection = "docker_images"
 
+        @staticmethod
+        def indexes():
+            yield Index(ImageDB.user_id, ImageDB.docker_id)
+
 
 class AppVariantDB(Model):
     app_name: str
@@ -49,6 +55,22 @@ class AppVariantDB(Model):
     class Config:
         collection = "app_variants"
 
+        @staticmethod
+        def indexes():
+            yield Index(
+                AppVariantDB.user_id,
+                AppVariantDB.app_name,
+                AppVariantDB.variant_name,
+                AppVariantDB.is_deleted,
+            )
+            yield Index(
+                AppVariantDB.user_id,
+                AppVariantDB.is_deleted,
+                AppVariantDB.app_name,
+                AppVariantDB.variant_name,
+            )
+            yield Index(AppVariantDB.is_deleted, AppVariantDB.image_id)
+
 
 class EnvironmentDB(Model):
     name: str
@@ -59,6 +81,15 @@ class EnvironmentDB(Model):
     class Config:
         collection = "environments"
 
+        @staticmethod
+        def indexes():
+            yield Index(EnvironmentDB.user_id, EnvironmentDB.app_name, EnvironmentDB.name)
+            yield Index(
+                EnvironmentDB.user_id,
+                EnvironmentDB.app_name,
+                EnvironmentDB.deployed_app_variant,
+            )
+
 
 class TemplateDB(Model):
     template_id: str
@@ -76,6 +107,11 @@ class TemplateDB(Model):
     class Config:
         collection = "templates"
 
+        @staticmethod
+        def indexes():
+            yield Index(TemplateDB.template_id)
+            yield Index(TemplateDB.name)
+
 
 class EvaluationTypeSettings(EmbeddedModel):
     similarity_threshold: Optional[float]
@@ -94,6 +130,27 @@ class EvaluationScenarioOutput(EmbeddedModel):
     variant_output: str
 
 
+class EvaluationMaterialization(EmbeddedModel):
+    total: int = Field(default=0)
+    materialized: int = Field(default=0)
+    rows_per_second: Optional[float]
+    # Renewed while the scenarios are written, see evaluation_service
+    lease_expires_at: Optional[datetime]
+
+
+class EvaluationRun(EmbeddedModel):
+    total: int = Field(default=0)
+    completed: int = Field(default=0)
+    failed: int = Field(default=0)
+    rows_per_second: Optional[float]
+    error: Optional[str]
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+    # Held by the process running the evaluation, see evaluation_runner
+    lease_expires_at: Optional[datetime]
+    token: Optional[ObjectId]
+
+
 class EvaluationDB(Model):
     status: str
     evaluation_type: str
@@ -103,6 +160,16 @@ class EvaluationDB(Model):
     variants: List[str]
     app_name: str
     testset: Dict[str, str]
+    materialization: EvaluationMaterialization = Field(
+        default=EvaluationMaterialization()
+    )
+    run: EvaluationRun = Field(default=EvaluationRun())
+    # Batch AI critique of the scenarios, see ai_critique
+    critique: EvaluationRun = Field(default=EvaluationRun())
+    # Scenarios moved to evaluation_archives, see evaluation_archive
+    archived: bool = Field(default=False)
+    # Set while the archived scenarios are moved back, see evaluation_archive
+    restoring: bool = Field(default=False)
     user: UserDB = Reference(key_name="user")
     created_at: Optional[datetime] = Field(default=datetime.utcnow())
     updated_at: Optional[datetime] = Field(default=datetime.utcnow())
@@ -110,12 +177,16 @@ class EvaluationDB(Model):
     class Config:
         collection = "evaluations"
 
+        @staticmethod
+        def indexes():
+            yield Index(EvaluationDB.user, EvaluationDB.app_name)
+
 
 class EvaluationScenarioDB(Model):
     inputs: List[EvaluationScenarioInput]
     outputs: List[EvaluationScenarioOutput]
     vote: Optional[str]
-    score: Optional[str]
+    score: Optional[Union[float, str]]
     evaluation: Optional[str]
     evaluation_id: str
     user: UserDB = Reference(key_name="user")
@@ -126,6 +197,89 @@ class EvaluationScenarioDB(Model):
     class Config:
         collection = "evaluation_scenarios"
 
+        @staticmethod
+        def indexes():
+            yield Index(
+                EvaluationScenarioDB.evaluation_id,
+                EvaluationScenarioDB.user,
+                EvaluationScenarioDB.id,
+            )
+            yield Index(EvaluationScenarioDB.evaluation_id, EvaluationScenarioDB.vote)
+            yield Index(EvaluationScenarioDB.evaluation_id, EvaluationScenarioDB.score)
+
+
+class EvaluationResultsDB(Model):
+    """Result counters of an evaluation, maintained incrementally as its scenarios change"""
+
+    evaluation_id: str = Field(unique=True)
+    counted_field: str
+    total: int = Field(default=0)
+    counts: Dict[str, int] = Field(default={})
+    updated_at: Optional[datetime] = Field(default=datetime.utcnow())
+
+    class Config:
+        collection = "evaluation_results"
+
+
+class EvaluationArchiveDB(Model):
+    """Schema of the archived scenarios of an evaluation, shared by its chunks"""
+
+    evaluation_id: str = Field(unique=True)
+    user: ObjectId
+    # Names of the input and output columns, in order of first appearance
+    input_names: List[str]
+    variant_names: List[str]
+    scenario_count: int
+    archived_bytes: int
+    created_at: datetime
+
+    class Config:
+        collection = "evaluation_archives"
+
+
+class EvaluationArchiveChunkDB(Model):
+    """Consecutive archived scenarios of an evaluation, in _id order, stored
+    as compressed value columns"""
+
+    evaluation_id: str
+    first_id: ObjectId
+    last_id: ObjectId
+    count: int
+    # The scenario ids, 12 bytes each
+    ids: bytes
+    # zlib compressed JSON of the value columns
+    data: bytes
+
+    class Config:
+        collection = "evaluation_archive_chunks"
+
+        @staticmethod
+        def indexes():
+            yield Index(
+                EvaluationArchiveChunkDB.evaluation_id,
+                EvaluationArchiveChunkDB.first_id,
+                unique=True,
+            )
+
+
+class AICritiqueCacheDB(Model):
+    """Verdict of the AI critique of a prompt, see ai_critique_cache"""
+
+    # Hash of the prompt and the model settings it was critiqued with
+    key: str = Field(unique=True)
+    verdict: str
+    hits: int = Field(default=0)
+    created_at: datetime
+    # Pushed back on every hit, the least recently used entries expire first
+    expires_at: datetime
+
+    class Config:
+        collection = "ai_critique_cache"
+
+        @staticmethod
+        def indexes():
+            yield IndexModel([("expires_at", 1)], expireAfterSeconds=0)
+
 
 class CustomEvaluationDB(Model):
     evaluation_name: str
@@ -138,14 +292,130 @@ class CustomEvaluationDB(Model):
     class Config:
         collection = "custom_evaluations"
 
+        @staticmethod
+        def indexes():
+            yield Index(CustomEvaluationDB.user, CustomEvaluationDB.app_name)
+
 
 class TestSetDB(Model):
     name: str
     app_name: str
-    csvdata: List[Dict[str, str]]
+    # Rows of the test sets created before the rows were chunked, moved to
+    # testset_rows by the migration
+    csvdata: List[Dict[str, str]] = Field(default=[])
+    row_count: int = Field(default=0)
+    # Version of the row chunks in testset_rows, 0 while the rows are inline
+    rows_version: int = Field(default=0)
+    # Last version handed out to a writer, see testset_service
+    last_rows_version: int = Field(default=0)
+    # Key of the row chunks in testset_rows, the test set id when missing
+    rows_key: Optional[ObjectId] = None
+    # Content shared with the test sets holding the same rows, missing once
+    # the rows are edited in place
+    content_id: Optional[ObjectId] = None
+    # Hash of the rows, missing while unknown
+    content_hash: Optional[str] = None
     user: UserDB = Reference(key_name="user")
     created_at: Optional[datetime] = Field(default=datetime.utcnow())
     updated_at: Optional[datetime] = Field(default=datetime.utcnow())
 
     class Config:
         collection = "testsets"
+
+        @staticmethod
+        def indexes():
+            yield Index(TestSetDB.user, TestSetDB.app_name)
+
+
+class TestSetContentDB(Model):
+    """Rows stored once for every test set referencing them, their chunks
+    being keyed by the content id"""
+
+    content_hash: str
+    row_count: int
+    # Number of test sets referencing the content
+    refs: int
+    created_at: datetime
+
+    class Config:
+        collection = "testset_contents"
+
+        @staticmethod
+        def indexes():
+            yield Index(TestSetContentDB.content_hash, unique=True)
+
+
+class TestSetRowsChunkDB(Model):
+    """Consecutive rows of a test set, starting at row `first_row`"""
+
+    # Content id, or test set id for the rows written before contents
+    testset_id: ObjectId
+    version: int
+    first_row: int
+    rows: List[Dict[str, str]]
+    # Hashes of the rows, concatenated, see testset_service.row_hashes,
+    # missing for the chunks written before they were kept
+    row_hashes: Optional[bytes] = None
+
+    class Config:
+        collection = "testset_rows"
+
+        @staticmethod
+        def indexes():
+            yield Index(
+                TestSetRowsChunkDB.testset_id,
+                TestSetRowsChunkDB.version,
+                TestSetRowsChunkDB.first_row,
+                unique=True,
+            )
+
+
+class TestSetImportDB(Model):
+    """Checkpoint of a test set import from a remote endpoint, removed once
+    the test set is created"""
+
+    user: UserDB = Reference(key_name="user")
+    app_name: str
+    name: str
+    endpoint: str
+    # The test set is created with this id once every row is written
+    testset_id: ObjectId
+    # Key the rows are written under, registered as a content at the end
+    rows_key: ObjectId
+    rows_written: int = Field(default=0)
+    # ETag or Last-Modified of the remote data the rows were read from
+    validator: Optional[str] = None
+    # The import is run by a single request at a time, see testset_imports
+    lease_expires_at: datetime
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        collection = "testset_imports"
+
+        @staticmethod
+        def indexes():
+            yield Index(
+                TestSetImportDB.user,
+                TestSetImportDB.app_name,
+                TestSetImportDB.name,
+                TestSetImportDB.endpoint,
+                unique=True,
+            )
+
+
+class TestSetUploadDB(Model):
+    """Marker of the rows being written under a key by an upload or a copy,
+    removed once the rows are referenced"""
+
+    rows_key: ObjectId
+    # Renewed after each chunk, the orphan cleanup spares the rows until then
+    lease_expires_at: datetime
+    created_at: datetime
+
+    class Config:
+        collection = "testset_uploads"
+
+        @staticmethod
+        def indexes():
+            yield Index(TestSetUploadDB.rows_key)
@@ -14,7 +14,7 @@ from agenta_backend.models.api.api_models import (
     CreateAppVariant,
 )
 
-from agenta_backend.services import app_manager, db_manager, docker_utils
+from agenta_backend.services import app_manager, db_manager, db_reads, docker_utils
 from docker.errors import DockerException
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi import APIRouter, Body, HTTPException, Depends
@@ -39,7 +39,11 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-@router.get("/list_variants/", response_model=List[AppVariant])
+@router.get(
+    "/list_variants/",
+    response_class=db_reads.RawJSONResponse,
+    responses={200: {"model": List[AppVariant]}},
+)
 async def list_app_variants(
     app_name: Optional[str] = None,
     stoken_session: SessionContainer = Depends(verify_session()),
@@ -56,8 +60,9 @@ async def list_app_variants(
     """
     try:
         kwargs: dict = await get_user_and_org_id(stoken_session)
-        app_variants = await db_manager.list_app_variants(app_name=app_name, **kwargs)
-        return app_variants
+        user = await db_manager.get_user_object(kwargs["uid"])
+        app_variants = await db_reads.list_app_variants(user.id, app_name=app_name)
+        return db_reads.RawJSONResponse(content=app_variants)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -4,18 +4,30 @@ from bson import ObjectId
 from datetime import datetime
 from typing import List, Optional
 
-from fastapi.responses import JSONResponse
-from fastapi import HTTPException, APIRouter, Body, Depends
-
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import HTTPException, APIRouter, Body, Depends, Query
+
+from agenta_backend.services import (
+    ai_critique,
+    auto_evaluators,
+    db_reads,
+    evaluation_archive,
+    evaluation_export,
+    evaluation_runner,
+)
+from agenta_backend.services.background_tasks import spawn_background_task
 from agenta_backend.services.helpers import format_inputs, format_outputs
 from agenta_backend.models.api.evaluation_model import (
     CustomEvaluationNames,
     Evaluation,
+    EvaluationCritique,
     EvaluationScenario,
     CustomEvaluationOutput,
     CustomEvaluationDetail,
     EvaluationScenarioScoreUpdate,
     EvaluationScenarioUpdate,
+    EvaluationStatusEnum,
+    EvaluationTypeSettings,
     ExecuteCustomEvaluationCode,
     NewEvaluation,
     DeleteEvaluation,
@@ -26,6 +38,7 @@ from agenta_backend.models.api.evaluation_model import (
 )
 from agenta_backend.services.results_service import (
     fetch_average_score_for_custom_code_run,
+    fetch_score_analytics,
     fetch_results_for_human_a_b_testing_evaluation,
     fetch_results_for_auto_exact_match_evaluation,
     fetch_results_for_auto_similarity_match_evaluation,
@@ -34,10 +47,12 @@ from agenta_backend.services.results_service import (
     fetch_results_for_auto_ai_critique,
 )
 from agenta_backend.services.evaluation_service import (
+    EvaluationMaterializingError,
     UpdateEvaluationScenarioError,
     fetch_custom_evaluation_names,
     fetch_custom_evaluations,
     fetch_custom_evaluation_detail,
+    fetch_evaluation_scenarios_page,
     get_evaluation_scenario_score,
     update_evaluation_scenario,
     update_evaluation_scenario_score,
@@ -46,9 +61,10 @@ from agenta_backend.services.evaluation_service import (
     create_new_evaluation_scenario,
     create_custom_code_evaluation,
     execute_custom_code_evaluation,
+    delete_evaluations as delete_evaluations_cascade,
 )
 from agenta_backend.services.db_manager import engine, query, get_user_object
-from agenta_backend.models.db_models import EvaluationDB, EvaluationScenarioDB
+from agenta_backend.models.db_models import EvaluationDB
 from agenta_backend.config import settings
 
 if os.environ["FEATURE_FLAG"] in ["cloud", "ee", "demo"]:
@@ -106,6 +122,8 @@ async def update_evaluation_router(
         # Get user and organization id
         kwargs: dict = await get_user_and_org_id(stoken_session)
         return await update_evaluation(evaluation_id, update_data, **kwargs)
+    except EvaluationMaterializingError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
     except KeyError:
         raise HTTPException(
             status_code=400,
@@ -115,47 +133,324 @@ async def update_evaluation_router(
 
 @router.get(
     "/{evaluation_id}/evaluation_scenarios",
-    response_model=List[EvaluationScenario],
+    response_class=db_reads.RawJSONResponse,
+    responses={200: {"model": List[EvaluationScenario]}},
 )
 async def fetch_evaluation_scenarios(
     evaluation_id: str,
+    limit: Optional[int] = Query(
+        default=None, ge=1, le=settings.evaluation_scenarios_max_page_size
+    ),
+    cursor: Optional[str] = None,
+    fields: Optional[List[str]] = Query(default=None),
+    unvoted: bool = False,
+    unscored: bool = False,
     stoken_session: SessionContainer = Depends(verify_session()),
 ):
-    """Creates an empty evaluation row
+    """Lists the scenarios of an evaluation
+
+    Without a limit every scenario is returned. With a limit the scenarios
+    are paginated in id order and the cursor of the next page, if any, is
+    returned in the X-Next-Cursor header.
 
     Arguments:
-        evaluation_scenario -- _description_
+        evaluation_id -- the evaluation
+        limit -- the page size
+        cursor -- the X-Next-Cursor of the previous page
+        fields -- the scenario fields to return, all of them by default
+        unvoted -- only return the scenarios without a vote
+        unscored -- only return the scenarios without a score
 
-    Raises:
-        HTTPException: _description_
+    Returns:
+        the scenarios
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    scenarios, next_cursor = await fetch_evaluation_scenarios_page(
+        evaluation_id,
+        user,
+        limit=limit,
+        cursor=cursor,
+        fields=fields,
+        unvoted=unvoted,
+        unscored=unscored,
+    )
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return db_reads.RawJSONResponse(content=scenarios, headers=headers)
+
+
+@router.get("/{evaluation_id}/export")
+async def export_evaluation(
+    evaluation_id: str,
+    export_format: str = Query(default="csv", alias="format", regex="^(csv|jsonl)$"),
+    gzip: bool = False,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Downloads the scenarios of an evaluation as CSV or JSON lines
+
+    The scenarios are streamed from the database as they are read, with one
+    column per input and per variant output.
+
+    Arguments:
+        evaluation_id -- the evaluation
+        export_format -- csv or jsonl, passed as `format`
+        gzip -- gzip the file
 
     Returns:
-        _description_
+        the file
     """
 
     # Get user and organization id
     kwargs: dict = await get_user_and_org_id(stoken_session)
     user = await get_user_object(kwargs["uid"])
 
-    # Create query expression builder
-    query_expression = query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    ) & query.eq(EvaluationScenarioDB.user, user.id)
-
-    scenarios = await engine.find(EvaluationScenarioDB, query_expression)
-    eval_scenarios = [
-        EvaluationScenario(
-            evaluation_id=scenario.evaluation_id,
-            inputs=scenario.inputs,
-            outputs=scenario.outputs,
-            vote=scenario.vote,
-            score=scenario.score,
-            correct_answer=scenario.correct_answer,
-            id=str(scenario.id),
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    evaluation = await engine.find_one(EvaluationDB, query_expression)
+    if evaluation is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"evaluation with id {evaluation_id} not found",
         )
-        for scenario in scenarios
-    ]
-    return eval_scenarios
+
+    filename = f"evaluation_{evaluation_id}.{export_format}"
+    media_type = evaluation_export.MEDIA_TYPES[export_format]
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        evaluation_export.iter_evaluation_export(evaluation, export_format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/{evaluation_id}/archive")
+async def archive_evaluation(
+    evaluation_id: str,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Moves the scenarios of a finished evaluation to compressed cold storage
+
+    The scenarios stay readable, they are decoded from the archive.
+
+    Arguments:
+        evaluation_id -- the evaluation
+
+    Returns:
+        the number of archived scenarios
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    if await engine.find_one(EvaluationDB, query_expression) is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"evaluation with id {evaluation_id} not found",
+        )
+
+    try:
+        archived = await evaluation_archive.archive_evaluation(evaluation_id)
+    except evaluation_archive.EvaluationArchiveError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    return {"evaluation_id": evaluation_id, "archived_scenarios": archived}
+
+
+@router.post("/{evaluation_id}/restore")
+async def restore_evaluation(
+    evaluation_id: str,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Moves the scenarios of an archived evaluation back, so they can be
+    edited again
+
+    Arguments:
+        evaluation_id -- the evaluation
+
+    Returns:
+        the number of restored scenarios
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    if await engine.find_one(EvaluationDB, query_expression) is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"evaluation with id {evaluation_id} not found",
+        )
+
+    try:
+        restored = await evaluation_archive.restore_evaluation(evaluation_id)
+    except evaluation_archive.EvaluationArchiveError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    return {"evaluation_id": evaluation_id, "restored_scenarios": restored}
+
+
+@router.post("/{evaluation_id}/run", status_code=202)
+async def run_evaluation(
+    evaluation_id: str,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Runs an evaluation on the backend: every scenario missing an output is
+    sent to the variants and their outputs saved, in the background
+
+    The progress is reported in the run field of the evaluation.
+
+    Arguments:
+        evaluation_id -- the evaluation
+
+    Returns:
+        the status of the evaluation
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    evaluation = await engine.find_one(EvaluationDB, query_expression)
+    if evaluation is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"evaluation with id {evaluation_id} not found",
+        )
+
+    try:
+        endpoints = await evaluation_runner.load_variant_endpoints(evaluation)
+        token = await evaluation_runner.claim_run(evaluation)
+    except evaluation_runner.EvaluationRunError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except evaluation_runner.EvaluationRunInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+    spawn_background_task(evaluation_runner.execute_run(evaluation, token, endpoints))
+    return {
+        "evaluation_id": evaluation_id,
+        "status": EvaluationStatusEnum.EVALUATION_STARTED,
+    }
+
+
+@router.post("/{evaluation_id}/score")
+async def score_evaluation(
+    evaluation_id: str,
+    evaluation_type_settings: Optional[EvaluationTypeSettings] = Body(None),
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Scores the scenarios of an exact match, similarity match or regex test
+    evaluation against their correct answers
+
+    Arguments:
+        evaluation_id -- the evaluation
+        evaluation_type_settings -- a new threshold or regex, saved on the evaluation
+
+    Returns:
+        the number of scored scenarios and of changed scores
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    evaluation = await engine.find_one(EvaluationDB, query_expression)
+    if evaluation is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"evaluation with id {evaluation_id} not found",
+        )
+
+    if evaluation_runner.run_in_progress(evaluation):
+        # The run scores the scenarios once they all hold an output
+        raise HTTPException(
+            status_code=409,
+            detail=f"evaluation with id {evaluation_id} is running",
+        )
+
+    try:
+        result = await auto_evaluators.score_evaluation(
+            evaluation, evaluation_type_settings
+        )
+    except auto_evaluators.AutoEvaluationError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    return {"evaluation_id": evaluation_id, **result}
+
+
+@router.post("/{evaluation_id}/critique", status_code=202)
+async def critique_evaluation(
+    evaluation_id: str,
+    evaluation_critique: EvaluationCritique,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Critiques the outputs of every scenario of an AI critique evaluation
+    not critiqued yet, in the background
+
+    The progress is reported in the critique field of the evaluation.
+
+    Arguments:
+        evaluation_id -- the evaluation
+        evaluation_critique -- the evaluation prompt and the OpenAI API key
+
+    Returns:
+        the status of the evaluation
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    evaluation = await engine.find_one(EvaluationDB, query_expression)
+    if evaluation is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"evaluation with id {evaluation_id} not found",
+        )
+    if evaluation.evaluation_type != EvaluationType.auto_ai_critique:
+        raise HTTPException(
+            status_code=400,
+            detail=f"evaluation with id {evaluation_id} is not an AI critique",
+        )
+
+    try:
+        token = await evaluation_runner.claim_run(evaluation, "critique")
+    except evaluation_runner.EvaluationRunError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except evaluation_runner.EvaluationRunInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+    spawn_background_task(
+        ai_critique.critique_evaluation(
+            evaluation,
+            token,
+            evaluation_critique.evaluation_prompt_template,
+            evaluation_critique.open_ai_key,
+            evaluation_critique.rescore,
+        )
+    )
+    return {
+        "evaluation_id": evaluation_id,
+        "status": EvaluationStatusEnum.EVALUATION_STARTED,
+    }
 
 
 @router.post("/{evaluation_id}/evaluation_scenario", response_model=EvaluationScenario)
@@ -199,6 +494,7 @@ async def create_evaluation_scenario(
     "/{evaluation_id}/evaluation_scenario/{evaluation_scenario_id}/{evaluation_type}"
 )
 async def update_evaluation_scenario_router(
+    evaluation_id: str,
     evaluation_scenario_id: str,
     evaluation_type: EvaluationType,
     evaluation_scenario: EvaluationScenarioUpdate,
@@ -207,6 +503,7 @@ async def update_evaluation_scenario_router(
     """Updates an evaluation row with a vote
 
     Arguments:
+        evaluation_id -- the evaluation of the scenario
         evaluation_scenario_id -- _description_
         evaluation_scenario -- _description_
 
@@ -220,13 +517,20 @@ async def update_evaluation_scenario_router(
         # Get user and organization id
         kwargs: dict = await get_user_and_org_id(stoken_session)
         return await update_evaluation_scenario(
+            evaluation_id,
             evaluation_scenario_id,
             evaluation_scenario,
             evaluation_type,
             **kwargs,
         )
+    except evaluation_archive.EvaluationArchiveError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
     except UpdateEvaluationScenarioError as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
+    except ai_critique.AICritiqueAuthError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except ai_critique.AICritiqueError as e:
+        raise HTTPException(status_code=502, detail=str(e)) from e
 
 
 @router.get("/evaluation_scenario/{evaluation_scenario_id}/score")
@@ -279,11 +583,17 @@ async def update_evaluation_scenario_score_router(
         return await update_evaluation_scenario_score(
             evaluation_scenario_id, payload.score, **kwargs
         )
+    except evaluation_archive.EvaluationArchiveError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
-@router.get("/", response_model=List[Evaluation])
+@router.get(
+    "/",
+    response_class=db_reads.RawJSONResponse,
+    responses={200: {"model": List[Evaluation]}},
+)
 async def fetch_list_evaluations(
     app_name: Optional[str] = None,
     stoken_session: SessionContainer = Depends(verify_session()),
@@ -298,27 +608,8 @@ async def fetch_list_evaluations(
     kwargs: dict = await get_user_and_org_id(stoken_session)
     user = await get_user_object(kwargs["uid"])
 
-    # Construct query expression builder
-    query_expression = query.eq(EvaluationDB.app_name, app_name) & query.eq(
-        EvaluationDB.user, user.id
-    )
-    evaluations = await engine.find(EvaluationDB, query_expression)
-    return [
-        Evaluation(
-            id=str(evaluation.id),
-            status=evaluation.status,
-            evaluation_type=evaluation.evaluation_type,
-            custom_code_evaluation_id=evaluation.custom_code_evaluation_id,
-            evaluation_type_settings=evaluation.evaluation_type_settings,
-            llm_app_prompt_template=evaluation.llm_app_prompt_template,
-            variants=evaluation.variants,
-            app_name=evaluation.app_name,
-            testset=evaluation.testset,
-            created_at=evaluation.created_at,
-            updated_at=evaluation.updated_at,
-        )
-        for evaluation in evaluations
-    ]
+    evaluations = await db_reads.list_evaluations(user.id, app_name)
+    return db_reads.RawJSONResponse(content=evaluations)
 
 
 @router.get("/{evaluation_id}", response_model=Evaluation)
@@ -352,6 +643,9 @@ async def fetch_evaluation(
             variants=evaluation.variants,
             app_name=evaluation.app_name,
             testset=evaluation.testset,
+            materialization=evaluation.materialization,
+            run=evaluation.run,
+            critique=evaluation.critique,
             created_at=evaluation.created_at,
             updated_at=evaluation.updated_at,
         )
@@ -381,24 +675,7 @@ async def delete_evaluations(
     kwargs: dict = await get_user_and_org_id(stoken_session)
     user = await get_user_object(kwargs["uid"])
 
-    deleted_ids = []
-    for evaluations_id in delete_evaluations.evaluations_ids:
-        # Construct query expression builder
-        query_expression = query.eq(
-            EvaluationDB.id, ObjectId(evaluations_id)
-        ) & query.eq(EvaluationDB.user, user.id)
-        evaluation = await engine.find_one(EvaluationDB, query_expression)
-
-        if evaluation is not None:
-            await engine.delete(evaluation)
-            deleted_ids.append(evaluations_id)
-        else:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Comparison table {evaluations_id} not found",
-            )
-
-    return deleted_ids
+    return await delete_evaluations_cascade(delete_evaluations.evaluations_ids, user)
 
 
 @router.get("/{evaluation_id}/results")
@@ -458,11 +735,49 @@ async def fetch_results(
         results = await fetch_results_for_auto_ai_critique(evaluation_id)
         return {"results_data": results}
 
-    elif evaluation.evaluation_type == EvaluationType.custom_code_run:
+    elif evaluation.evaluation_type in [
+        EvaluationType.custom_code_run,
+        EvaluationType.human_scoring,
+    ]:
         results = await fetch_average_score_for_custom_code_run(evaluation_id)
         return {"avg_score": results}
 
 
+@router.get("/{evaluation_id}/results/analytics")
+async def fetch_results_analytics(
+    evaluation_id: str,
+    bins: int = Query(default=10, ge=1, le=100),
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Fetch the score distribution of each variant of a custom code run or
+    human scoring evaluation
+
+    Arguments:
+        evaluation_id -- the evaluation
+        bins -- the number of histogram bins
+
+    Returns:
+        mean, stddev, min, max, percentiles and histogram of the scores per variant
+    """
+
+    # Get user and organization id
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    # Construct query expression builder and retrieve evaluation from database
+    query_expression = query.eq(EvaluationDB.id, ObjectId(evaluation_id)) & query.eq(
+        EvaluationDB.user, user.id
+    )
+    evaluation = await engine.find_one(EvaluationDB, query_expression)
+    if evaluation is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Evaluation {evaluation_id} not found",
+        )
+
+    return await fetch_score_analytics(evaluation_id, bins)
+
+
 @router.post("/custom_evaluation/")
 async def create_custom_evaluation(
     custom_evaluation_payload: CreateCustomEvaluation,
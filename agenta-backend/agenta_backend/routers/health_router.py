@@ -0,0 +1,55 @@
+import os
+
+from fastapi import APIRouter, Depends
+
+from agenta_backend.models.db_engine import get_pool_stats
+from agenta_backend.services.ai_critique_cache import critique_cache_stats
+from agenta_backend.services.background_tasks import sweeper_stats
+
+if os.environ["FEATURE_FLAG"] in ["cloud", "ee", "demo"]:
+    from agenta_backend.ee.services.auth_helper import SessionContainer, verify_session
+else:
+    from agenta_backend.services.auth_helper import SessionContainer, verify_session
+
+
+router = APIRouter()
+
+
+@router.get("/db_pool/")
+async def db_pool_stats(
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Returns the mongo connection pool utilization of this process.
+
+    Returns:
+        dict: the configured pool size and the counters of each server pool
+    """
+
+    return get_pool_stats()
+
+
+@router.get("/sweeper/")
+async def soft_deleted_sweeper_stats(
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Returns the counters of the soft-deleted variants sweeper.
+
+    Returns:
+        dict: runs, failures and deleted variants since the process started
+    """
+
+    return sweeper_stats
+
+
+@router.get("/ai_critique_cache/")
+async def ai_critique_cache_stats(
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """Returns the counters of the AI critique verdict cache.
+
+    Returns:
+        dict: hits, misses, shared completions, errors and trimmed verdicts
+        since the process started
+    """
+
+    return critique_cache_stats
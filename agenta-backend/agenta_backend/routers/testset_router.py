@@ -1,22 +1,30 @@
 import os
-import csv
-import json
-import requests
 from copy import deepcopy
 from bson import ObjectId
 from datetime import datetime
 from typing import Optional, List
 
-from fastapi import HTTPException, APIRouter, UploadFile, File, Form, Depends
+from fastapi import HTTPException, APIRouter, UploadFile, File, Form, Depends, Query
+from fastapi.responses import StreamingResponse
 
 from agenta_backend.models.api.testset_model import (
     UploadResponse,
     DeleteTestsets,
     NewTestset,
     TestSetOutputResponse,
+    TestsetRowsPatch,
+    TestsetRowsSelection,
 )
 from agenta_backend.config import settings
 from agenta_backend.models.db_models import TestSetDB
+from agenta_backend.services import (
+    db_reads,
+    testset_columnar,
+    testset_imports,
+    testset_parsers,
+    testset_selection,
+    testset_service,
+)
 from agenta_backend.services.db_manager import engine, query, get_user_object
 
 
@@ -50,9 +58,14 @@ async def upload_file(
     """
     Uploads a CSV or JSON file and saves its data to MongoDB.
 
+    The file is parsed as it is read and its rows are written in chunks,
+    so large files are uploaded with a bounded memory use.
+
     Args:
-    upload_type : Either a json or csv file.
-        file (UploadFile): The CSV or JSON file to upload.
+    upload_type : Either a json or csv file. JSON files hold an array of
+        objects or JSON lines, "JSONL" is accepted as well. "PARQUET" and
+        "ARROW" (IPC file or stream) files are read in record batches.
+        file (UploadFile): The CSV, JSON, Parquet or Arrow file to upload.
         testset_name (Optional): the name of the testset if provided.
 
     Returns:
@@ -62,49 +75,40 @@ async def upload_file(
     kwargs: dict = await get_user_and_org_id(stoken_session)
 
     try:
-        # Create a document
-        document = {
-            "created_at": datetime.now().isoformat(),
-            "name": testset_name if testset_name else file.filename,
-            "app_name": app_name,
-            "csvdata": [],
-        }
-
-        if upload_type == "JSON":
-            # Read and parse the JSON file
-            json_data = await file.read()
-            json_text = json_data.decode("utf-8")
-            json_object = json.loads(json_text)
-
-            # Populate the document with column names and values
-            for row in json_object:
-                document["csvdata"].append(row)
-
+        name = testset_name if testset_name else file.filename
+        created_at = datetime.now().isoformat()
+
+        # Parse the file as it is read
+        chunks = testset_parsers.iter_upload_chunks(file)
+        if upload_type in ["PARQUET", "ARROW"]:
+            rows = testset_columnar.iter_columnar_rows(file, upload_type.lower())
+        elif upload_type in ["JSON", "JSONL"]:
+            rows = testset_parsers.check_columns(
+                testset_parsers.iter_json_rows(chunks)
+            )
         else:
-            # Read and parse the CSV file
-            csv_data = await file.read()
-            csv_text = csv_data.decode("utf-8")
-            csv_reader = csv.reader(csv_text.splitlines())
-            columns = next(csv_reader)  # Get the column names
-
-            # Populate the document with column names and values
-            for row in csv_reader:
-                row_data = {}
-                for i, value in enumerate(row):
-                    row_data[columns[i]] = value
-                document["csvdata"].append(row_data)
+            rows = testset_parsers.iter_csv_rows(chunks)
 
         user = await get_user_object(kwargs["uid"])
-        testset_instance = TestSetDB(**document, user=user)
-        result = await engine.save(testset_instance)
+        result = await testset_service.create_testset(
+            name=name,
+            app_name=app_name,
+            rows=rows,
+            user=user,
+            created_at=created_at,
+        )
 
         if isinstance(result.id, ObjectId):
             return UploadResponse(
                 id=str(result.id),
-                name=document["name"],
-                created_at=document["created_at"],
+                name=name,
+                created_at=created_at,
             )
 
+    except testset_parsers.TestSetParsingError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except testset_columnar.ColumnarFormatUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e)) from e
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Failed to process file") from e
@@ -120,8 +124,12 @@ async def import_testset(
     """
     Import JSON testset data from an endpoint and save it to MongoDB.
 
+    The response is streamed and its rows written as they arrive. An import
+    interrupted by a network failure resumes where it stopped when the same
+    import is requested again.
+
     Args:
-        endpoint (str): An endpoint URL to import data from.
+        endpoint (str): An endpoint URL serving a JSON array or JSON lines.
         testset_name (str): the name of the testset if provided.
 
     Returns:
@@ -129,45 +137,38 @@ async def import_testset(
     """
 
     try:
-        response = requests.get(endpoint, timeout=10)
-
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=400, detail="Failed to fetch testset from endpoint"
-            )
-
-        # Create a document
-        document = {
-            "created_at": datetime.now().isoformat(),
-            "name": testset_name,
-            "app_name": app_name,
-            "csvdata": [],
-        }
-
-        # Populate the document with column names and values
-        json_response = response.json()
-        for row in json_response:
-            document["csvdata"].append(row)
-
         kwargs: dict = await get_user_and_org_id(stoken_session)
         user = await get_user_object(kwargs["uid"])
-        testset_instance = TestSetDB(**document, user=user)
-        result = await engine.save(testset_instance)
+        result = await testset_imports.import_testset(
+            endpoint=endpoint, name=testset_name, app_name=app_name, user=user
+        )
 
         if isinstance(result.id, ObjectId):
             return UploadResponse(
                 id=str(result.id),
-                name=document["name"],
-                created_at=document["created_at"],
+                name=result.name,
+                created_at=result.created_at.isoformat(),
             )
 
     except HTTPException as error:
         print(error)
         raise error
-    except json.JSONDecodeError as error:
+    except testset_imports.TestSetImportInProgress as error:
+        raise HTTPException(status_code=409, detail=str(error)) from error
+    except testset_imports.TestSetImportError as error:
+        print(error)
+        raise HTTPException(status_code=400, detail=str(error)) from error
+    except testset_parsers.TestSetParsingError as error:
+        print(error)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Endpoint does not return valid JSON testset data: {error}",
+        ) from error
+    except testset_imports.TestSetImportInterrupted as error:
         print(error)
         raise HTTPException(
-            status_code=400, detail="Endpoint does not return valid JSON testset data"
+            status_code=502,
+            detail=f"{error}. Import the testset again to resume.",
         ) from error
     except Exception as error:
         print(error)
@@ -203,8 +204,13 @@ async def create_testset(
     }
     try:
         user = await get_user_object(kwargs["uid"])
-        testset_instance = TestSetDB(**testset, user=user)
-        await engine.save(testset_instance)
+        testset_instance = await testset_service.create_testset(
+            name=testset["name"],
+            app_name=app_name,
+            rows=testset["csvdata"],
+            user=user,
+            created_at=testset["created_at"],
+        )
 
         if testset_instance is not None:
             testset["_id"] = str(testset_instance.id)
@@ -230,11 +236,6 @@ async def update_testset(
     Returns:
     str: The id of the test set updated.
     """
-    testset = {
-        "name": csvdata.name,
-        "csvdata": csvdata.csvdata,
-        "updated_at": datetime.now().isoformat(),
-    }
     try:
         kwargs: dict = await get_user_and_org_id(stoken_session)
         user = await get_user_object(kwargs["uid"])
@@ -246,8 +247,9 @@ async def update_testset(
 
         # Find and update testset
         result = await engine.find_one(TestSetDB, query_expression)
-        result.update(testset)
-        await engine.save(result)
+        await testset_service.replace_testset_rows(
+            result, csvdata.csvdata, name=csvdata.name
+        )
 
         if isinstance(result.id, ObjectId):
             return {
@@ -262,7 +264,58 @@ async def update_testset(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/")
+@router.patch("/{testset_id}")
+async def patch_testset(
+    testset_id: str,
+    patch: TestsetRowsPatch,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """
+    Insert, update and delete some rows of a testset, splitting again only
+    the chunks holding them.
+
+    Args:
+    testset_id (str): id of the test set to be edited.
+    patch (TestsetRowsPatch): the rows to update, delete and insert.
+
+    Returns:
+    dict: The id of the test set updated and its number of rows.
+    """
+
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    # Define query expression
+    query_expression = query.eq(TestSetDB.user, user.id) & query.eq(
+        TestSetDB.id, ObjectId(testset_id)
+    )
+
+    testset = await engine.find_one(TestSetDB, query_expression)
+    if testset is None:
+        raise HTTPException(status_code=404, detail="testset not found")
+
+    try:
+        row_count = await testset_service.patch_testset_rows(
+            testset,
+            updates=[(update.index, update.row) for update in patch.updates],
+            deletes=patch.deletes,
+            inserts=[(insert.index, insert.row) for insert in patch.inserts],
+            name=patch.name,
+        )
+    except testset_service.TestSetPatchError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except testset_service.TestSetPatchConflict as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+    return {
+        "status": "success",
+        "message": "testset updated successfully",
+        "_id": testset_id,
+        "row_count": row_count,
+    }
+
+
+@router.get("/", response_class=db_reads.RawJSONResponse)
 async def get_testsets(
     app_name: Optional[str] = None,
     stoken_session: SessionContainer = Depends(verify_session()),
@@ -280,25 +333,16 @@ async def get_testsets(
     kwargs: dict = await get_user_and_org_id(stoken_session)
     user = await get_user_object(kwargs["uid"])
 
-    # Define query expression
-    query_expression = query.eq(TestSetDB.user, user.id) & query.eq(
-        TestSetDB.app_name, app_name
-    )
-    testsets: List[TestSetDB] = await engine.find(TestSetDB, query_expression)
-    return [
-        TestSetOutputResponse(
-            id=str(testset.id),
-            name=testset.name,
-            app_name=testset.app_name,
-            created_at=testset.created_at,
-        )
-        for testset in testsets
-    ]
+    # The rows are projected out, only the test set metadata is read
+    testsets = await db_reads.list_testsets(user.id, app_name)
+    return db_reads.RawJSONResponse(content=testsets)
 
 
 @router.get("/{testset_id}", tags=["testsets"])
 async def get_testset(
     testset_id: str,
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1),
     stoken_session: SessionContainer = Depends(verify_session()),
 ):
     """
@@ -306,6 +350,8 @@ async def get_testset(
 
     Args:
         testset_id (str): The _id of the testset to fetch.
+        offset (int): The index of the first row to return.
+        limit (Optional[int]): The number of rows to return, all of them by default.
 
     Returns:
         The requested testset if found, else an HTTPException.
@@ -321,6 +367,10 @@ async def get_testset(
 
     testset = await engine.find_one(TestSetDB, query_expression)
     if testset is not None:
+        stop = offset + limit if limit is not None else None
+        testset.csvdata = await testset_service.read_testset_rows(
+            testset, offset, stop
+        )
         return testset
     else:
         raise HTTPException(
@@ -328,6 +378,148 @@ async def get_testset(
         )
 
 
+@router.post(
+    "/{testset_id}/rows/selection",
+    tags=["testsets"],
+    response_class=db_reads.RawJSONResponse,
+)
+async def select_testset_rows(
+    testset_id: str,
+    selection: TestsetRowsSelection,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """
+    Fetch the rows of a testset matching some column filters, or a seeded
+    random sample of them, stratified by a column if requested.
+
+    Args:
+        testset_id (str): The _id of the testset.
+        selection (TestsetRowsSelection): the filters and the sample to take.
+
+    Returns:
+        dict: The selected rows and their indexes in the testset.
+    """
+
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    # Define query expression
+    query_expression = query.eq(TestSetDB.user, user.id) & query.eq(
+        TestSetDB.id, ObjectId(testset_id)
+    )
+
+    testset = await engine.find_one(TestSetDB, query_expression)
+    if testset is None:
+        raise HTTPException(
+            status_code=404, detail=f"testset with id {testset_id} not found"
+        )
+
+    try:
+        row_count, rows = await testset_selection.select_testset_rows(
+            testset, selection
+        )
+    except testset_selection.RowsSelectionError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    indexes, csvdata = [], []
+    async for index, row in rows:
+        indexes.append(index)
+        csvdata.append(row)
+    return db_reads.RawJSONResponse(
+        content={
+            "_id": testset_id,
+            "row_count": row_count,
+            "indexes": indexes,
+            "csvdata": csvdata,
+        }
+    )
+
+
+@router.get("/{testset_id}/export", tags=["testsets"])
+async def export_testset(
+    testset_id: str,
+    file_format: str = Query(
+        default="parquet", alias="format", regex="^(parquet|arrow)$"
+    ),
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """
+    Download a testset as a Parquet file or an Arrow IPC stream, streamed
+    one record batch at a time.
+
+    Args:
+        testset_id (str): The _id of the testset to export.
+        file_format (str): Either parquet or arrow, passed as `format`.
+
+    Returns:
+        The file, every column holding strings.
+    """
+
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    # Define query expression
+    query_expression = query.eq(TestSetDB.user, user.id) & query.eq(
+        TestSetDB.id, ObjectId(testset_id)
+    )
+
+    testset = await engine.find_one(TestSetDB, query_expression)
+    if testset is None:
+        raise HTTPException(
+            status_code=404, detail=f"testset with id {testset_id} not found"
+        )
+
+    try:
+        testset_columnar.require_pyarrow()
+    except testset_columnar.ColumnarFormatUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e)) from e
+
+    extension = "parquet" if file_format == "parquet" else "arrows"
+    return StreamingResponse(
+        testset_columnar.iter_columnar_export(testset, file_format),
+        media_type=testset_columnar.MEDIA_TYPES[file_format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{testset.name}.{extension}"'
+        },
+    )
+
+
+@router.get("/{testset_id}/content_hash", tags=["testsets"])
+async def get_testset_content_hash(
+    testset_id: str,
+    stoken_session: SessionContainer = Depends(verify_session()),
+):
+    """
+    Fetch the hash of the rows of a testset, which changes with its rows.
+
+    Args:
+        testset_id (str): The _id of the testset.
+
+    Returns:
+        dict: The id of the testset, the hash of its rows and their number.
+    """
+
+    kwargs: dict = await get_user_and_org_id(stoken_session)
+    user = await get_user_object(kwargs["uid"])
+
+    # Define query expression
+    query_expression = query.eq(TestSetDB.user, user.id) & query.eq(
+        TestSetDB.id, ObjectId(testset_id)
+    )
+
+    testset = await engine.find_one(TestSetDB, query_expression)
+    if testset is None:
+        raise HTTPException(
+            status_code=404, detail=f"testset with id {testset_id} not found"
+        )
+
+    return {
+        "_id": testset_id,
+        "content_hash": await testset_service.testset_content_hash(testset),
+        "row_count": testset_service.testset_row_count(testset),
+    }
+
+
 @router.delete("/", response_model=List[str])
 async def delete_testsets(
     delete_testsets: DeleteTestsets,
@@ -342,24 +534,22 @@ async def delete_testsets(
     Returns:
     A list of the deleted testsets' IDs.
     """
-    deleted_ids = []
-
     kwargs: dict = await get_user_and_org_id(stoken_session)
     user = await get_user_object(kwargs["uid"])
 
-    for testset_id in delete_testsets.testset_ids:
-        # Define query expression
-        query_expression = query.eq(TestSetDB.user, user.id) & query.eq(
-            TestSetDB.id, ObjectId(testset_id)
+    testset_ids = [ObjectId(testset_id) for testset_id in delete_testsets.testset_ids]
+    filters = {"_id": {"$in": testset_ids}, "user": user.id}
+    found = {
+        str(document["_id"])
+        async for document in engine.get_collection(TestSetDB).find(
+            filters, projection={"_id": 1}
         )
-        testset = await engine.find_one(TestSetDB, query_expression)
-
-        if testset is not None:
-            await engine.delete(testset)
-            deleted_ids.append(testset_id)
-        else:
+    }
+    for testset_id in delete_testsets.testset_ids:
+        if testset_id not in found:
             raise HTTPException(
                 status_code=404, detail=f"testset {testset_id} not found"
             )
 
-    return deleted_ids
+    await testset_service.delete_testsets(filters)
+    return delete_testsets.testset_ids
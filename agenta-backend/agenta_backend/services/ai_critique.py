@@ -0,0 +1,310 @@
+"""AI critique of evaluation scenarios by an OpenAI compatible completion
+model, one scenario or all the scenarios of an evaluation at once
+
+The completions are requested from the event loop with a shared HTTP client,
+at most `settings.ai_critique_concurrency` at a time and at the rate allowed
+by a token bucket per API key, so a batch stays within the rate limit of its
+key instead of running into it. Rate limited and failed requests are retried
+with exponential backoff and jitter. `settings.ai_critique_api_base` points
+the critiques to any server speaking the completions API.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from bson import ObjectId
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import EvaluationDB
+from agenta_backend.services.ai_critique_cache import (
+    cached_critique,
+    critique_cache_key,
+)
+from agenta_backend.services.evaluation_runner import process_scenarios
+from agenta_backend.services.helpers import TTLCache
+from agenta_backend.services.http_client import backoff, get_http_client
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Statuses worth retrying, the model may answer later
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class AICritiqueError(Exception):
+    """Custom exception for critiques the model failed to give."""
+
+    pass
+
+
+class AICritiqueAuthError(AICritiqueError):
+    """Custom exception for API keys refused by the model provider."""
+
+    pass
+
+
+class TokenBucket:
+    """Lets `rate` requests through per second on average and up to
+    `capacity` at once, in their order of arrival."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Waits until a request may be sent."""
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# One bucket per API key, the rate limits of the provider apply per key
+_buckets = TTLCache(maxsize=1024, ttl=3600.0)
+_semaphore: Optional[asyncio.Semaphore] = None
+_proxied_client: Optional[httpx.AsyncClient] = None
+
+
+def _bucket(open_ai_key: str) -> TokenBucket:
+    key = hashlib.sha256(open_ai_key.encode()).hexdigest()
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = TokenBucket(
+            settings.ai_critique_requests_per_second, settings.ai_critique_burst
+        )
+        _buckets.set(key, bucket)
+    return bucket
+
+
+def _concurrency() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(settings.ai_critique_concurrency)
+    return _semaphore
+
+
+def get_critique_client() -> httpx.AsyncClient:
+    """Returns the client the critiques are requested with: the pooled one,
+    or a client going through OPENAI_PROXY when it is set."""
+
+    proxy = os.getenv("OPENAI_PROXY")
+    if not proxy:
+        return get_http_client()
+    global _proxied_client
+    if _proxied_client is None or _proxied_client.is_closed:
+        _proxied_client = httpx.AsyncClient(
+            proxies=proxy, timeout=settings.ai_critique_timeout_seconds
+        )
+    return _proxied_client
+
+
+async def close_critique_client() -> None:
+    """Closes the client going through OPENAI_PROXY, if any."""
+
+    global _proxied_client
+    if _proxied_client is not None:
+        await _proxied_client.aclose()
+        _proxied_client = None
+
+
+def build_critique_prompt(
+    llm_app_prompt_template: str,
+    llm_app_inputs: List[Dict[str, str]],
+    correct_answer: Optional[str],
+    app_variant_output: str,
+    evaluation_prompt_template: str,
+) -> str:
+    """Fills the evaluation prompt template with the variables it uses: the
+    defaults and the inputs of the scenario.
+
+    Raises:
+        AICritiqueError: the template uses an unknown variable
+
+    Returns:
+        str: the prompt sent to the model
+    """
+
+    values: Dict[str, Any] = {
+        "llm_app_prompt_template": llm_app_prompt_template,
+        "correct_answer": correct_answer,
+        "app_variant_output": app_variant_output,
+    }
+    for input_item in llm_app_inputs:
+        values[input_item["input_name"]] = input_item["input_value"]
+
+    used = {
+        name: value
+        for name, value in values.items()
+        if "{%s}" % name in evaluation_prompt_template
+    }
+    try:
+        return evaluation_prompt_template.format(**used)
+    except (KeyError, IndexError, ValueError) as e:
+        raise AICritiqueError(f"Invalid evaluation prompt template: {e!r}") from e
+
+
+async def critique(prompt: str, open_ai_key: str, temperature: float = 0.9) -> str:
+    """Requests the completion of a prompt, retrying
+    `settings.ai_critique_retries` times while the model is rate limited or
+    unavailable.
+
+    Raises:
+        AICritiqueAuthError: the API key is refused
+        AICritiqueError: the model failed to answer
+
+    Returns:
+        str: the completion, stripped
+    """
+
+    client = get_critique_client()
+    bucket = _bucket(open_ai_key)
+    async with _concurrency():
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            try:
+                response = await client.post(
+                    f"{settings.ai_critique_api_base}/completions",
+                    headers={"Authorization": f"Bearer {open_ai_key}"},
+                    json={
+                        "model": settings.ai_critique_model,
+                        "prompt": prompt,
+                        "temperature": temperature,
+                        "max_tokens": settings.ai_critique_max_tokens,
+                    },
+                    timeout=settings.ai_critique_timeout_seconds,
+                )
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    break
+                error = f"status {response.status_code}"
+            except httpx.TransportError as e:
+                error = repr(e)
+            attempt += 1
+            if attempt > settings.ai_critique_retries:
+                raise AICritiqueError(f"AI critique failed: {error}")
+            await backoff(attempt, jitter=True)
+
+    if response.status_code in (401, 403):
+        raise AICritiqueAuthError("The OpenAI API key was refused")
+    if response.status_code != 200:
+        raise AICritiqueError(
+            f"AI critique failed with status {response.status_code}: "
+            f"{response.text[:200]}"
+        )
+    try:
+        return response.json()["choices"][0]["text"].strip()
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise AICritiqueError(f"Unexpected completion: {response.text[:200]}") from e
+
+
+async def critique_scenario(
+    llm_app_prompt_template: str,
+    llm_app_inputs: List[Dict[str, str]],
+    correct_answer: Optional[str],
+    app_variant_output: str,
+    evaluation_prompt_template: str,
+    open_ai_key: str,
+    temperature: float = 0.9,
+    rescore: bool = False,
+) -> str:
+    """Critiques the output of a variant for the inputs of a scenario, the
+    verdict cached for the next critiques of the same prompt. A rescore
+    requests a new verdict, replacing the cached one.
+
+    Raises:
+        AICritiqueError: the template is invalid or the model failed to answer
+
+    Returns:
+        str: the critique
+    """
+
+    prompt = build_critique_prompt(
+        llm_app_prompt_template,
+        llm_app_inputs,
+        correct_answer,
+        app_variant_output,
+        evaluation_prompt_template,
+    )
+    return await cached_critique(
+        critique_cache_key(prompt, temperature),
+        lambda: critique(prompt, open_ai_key, temperature),
+        bypass=rescore,
+    )
+
+
+async def critique_evaluation(
+    evaluation: EvaluationDB,
+    token: ObjectId,
+    evaluation_prompt_template: str,
+    open_ai_key: str,
+    rescore: bool = False,
+) -> Dict[str, int]:
+    """Critiques the output of every scenario of an AI critique evaluation
+    not critiqued yet, then releases the lease of the critique. The progress
+    is kept in the critique field of the evaluation.
+
+    Arguments:
+        evaluation -- the evaluation, its critique claimed with claim_run
+        token -- the token returned by claim_run
+        evaluation_prompt_template -- the prompt set in the AI evaluation view
+        open_ai_key -- the OpenAI API key of the user
+        rescore -- critique again the scenarios already critiqued, without
+        reading the cached verdicts
+
+    Raises:
+        AICritiqueAuthError: the API key is refused, the batch stops
+
+    Returns:
+        Dict[str, int]: the progress of the critique
+    """
+
+    def pending(document: Dict[str, Any]) -> bool:
+        return rescore or not document.get("evaluation")
+
+    async def handle(document: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        outputs = document.get("outputs") or []
+        if not outputs:
+            logger.warning(f"Scenario {document['_id']} has no output to critique")
+            return {}, True
+        try:
+            verdict = await critique_scenario(
+                llm_app_prompt_template=evaluation.llm_app_prompt_template,
+                llm_app_inputs=document.get("inputs") or [],
+                correct_answer=document.get("correct_answer"),
+                app_variant_output=outputs[0]["variant_output"],
+                evaluation_prompt_template=evaluation_prompt_template,
+                open_ai_key=open_ai_key,
+                rescore=rescore,
+            )
+        except AICritiqueAuthError:
+            raise
+        except AICritiqueError as e:
+            logger.warning(f"Scenario {document['_id']}: {e}")
+            return {}, True
+        return {"evaluation": verdict}, False
+
+    return await process_scenarios(
+        evaluation,
+        token,
+        "critique",
+        {"inputs": 1, "outputs": 1, "correct_answer": 1, "evaluation": 1},
+        pending,
+        handle,
+        settings.ai_critique_concurrency,
+    )
@@ -0,0 +1,197 @@
+"""Persistent cache of the AI critique verdicts, shared by every process
+
+A verdict is stored under the hash of the prompt sent to the model and of
+the model settings, so critiquing again the same evaluation prompt, output,
+inputs and correct answer costs a database read instead of a completion.
+Entries expire `settings.ai_critique_cache_ttl_seconds` after their last
+hit through a TTL index, and the least recently used ones are trimmed down
+to `settings.ai_critique_cache_max_entries` periodically. Identical prompts
+critiqued at the same time in a process share a single completion, taken
+over by one of the waiting critiques when the critique requesting it is
+cancelled.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import AICritiqueCacheDB
+from agenta_backend.services.db_manager import engine
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Counters of the verdict cache since the process started
+critique_cache_stats: Dict[str, Any] = {
+    "hits": 0,
+    "misses": 0,
+    "shared": 0,
+    "errors": 0,
+    "trimmed": 0,
+}
+
+# Completions in flight in this process, by cache key
+_pending: Dict[str, "asyncio.Future[str]"] = {}
+
+
+class CritiqueAbandonedError(Exception):
+    """Custom exception for completions abandoned by a cancelled critique,
+    requested again by the critiques waiting for them."""
+
+    pass
+
+
+def critique_cache_key(prompt: str, temperature: float) -> str:
+    """Hashes a prompt with the settings of the model critiquing it."""
+
+    content = json.dumps(
+        [
+            settings.ai_critique_api_base,
+            settings.ai_critique_model,
+            settings.ai_critique_max_tokens,
+            temperature,
+            prompt,
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+async def get_cached_verdict(key: str) -> Optional[str]:
+    """Returns the cached verdict of a key and pushes its expiry back, None
+    when it is not cached or the cache is unavailable."""
+
+    now = datetime.utcnow()
+    try:
+        document = await engine.get_collection(AICritiqueCacheDB).find_one_and_update(
+            {"key": key, "expires_at": {"$gt": now}},
+            {
+                "$inc": {"hits": 1},
+                "$set": {
+                    "expires_at": now
+                    + timedelta(seconds=settings.ai_critique_cache_ttl_seconds)
+                },
+            },
+            projection={"verdict": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+    except PyMongoError as e:
+        critique_cache_stats["errors"] += 1
+        logger.warning(f"AI critique cache read failed: {e}")
+        return None
+    return None if document is None else document["verdict"]
+
+
+async def cache_verdict(key: str, verdict: str) -> None:
+    """Stores a verdict, logging rather than raising when the cache is
+    unavailable: the verdict was paid for, the critique goes on."""
+
+    now = datetime.utcnow()
+    try:
+        await engine.get_collection(AICritiqueCacheDB).update_one(
+            {"key": key},
+            {
+                "$set": {
+                    "verdict": verdict,
+                    "expires_at": now
+                    + timedelta(seconds=settings.ai_critique_cache_ttl_seconds),
+                },
+                "$setOnInsert": {"hits": 0, "created_at": now},
+            },
+            upsert=True,
+        )
+    except PyMongoError as e:
+        critique_cache_stats["errors"] += 1
+        logger.warning(f"AI critique cache write failed: {e}")
+
+
+async def cached_critique(
+    key: str, critique: Callable[[], Awaitable[str]], bypass: bool = False
+) -> str:
+    """Returns the cached verdict of a key, or the one of `critique` once
+    stored. Concurrent calls for a key not cached yet wait for the first one,
+    and one of them requests the verdict in its place if it is cancelled.
+
+    Arguments:
+        key -- the cache key, see critique_cache_key
+        critique -- requests the verdict from the model
+        bypass -- request a new verdict even if one is cached, and replace it
+
+    Returns:
+        str: the verdict
+    """
+
+    while True:
+        pending = _pending.get(key)
+        if pending is None:
+            verdict = None if bypass else await get_cached_verdict(key)
+            if verdict is not None:
+                critique_cache_stats["hits"] += 1
+                return verdict
+            # Checked again, another call may have started while reading
+            pending = _pending.get(key)
+            if pending is None:
+                break
+        critique_cache_stats["shared"] += 1
+        try:
+            return await asyncio.shield(pending)
+        except CritiqueAbandonedError:
+            continue
+
+    critique_cache_stats["misses"] += 1
+    future = asyncio.get_running_loop().create_future()
+    _pending[key] = future
+    try:
+        verdict = await critique()
+        await cache_verdict(key, verdict)
+    except asyncio.CancelledError:
+        # One of the waiting calls, if any, requests the verdict instead
+        future.set_exception(CritiqueAbandonedError(f"Critique {key} cancelled"))
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Marked as retrieved, the waiting calls raise it too if any
+        future.exception()
+        raise
+    else:
+        future.set_result(verdict)
+    finally:
+        del _pending[key]
+    return verdict
+
+
+async def trim_critique_cache() -> int:
+    """Removes the least recently used verdicts beyond
+    `settings.ai_critique_cache_max_entries`.
+
+    Returns:
+        int: the number of removed verdicts
+    """
+
+    collection = engine.get_collection(AICritiqueCacheDB)
+    excess = (
+        await collection.estimated_document_count()
+        - settings.ai_critique_cache_max_entries
+    )
+    if excess <= 0:
+        return 0
+
+    cutoff = None
+    async for document in collection.find(
+        {}, projection={"expires_at": 1}, sort=[("expires_at", 1)], skip=excess - 1
+    ).limit(1):
+        cutoff = document["expires_at"]
+    if cutoff is None:
+        return 0
+    result = await collection.delete_many({"expires_at": {"$lte": cutoff}})
+    critique_cache_stats["trimmed"] += result.deleted_count
+    logger.info(f"Trimmed {result.deleted_count} AI critique verdict(s) from the cache")
+    return result.deleted_count
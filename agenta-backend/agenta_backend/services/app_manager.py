@@ -14,8 +14,8 @@ from agenta_backend.models.api.api_models import (
     Image,
     ImageExtended,
 )
-from agenta_backend.models.db_models import AppVariantDB, TestSetDB
-from agenta_backend.services import db_manager, docker_utils
+from agenta_backend.models.db_models import AppVariantDB
+from agenta_backend.services import db_manager, docker_utils, testset_service
 from docker.errors import DockerException
 
 logging.basicConfig(level=logging.INFO)
@@ -262,7 +262,7 @@ async def remove_app_related_resources(app_name: str, **kwargs: dict):
 
 
 async def remove_app_testsets(app_name: str, **kwargs):
-    """Returns a list of testsets owned by an app.
+    """Deletes the testsets owned by an app, with one delete_many.
 
     Args:
         app_name (str): The name of the app
@@ -274,25 +274,14 @@ async def remove_app_testsets(app_name: str, **kwargs):
     # Get user object
     user = await db_manager.get_user_object(kwargs["uid"])
 
-    # Find testsets owned by the app
-    deleted_count: int = 0
-
-    # Build query expression
-    query_expression = db_manager.query.eq(
-        TestSetDB.user, user.id
-    ) & db_manager.query.eq(TestSetDB.app_name, app_name)
-    testsets = await db_manager.engine.find(TestSetDB, query_expression)
-
-    # Perform deletion if there are testsets to delete
-    if testsets is not None:
-        for testset in testsets:
-            await db_manager.engine.delete(testset)
-            deleted_count += 1
-            logger.info(f"{deleted_count} testset(s) deleted for app {app_name}")
-            return deleted_count
-
-    logger.info(f"No testsets found for app {app_name}")
-    return 0
+    deleted_ids = await testset_service.delete_testsets(
+        {"user": user.id, "app_name": app_name}
+    )
+    if deleted_ids:
+        logger.info(f"{len(deleted_ids)} testset(s) deleted for app {app_name}")
+    else:
+        logger.info(f"No testsets found for app {app_name}")
+    return len(deleted_ids)
 
 
 async def start_variant(
@@ -0,0 +1,278 @@
+"""Backend scoring of the exact match, similarity match and regex test
+evaluations, over all the scenarios of an evaluation at once
+
+The scores are the ones the web app computes one scenario at a time. The
+scorer of an evaluation is built once, its regex compiled once, and keeps
+the score of each distinct pair of output and correct answer, so scoring
+again with a new threshold or pattern is one pass over the scenarios
+without any call to a variant. Only the scores that change are written,
+with one bulk_write per batch, and the result counters are moved by the
+same amounts. Regexes are matched in a worker thread, off the event loop,
+within `settings.auto_evaluation_regex_budget_seconds` per scoring.
+"""
+import asyncio
+import logging
+import re
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from starlette.concurrency import run_in_threadpool
+
+from agenta_backend.config import settings
+from agenta_backend.models.api.evaluation_model import (
+    EvaluationType,
+    EvaluationTypeSettings as EvaluationTypeSettingsUpdate,
+)
+from agenta_backend.models.db_models import (
+    EvaluationDB,
+    EvaluationScenarioDB,
+    EvaluationTypeSettings,
+)
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.results_service import (
+    increment_result_counters,
+    rebuild_result_counters,
+)
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+AUTO_EVALUATION_TYPES = (
+    EvaluationType.auto_exact_match.value,
+    EvaluationType.auto_similarity_match.value,
+    EvaluationType.auto_regex_test.value,
+)
+
+
+class AutoEvaluationError(Exception):
+    """Custom exception for evaluations that cannot be scored on the backend."""
+
+    pass
+
+
+def similarity(output: str, correct_answer: str) -> float:
+    """Jaccard similarity of the sets of words separated by a space."""
+
+    words = set(output.split(" "))
+    expected = set(correct_answer.split(" "))
+    return len(words & expected) / len(words | expected)
+
+
+def build_scorer(
+    evaluation_type: str, type_settings: EvaluationTypeSettings
+) -> Callable[[str, str], str]:
+    """Builds the function scoring an output against its correct answer.
+
+    Arguments:
+        evaluation_type -- auto_exact_match, auto_similarity_match or auto_regex_test
+        type_settings -- the threshold or the regex of the evaluation
+
+    Raises:
+        AutoEvaluationError: the type is not scored on the backend, or the
+        regex pattern is invalid
+
+    Returns:
+        Callable[[str, str], str]: the scorer, caching its results
+    """
+
+    if evaluation_type == EvaluationType.auto_exact_match:
+
+        def score(output: str, correct_answer: str) -> str:
+            return "correct" if output == correct_answer else "wrong"
+
+    elif evaluation_type == EvaluationType.auto_similarity_match:
+        threshold = type_settings.similarity_threshold or 0.0
+
+        def score(output: str, correct_answer: str) -> str:
+            similar = similarity(output, correct_answer) >= threshold
+            return "true" if similar else "false"
+
+    elif evaluation_type == EvaluationType.auto_regex_test:
+        try:
+            pattern = re.compile(type_settings.regex_pattern or "", re.IGNORECASE)
+        except re.error as e:
+            raise AutoEvaluationError(f"Invalid regex pattern: {e}") from e
+        should_match = type_settings.regex_should_match is not False
+
+        def score(output: str, correct_answer: str) -> str:
+            matches = pattern.search(output) is not None
+            return "correct" if matches == should_match else "wrong"
+
+    else:
+        raise AutoEvaluationError(
+            f"Evaluations of type {evaluation_type} are not scored on the backend"
+        )
+
+    return lru_cache(maxsize=settings.auto_evaluation_cache_size)(score)
+
+
+def _over_budget() -> AutoEvaluationError:
+    return AutoEvaluationError(
+        f"Scoring took longer than {settings.auto_evaluation_regex_budget_seconds}s, "
+        "simplify the regex pattern"
+    )
+
+
+def score_pairs(
+    scorer: Callable[[str, str], str],
+    pairs: List[Tuple[str, str]],
+    deadline: float,
+) -> List[str]:
+    """Scores pairs of output and correct answer until `deadline`.
+
+    Raises:
+        AutoEvaluationError: the deadline, a time.monotonic() value, passed
+
+    Returns:
+        List[str]: the score of each pair
+    """
+
+    scores = []
+    for output, correct_answer in pairs:
+        if time.monotonic() > deadline:
+            raise _over_budget()
+        scores.append(scorer(output, correct_answer))
+    return scores
+
+
+def merge_type_settings(
+    current: EvaluationTypeSettings, update: Optional[EvaluationTypeSettingsUpdate]
+) -> EvaluationTypeSettings:
+    """Returns the settings of an evaluation with the values set in `update`."""
+
+    values = current.dict()
+    if update is not None:
+        values.update(
+            {name: value for name, value in update.dict().items() if value is not None}
+        )
+    return EvaluationTypeSettings(**values)
+
+
+async def score_evaluation(
+    evaluation: EvaluationDB,
+    type_settings: Optional[EvaluationTypeSettingsUpdate] = None,
+) -> Dict[str, int]:
+    """Scores the scenarios of an evaluation holding an output, against
+    their correct answer.
+
+    Arguments:
+        evaluation -- the evaluation to score
+        type_settings -- a new threshold or regex, saved on the evaluation
+
+    Raises:
+        AutoEvaluationError: the evaluation cannot be scored on the backend
+
+    Returns:
+        Dict[str, int]: the number of scored scenarios and of changed scores
+    """
+
+    if evaluation.archived:
+        raise AutoEvaluationError(
+            f"Evaluation {evaluation.id} is archived, restore it to score it"
+        )
+    merged_settings = merge_type_settings(
+        evaluation.evaluation_type_settings, type_settings
+    )
+    scorer = build_scorer(evaluation.evaluation_type, merged_settings)
+    if type_settings is not None:
+        await engine.get_collection(EvaluationDB).update_one(
+            {"_id": evaluation.id},
+            {"$set": {"evaluation_type_settings": merged_settings.doc()}},
+        )
+        evaluation.evaluation_type_settings = merged_settings
+
+    scenarios = engine.get_collection(EvaluationScenarioDB)
+    evaluation_id = str(evaluation.id)
+    started = time.monotonic()
+    scored = 0
+    changed = 0
+    # Set when a scenario changed in the meantime, the counters are rebuilt
+    drifted = False
+    operations = []
+    increments: Dict[Optional[str], int] = {}
+
+    async def flush():
+        nonlocal drifted, operations, increments
+        result = await scenarios.bulk_write(operations, ordered=False)
+        if result.matched_count != len(operations):
+            drifted = True
+        else:
+            await increment_result_counters(evaluation_id, increments)
+        operations = []
+        increments = {}
+
+    deadline = started + settings.auto_evaluation_regex_budget_seconds
+    off_loop = evaluation.evaluation_type == EvaluationType.auto_regex_test
+
+    async def score_batch(documents: List[Dict[str, Any]]) -> List[str]:
+        pairs = [
+            (
+                document["outputs"][0].get("variant_output") or "",
+                document.get("correct_answer") or "",
+            )
+            for document in documents
+        ]
+        if not off_loop:
+            return [scorer(output, correct_answer) for output, correct_answer in pairs]
+        try:
+            # A single slow match is not interrupted, its thread is left
+            # running but the scoring stops
+            return await asyncio.wait_for(
+                run_in_threadpool(score_pairs, scorer, pairs, deadline),
+                timeout=max(deadline - time.monotonic(), 0),
+            )
+        except asyncio.TimeoutError as e:
+            raise _over_budget() from e
+
+    async def score_documents(documents: List[Dict[str, Any]]):
+        nonlocal scored, changed
+        now = datetime.utcnow()
+        for document, score in zip(documents, await score_batch(documents)):
+            scored += 1
+            previous = document.get("score")
+            if score == previous:
+                continue
+
+            changed += 1
+            operations.append(
+                UpdateOne(
+                    {"_id": document["_id"], "score": previous},
+                    {"$set": {"score": score, "updated_at": now}},
+                )
+            )
+            increments[previous] = increments.get(previous, 0) - 1
+            increments[score] = increments.get(score, 0) + 1
+        if len(operations) >= settings.evaluation_scenarios_batch_size:
+            await flush()
+
+    documents = []
+    async for document in scenarios.find(
+        {"evaluation_id": evaluation_id, "user": evaluation.user.id},
+        projection={"outputs.variant_output": 1, "correct_answer": 1, "score": 1},
+        sort=[("_id", 1)],
+    ):
+        if not document.get("outputs"):
+            # Not run yet
+            continue
+        documents.append(document)
+        if len(documents) >= settings.evaluation_scenarios_batch_size:
+            await score_documents(documents)
+            documents = []
+    if documents:
+        await score_documents(documents)
+
+    if operations:
+        await flush()
+    if drifted:
+        await rebuild_result_counters(evaluation_id, evaluation.evaluation_type)
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Scored {scored} scenario(s) of evaluation {evaluation_id}, "
+        f"{changed} changed, in {elapsed:.2f}s"
+    )
+    return {"scored": scored, "changed": changed}
@@ -0,0 +1,188 @@
+"""Background and periodic jobs running next to the API, off the request path
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Set
+
+from agenta_backend.config import settings
+from agenta_backend.services.ai_critique_cache import trim_critique_cache
+from agenta_backend.services.cleanup_service import fail_stale_materializations
+from agenta_backend.services.db_manager import clean_soft_deleted_variants
+from agenta_backend.services.evaluation_archive import archive_finished_evaluations
+from agenta_backend.services.results_service import reconcile_result_counters
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Strong references to the fire-and-forget tasks, so they are not garbage collected
+_running_tasks: Set[asyncio.Task] = set()
+
+# Counters of the soft-deleted variants sweeper
+sweeper_stats: Dict[str, Any] = {
+    "runs": 0,
+    "failures": 0,
+    "deleted_variants": 0,
+    "last_run_at": None,
+    "last_run_seconds": None,
+}
+
+
+async def sweep_soft_deleted_variants() -> int:
+    """Runs one pass of the soft-deleted variants sweeper and updates its counters.
+
+    Returns:
+        int: the number of deleted variants
+    """
+
+    started = time.monotonic()
+    try:
+        deleted_count = await clean_soft_deleted_variants()
+    except Exception:
+        sweeper_stats["failures"] += 1
+        raise
+    finally:
+        sweeper_stats["runs"] += 1
+        sweeper_stats["last_run_at"] = time.time()
+        sweeper_stats["last_run_seconds"] = round(time.monotonic() - started, 4)
+
+    sweeper_stats["deleted_variants"] += deleted_count
+    if deleted_count:
+        logger.info(f"Swept {deleted_count} soft-deleted app variant(s)")
+    return deleted_count
+
+
+async def run_periodically(
+    job: Callable[[], Awaitable[Any]], interval_seconds: float
+) -> None:
+    """Runs `job` every `interval_seconds` until cancelled, logging its failures.
+
+    Arguments:
+        job -- the coroutine function to run
+        interval_seconds -- the delay between two runs
+    """
+
+    while True:
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background job {job.__name__} failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+
+def start_soft_deleted_variants_sweeper() -> asyncio.Task:
+    """Schedules the soft-deleted variants sweeper on the running event loop.
+
+    Returns:
+        asyncio.Task: the sweeper task, to be cancelled on shutdown
+    """
+
+    return asyncio.create_task(
+        run_periodically(
+            sweep_soft_deleted_variants, settings.soft_deleted_sweep_interval_seconds
+        )
+    )
+
+
+def start_result_counters_reconciler() -> asyncio.Task:
+    """Schedules the rebuild of the evaluation result counters on the running
+    event loop, correcting any drift of the incremental updates.
+
+    Returns:
+        asyncio.Task: the reconciler task, to be cancelled on shutdown
+    """
+
+    async def reconcile_later():
+        # The counters are maintained incrementally, no need for a run at startup
+        await asyncio.sleep(settings.evaluation_results_reconcile_interval_seconds)
+        await run_periodically(
+            reconcile_result_counters,
+            settings.evaluation_results_reconcile_interval_seconds,
+        )
+
+    return asyncio.create_task(reconcile_later())
+
+
+def start_evaluation_archiver() -> asyncio.Task:
+    """Schedules the archiving of the evaluations finished long ago on the
+    running event loop.
+
+    Returns:
+        asyncio.Task: the archiver task, to be cancelled on shutdown
+    """
+
+    return asyncio.create_task(
+        run_periodically(
+            archive_finished_evaluations,
+            settings.evaluation_archive_interval_seconds,
+        )
+    )
+
+
+def start_ai_critique_cache_trimmer() -> asyncio.Task:
+    """Schedules the trimming of the AI critique verdict cache on the running
+    event loop.
+
+    Returns:
+        asyncio.Task: the trimmer task, to be cancelled on shutdown
+    """
+
+    return asyncio.create_task(
+        run_periodically(
+            trim_critique_cache,
+            settings.ai_critique_cache_trim_interval_seconds,
+        )
+    )
+
+
+def start_materialization_checker() -> asyncio.Task:
+    """Schedules the failing of the evaluations whose materialization stopped
+    on the running event loop, a first time at startup.
+
+    Returns:
+        asyncio.Task: the checker task, to be cancelled on shutdown
+    """
+
+    return asyncio.create_task(
+        run_periodically(
+            fail_stale_materializations,
+            settings.evaluation_materialization_check_interval_seconds,
+        )
+    )
+
+
+def spawn_background_task(coroutine: Coroutine) -> asyncio.Task:
+    """Runs `coroutine` on the running event loop without awaiting it.
+
+    Exceptions are logged rather than lost with the task.
+
+    Arguments:
+        coroutine -- the coroutine to run
+
+    Returns:
+        asyncio.Task: the scheduled task
+    """
+
+    task = asyncio.create_task(coroutine)
+    _running_tasks.add(task)
+
+    def on_done(finished: asyncio.Task) -> None:
+        _running_tasks.discard(finished)
+        if not finished.cancelled() and finished.exception() is not None:
+            logger.error(f"Background task failed: {finished.exception()}")
+
+    task.add_done_callback(on_done)
+    return task
+
+
+async def cancel_background_tasks() -> None:
+    """Cancels the fire-and-forget tasks still running and waits for them, so
+    they release what they hold before the process exits."""
+
+    tasks = list(_running_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
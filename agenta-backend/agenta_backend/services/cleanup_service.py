@@ -0,0 +1,338 @@
+"""Bulk deletion of the documents depending on deleted ones, and removal of
+the orphans left behind by interrupted deletions
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Set, Tuple
+
+from bson import ObjectId
+
+from agenta_backend.config import settings
+from agenta_backend.models.api.evaluation_model import EvaluationStatusEnum
+from agenta_backend.models.db_models import (
+    EvaluationArchiveChunkDB,
+    EvaluationArchiveDB,
+    EvaluationDB,
+    EvaluationResultsDB,
+    EvaluationScenarioDB,
+    TestSetContentDB,
+    TestSetDB,
+    TestSetImportDB,
+    TestSetRowsChunkDB,
+    TestSetUploadDB,
+)
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.testset_service import (
+    CONTENT_ROWS_VERSION,
+    delete_testset_rows,
+)
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Number of keys looked up at once when searching for orphans
+ORPHAN_LOOKUP_BATCH_SIZE = 1000
+
+
+async def delete_in_batches(collection, filters: Dict[str, Any]) -> int:
+    """Deletes the documents matching a filter `settings.cleanup_delete_batch_size`
+    at a time, so a large deletion does not hold the collection in one
+    long operation.
+
+    Arguments:
+        collection -- the motor collection
+        filters -- the query selecting the documents
+
+    Returns:
+        int: the number of deleted documents
+    """
+
+    deleted = 0
+    while True:
+        documents = collection.find(filters, projection={"_id": 1}).limit(
+            settings.cleanup_delete_batch_size
+        )
+        ids = [document["_id"] async for document in documents]
+        if not ids:
+            return deleted
+        result = await collection.delete_many({"_id": {"$in": ids}})
+        deleted += result.deleted_count
+
+
+async def delete_evaluation_scenarios(evaluation_ids: List[str]) -> int:
+    """Deletes the scenarios of deleted evaluations, archived ones included.
+
+    Arguments:
+        evaluation_ids -- the ids of the deleted evaluations
+
+    Returns:
+        int: the number of deleted scenarios
+    """
+
+    filters = {"evaluation_id": {"$in": evaluation_ids}}
+    deleted = await delete_in_batches(
+        engine.get_collection(EvaluationScenarioDB), filters
+    )
+    await engine.get_collection(EvaluationArchiveChunkDB).delete_many(filters)
+    await engine.get_collection(EvaluationArchiveDB).delete_many(filters)
+    logger.info(
+        f"Deleted {deleted} scenario(s) of {len(evaluation_ids)} deleted evaluation(s)"
+    )
+    return deleted
+
+
+async def fail_stale_materializations() -> int:
+    """Fails the evaluations whose materialization stopped without finishing,
+    their process having been restarted, and deletes their partial scenarios
+    and result counters. A materialization is stale once its lease, renewed
+    with each batch of scenarios, expired.
+
+    Returns:
+        int: the number of failed evaluations
+    """
+
+    now = datetime.utcnow()
+    evaluations = engine.get_collection(EvaluationDB)
+    stale = {
+        "status": EvaluationStatusEnum.EVALUATION_MATERIALIZING.value,
+        "$or": [
+            {"materialization.lease_expires_at": {"$lt": now}},
+            # Started before the materializations held a lease
+            {
+                "materialization.lease_expires_at": None,
+                "updated_at": {
+                    "$lt": now
+                    - timedelta(
+                        seconds=settings.evaluation_materialization_lease_seconds
+                    )
+                },
+            },
+        ],
+    }
+    failed = 0
+    async for evaluation in evaluations.find(stale, projection={"_id": 1}):
+        # Unless renewed in the meantime
+        result = await evaluations.update_one(
+            {"_id": evaluation["_id"], **stale},
+            {
+                "$set": {
+                    "status": EvaluationStatusEnum.EVALUATION_FAILED.value,
+                    "materialization.materialized": 0,
+                    "updated_at": now,
+                }
+            },
+        )
+        if not result.modified_count:
+            continue
+        filters = {"evaluation_id": str(evaluation["_id"])}
+        await delete_in_batches(engine.get_collection(EvaluationScenarioDB), filters)
+        await engine.get_collection(EvaluationResultsDB).delete_one(filters)
+        failed += 1
+    if failed:
+        logger.info(f"Failed {failed} evaluation(s) whose materialization stopped")
+    return failed
+
+
+def _created_before(cutoff: datetime) -> Dict[str, Any]:
+    """Matches the documents created before a date, by the date in their id."""
+
+    return {"_id": {"$lt": ObjectId.from_datetime(cutoff)}}
+
+
+async def _clean_evaluation_orphans(
+    model, cutoff: datetime, live: Dict[str, Any] = {}
+) -> int:
+    """Deletes the documents of a collection keyed by an evaluation_id that
+    no evaluation matching `live` has any more."""
+
+    collection = engine.get_collection(model)
+    evaluations = engine.get_collection(EvaluationDB)
+    created_before = _created_before(cutoff)
+    groups = collection.aggregate(
+        [{"$match": created_before}, {"$group": {"_id": "$evaluation_id"}}],
+        allowDiskUse=True,
+    )
+
+    async def delete_orphans(evaluation_ids: List[Any]) -> int:
+        object_ids = [
+            ObjectId(evaluation_id)
+            for evaluation_id in evaluation_ids
+            if isinstance(evaluation_id, str) and ObjectId.is_valid(evaluation_id)
+        ]
+        existing = {
+            str(document["_id"])
+            async for document in evaluations.find(
+                {"_id": {"$in": object_ids}, **live}, projection={"_id": 1}
+            )
+        }
+        orphans = [
+            evaluation_id
+            for evaluation_id in evaluation_ids
+            if evaluation_id not in existing
+        ]
+        if not orphans:
+            return 0
+        return await delete_in_batches(
+            collection, {**created_before, "evaluation_id": {"$in": orphans}}
+        )
+
+    deleted = 0
+    batch: List[Any] = []
+    async for group in groups:
+        batch.append(group["_id"])
+        if len(batch) >= ORPHAN_LOOKUP_BATCH_SIZE:
+            deleted += await delete_orphans(batch)
+            batch = []
+    if batch:
+        deleted += await delete_orphans(batch)
+    return deleted
+
+
+async def _clean_stale_imports(now: datetime) -> int:
+    """Deletes the checkpoints, and the rows, of the imports not resumed for
+    `settings.testset_import_max_age_seconds`."""
+
+    imports = engine.get_collection(TestSetImportDB)
+    expired = {
+        "lease_expires_at": {
+            "$lt": now - timedelta(seconds=settings.testset_import_max_age_seconds)
+        }
+    }
+    deleted = 0
+    async for job in imports.find(expired, projection={"rows_key": 1}):
+        # Unless resumed in the meantime
+        result = await imports.delete_one({"_id": job["_id"], **expired})
+        if result.deleted_count:
+            await delete_testset_rows(job["rows_key"])
+            deleted += 1
+    return deleted
+
+
+async def _clean_stale_uploads(now: datetime) -> int:
+    """Deletes the markers of the uploads whose lease expired, stopped by a
+    restart, leaving their rows to the orphan cleanup."""
+
+    result = await engine.get_collection(TestSetUploadDB).delete_many(
+        {"lease_expires_at": {"$lt": now}}
+    )
+    return result.deleted_count
+
+
+async def _live_chunk_versions(
+    keys: List[ObjectId],
+) -> Tuple[Dict[ObjectId, int], Dict[ObjectId, int]]:
+    """Tells which chunk versions of the given keys are referenced.
+
+    Returns:
+        the version read for each key of a content, a test set, an import or
+        an upload in progress, and the oldest version in use for each test
+        set keyed by its id
+    """
+
+    exact: Dict[ObjectId, int] = {}
+    oldest: Dict[ObjectId, int] = {}
+    async for document in engine.get_collection(TestSetContentDB).find(
+        {"_id": {"$in": keys}}, projection={"_id": 1}
+    ):
+        exact[document["_id"]] = CONTENT_ROWS_VERSION
+    for model in (TestSetDB, TestSetImportDB, TestSetUploadDB):
+        async for document in engine.get_collection(model).find(
+            {"rows_key": {"$in": keys}}, projection={"rows_key": 1}
+        ):
+            exact[document["rows_key"]] = CONTENT_ROWS_VERSION
+    async for document in engine.get_collection(TestSetDB).find(
+        {"_id": {"$in": keys}, "rows_key": None}, projection={"rows_version": 1}
+    ):
+        # Chunks written under the test set id, before contents, the newer
+        # versions being written by an ongoing update
+        oldest[document["_id"]] = document.get("rows_version", 0)
+    return exact, oldest
+
+
+async def _clean_orphan_chunks(cutoff: datetime) -> int:
+    """Deletes the row chunks no content, test set, import or upload
+    references."""
+
+    chunks = engine.get_collection(TestSetRowsChunkDB)
+    created_before = _created_before(cutoff)
+    groups = chunks.aggregate(
+        [
+            {"$match": created_before},
+            {"$group": {"_id": {"key": "$testset_id", "version": "$version"}}},
+        ],
+        allowDiskUse=True,
+    )
+
+    async def delete_orphans(batch: List[Dict[str, Any]]) -> int:
+        exact, oldest = await _live_chunk_versions(
+            list({group["key"] for group in batch})
+        )
+        orphans: Dict[int, Set[ObjectId]] = {}
+        for group in batch:
+            key, version = group["key"], group["version"]
+            if exact.get(key) == version or version >= oldest.get(key, version + 1):
+                continue
+            orphans.setdefault(version, set()).add(key)
+        deleted = 0
+        for version, keys in orphans.items():
+            result = await chunks.delete_many(
+                {**created_before, "testset_id": {"$in": list(keys)}, "version": version}
+            )
+            deleted += result.deleted_count
+        return deleted
+
+    deleted = 0
+    batch: List[Dict[str, Any]] = []
+    async for group in groups:
+        batch.append(group["_id"])
+        if len(batch) >= ORPHAN_LOOKUP_BATCH_SIZE:
+            deleted += await delete_orphans(batch)
+            batch = []
+    if batch:
+        deleted += await delete_orphans(batch)
+    return deleted
+
+
+async def clean_orphans() -> Dict[str, int]:
+    """Deletes the documents left behind by interrupted or older deletions:
+    the scenarios, result counters and archives of deleted evaluations, the
+    scenarios of archived evaluations not being restored, the expired
+    import checkpoints, the markers of the uploads stopped by a restart, the
+    unreferenced contents and the row chunks of none.
+
+    Only documents older than `settings.orphan_cleanup_grace_seconds` are
+    considered, so the writes in progress are left alone.
+
+    Returns:
+        Dict[str, int]: the number of deleted documents of each kind
+    """
+
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=settings.orphan_cleanup_grace_seconds)
+    contents = await engine.get_collection(TestSetContentDB).delete_many(
+        {"refs": {"$lte": 0}, "created_at": {"$lt": cutoff}}
+    )
+    deleted = {
+        # Including the scenarios left behind by an interrupted archive
+        "evaluation_scenarios": await _clean_evaluation_orphans(
+            EvaluationScenarioDB,
+            cutoff,
+            {"$or": [{"archived": {"$ne": True}}, {"restoring": True}]},
+        ),
+        "evaluation_results": await _clean_evaluation_orphans(
+            EvaluationResultsDB, cutoff
+        ),
+        "evaluation_archives": await _clean_evaluation_orphans(
+            EvaluationArchiveDB, cutoff
+        ),
+        "evaluation_archive_chunks": await _clean_evaluation_orphans(
+            EvaluationArchiveChunkDB, cutoff
+        ),
+        "testset_imports": await _clean_stale_imports(now),
+        "testset_uploads": await _clean_stale_uploads(now),
+        "testset_contents": contents.deleted_count,
+        "testset_rows": await _clean_orphan_chunks(cutoff),
+    }
+    logger.info(f"Orphan cleanup deleted {deleted}")
+    return deleted
@@ -0,0 +1,308 @@
+"""Index bootstrap and startup index report for the mongo collections
+"""
+import logging
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import pymongo
+from bson import ObjectId
+from odmantic import Model
+from odmantic.index import ODMBaseIndex
+
+from agenta_backend.models.db_models import (
+    AICritiqueCacheDB,
+    AppVariantDB,
+    CustomEvaluationDB,
+    EnvironmentDB,
+    EvaluationArchiveChunkDB,
+    EvaluationArchiveDB,
+    EvaluationDB,
+    EvaluationResultsDB,
+    EvaluationScenarioDB,
+    ImageDB,
+    OrganizationDB,
+    TemplateDB,
+    TestSetContentDB,
+    TestSetDB,
+    TestSetImportDB,
+    TestSetRowsChunkDB,
+    TestSetUploadDB,
+    UserDB,
+)
+from agenta_backend.services.db_manager import engine
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INDEXED_MODELS: List[Type[Model]] = [
+    OrganizationDB,
+    UserDB,
+    ImageDB,
+    AppVariantDB,
+    EnvironmentDB,
+    TemplateDB,
+    EvaluationDB,
+    EvaluationScenarioDB,
+    EvaluationResultsDB,
+    EvaluationArchiveDB,
+    EvaluationArchiveChunkDB,
+    CustomEvaluationDB,
+    AICritiqueCacheDB,
+    TestSetDB,
+    TestSetContentDB,
+    TestSetRowsChunkDB,
+    TestSetImportDB,
+    TestSetUploadDB,
+]
+
+
+def canonical_queries() -> List[Tuple[str, Type[Model], Dict[str, Any], Optional[list]]]:
+    """Returns the hot queries issued by db_manager and the routers.
+
+    The values are placeholders, only the shape of each filter matters
+    to the query planner.
+
+    Returns:
+        List of (name, model, filter, sort) tuples
+    """
+
+    user_id = ObjectId()
+    return [
+        (
+            "list_app_variants",
+            AppVariantDB,
+            {"user": user_id, "is_deleted": False, "app_name": "app"},
+            [("app_name", 1), ("variant_name", 1)],
+        ),
+        (
+            "get_app_variant_by_app_name_and_variant_name",
+            AppVariantDB,
+            {
+                "user": user_id,
+                "app_name": "app",
+                "variant_name": "variant",
+                "is_deleted": False,
+            },
+            None,
+        ),
+        (
+            "check_is_last_variant_for_image",
+            AppVariantDB,
+            {"user": user_id, "image": ObjectId(), "is_deleted": False},
+            None,
+        ),
+        ("soft_deleted_variants", AppVariantDB, {"is_deleted": True}, None),
+        (
+            "deploy_to_environment",
+            EnvironmentDB,
+            {"user": user_id, "app_name": "app", "name": "production"},
+            None,
+        ),
+        (
+            "list_environments_by_variant",
+            EnvironmentDB,
+            {"user": user_id, "app_name": "app", "deployed_app_variant": "variant"},
+            None,
+        ),
+        ("get_user_object", UserDB, {"uid": "0"}, None),
+        ("get_user_image_instance", ImageDB, {"user": user_id, "docker_id": "id"}, None),
+        ("fetch_list_evaluations", EvaluationDB, {"user": user_id, "app_name": "app"}, None),
+        (
+            "fetch_evaluation_scenarios",
+            EvaluationScenarioDB,
+            {"evaluation_id": "evaluation", "user": user_id, "_id": {"$gt": ObjectId()}},
+            [("_id", 1)],
+        ),
+        (
+            "fetch_results_votes",
+            EvaluationScenarioDB,
+            {"evaluation_id": "evaluation", "vote": "variant"},
+            None,
+        ),
+        (
+            "fetch_results_scores",
+            EvaluationScenarioDB,
+            {"evaluation_id": "evaluation", "score": "correct"},
+            None,
+        ),
+        ("get_testsets", TestSetDB, {"user": user_id, "app_name": "app"}, None),
+        (
+            "read_testset_rows",
+            TestSetRowsChunkDB,
+            {"testset_id": ObjectId(), "version": 1, "first_row": {"$gte": 0}},
+            [("first_row", 1)],
+        ),
+        (
+            "fetch_custom_evaluations",
+            CustomEvaluationDB,
+            {"user": user_id, "app_name": "app"},
+            None,
+        ),
+    ]
+
+
+# Code of the errors raised when existing documents break a unique index
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# Number of duplicated keys shown for a unique index that could not be built
+DUPLICATE_KEYS_SAMPLE_SIZE = 5
+
+
+async def find_duplicate_keys(
+    collection, fields: List[str]
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """Finds the keys held by several documents, which keep a unique index
+    from being built.
+
+    Arguments:
+        collection -- the motor collection of the index
+        fields -- the fields of the unique index
+
+    Returns:
+        Tuple[int, List[Dict[str, Any]]]: the number of duplicated keys and a
+        sample of them
+    """
+
+    pipeline = [
+        {
+            "$group": {
+                "_id": {field: f"${field}" for field in fields},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+        {
+            "$facet": {
+                "total": [{"$count": "keys"}],
+                "sample": [{"$limit": DUPLICATE_KEYS_SAMPLE_SIZE}],
+            }
+        },
+    ]
+    async for result in collection.aggregate(pipeline, allowDiskUse=True):
+        total = result["total"][0]["keys"] if result["total"] else 0
+        return total, [doc["_id"] for doc in result["sample"]]
+    return 0, []
+
+
+async def ensure_indexes() -> List[Dict[str, Any]]:
+    """Creates the indexes declared on the db models.
+
+    Index creation is idempotent, so this is safe to run on every startup.
+    The indexes are created one by one, an index that cannot be built is
+    logged and does not keep the others from being created.
+
+    Returns:
+        List[Dict[str, Any]]: one entry per index that could not be built,
+        with the duplicated keys when a unique index was broken
+    """
+
+    failures = []
+    for model in INDEXED_MODELS:
+        collection = engine.get_collection(model)
+        for index in model.__indexes__():
+            pymongo_index = (
+                index.get_pymongo_index() if isinstance(index, ODMBaseIndex) else index
+            )
+            try:
+                await collection.create_indexes([pymongo_index])
+            except pymongo.errors.OperationFailure as e:
+                failure = {
+                    "collection": collection.name,
+                    "index": pymongo_index.document["name"],
+                    "error": str(e),
+                }
+                if e.code == DUPLICATE_KEY_ERROR_CODE:
+                    fields = list(pymongo_index.document["key"].keys())
+                    failure["duplicates"], failure["sample"] = (
+                        await find_duplicate_keys(collection, fields)
+                    )
+                logger.error(
+                    f"Failed to create index {failure['index']} on "
+                    f"{failure['collection']}: {e}"
+                )
+                failures.append(failure)
+    logger.info(
+        f"Indexes ensured for {len(INDEXED_MODELS)} collections, "
+        f"{len(failures)} failed"
+    )
+    return failures
+
+
+def winning_plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Flattens the stages of an explain winning plan.
+
+    Arguments:
+        plan -- the `winningPlan` document of an explain output
+
+    Returns:
+        List[str]: the stage names, outermost first
+    """
+
+    stages = []
+    while plan:
+        stages.append(plan.get("stage"))
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif plan.get("inputStages"):
+            for child in plan["inputStages"]:
+                stages.extend(winning_plan_stages(child))
+            break
+        else:
+            break
+    return stages
+
+
+async def build_index_report() -> List[Dict[str, Any]]:
+    """Runs an explain plan for each canonical query.
+
+    Returns:
+        List[Dict[str, Any]]: one entry per query with the winning plan stages
+        and whether the planner fell back to a collection scan
+    """
+
+    report = []
+    for name, model, filters, sort in canonical_queries():
+        collection = engine.get_collection(model)
+        cursor = collection.find(filters)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = winning_plan_stages(
+            explain.get("queryPlanner", {}).get("winningPlan", {})
+        )
+        report.append(
+            {
+                "query": name,
+                "collection": collection.name,
+                "stages": stages,
+                "collection_scan": "COLLSCAN" in stages,
+            }
+        )
+    return report
+
+
+async def bootstrap_indexes() -> List[Dict[str, Any]]:
+    """Ensures the indexes exist and logs the startup index report.
+
+    Returns:
+        List[Dict[str, Any]]: the index report
+    """
+
+    for failure in await ensure_indexes():
+        if failure.get("duplicates"):
+            logger.warning(
+                f"Unique index {failure['index']} on {failure['collection']} is "
+                f"missing, {failure['duplicates']} keys are duplicated, "
+                f"e.g. {failure['sample']}"
+            )
+    report = await build_index_report()
+    for entry in report:
+        if entry["collection_scan"]:
+            logger.warning(
+                f"Query {entry['query']} on {entry['collection']} is a collection scan: {entry['stages']}"
+            )
+        else:
+            logger.info(
+                f"Query {entry['query']} on {entry['collection']} uses {entry['stages']}"
+            )
+    return report
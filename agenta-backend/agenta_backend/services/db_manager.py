@@ -1,6 +1,8 @@
+import copy
 import logging
 import os
-from typing import Any, Dict, List
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
 from agenta_backend.models.api.api_models import (
@@ -11,6 +13,7 @@ from agenta_backend.models.api.api_models import (
     ImageExtended,
     Template,
 )
+from agenta_backend.config import settings
 from agenta_backend.models.converters import (
     app_variant_db_to_pydantic,
     image_db_to_pydantic,
@@ -35,6 +38,25 @@ engine = DBEngine(mode="default").engine()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Users and organizations resolved by this process, keyed by uid / organization id
+user_cache = helpers.TTLCache(
+    maxsize=settings.user_cache_max_size, ttl=settings.user_cache_ttl_seconds
+)
+organization_cache = helpers.TTLCache(
+    maxsize=settings.user_cache_max_size, ttl=settings.user_cache_ttl_seconds
+)
+
+# Parameters of the app variants, keyed by user id, app name and variant name
+variant_parameters_cache = helpers.TTLCache(
+    maxsize=settings.variant_parameters_cache_size,
+    ttl=settings.variant_parameters_cache_ttl_seconds,
+)
+
+# Users resolved during the current request, see `begin_request_scope`
+_request_users: ContextVar[Optional[Dict[str, UserDB]]] = ContextVar(
+    "request_users", default=None
+)
+
 
 async def get_templates() -> List[Template]:
     templates = await engine.find(TemplateDB)
@@ -78,7 +100,6 @@ async def add_variant_based_on_image(
         ValueError: if variant exists or missing inputs
     """
 
-    await clean_soft_deleted_variants()
     if (
             app_variant is None
             or image is None
@@ -91,6 +112,11 @@ async def add_variant_based_on_image(
     if app_variant.parameters is not None:
         raise ValueError("Parameters are not supported when adding based on image")
 
+    # Get user instance
+    user_instance = await get_user_object(kwargs["uid"])
+
+    # Orphaned soft-deleted variants of the app must not block the new name
+    await clean_soft_deleted_variants(user_instance.id, app_variant.app_name)
     soft_deleted_variants = await list_app_variants(show_soft_deleted=True, **kwargs)
     already_exists = any(
         [
@@ -103,8 +129,6 @@ async def add_variant_based_on_image(
     if already_exists:
         raise ValueError("App variant with the same name already exists")
 
-    # Get user instance
-    user_instance = await get_user_object(kwargs["uid"])
     user_db_image = await get_user_image_instance(user_instance.uid, image.docker_id)
 
     # Add image
@@ -150,7 +174,6 @@ async def add_variant_based_on_previous(
         ValueError: _description_
     """
 
-    await clean_soft_deleted_variants()
     if (
             previous_app_variant is None
             or previous_app_variant.app_name in [None, ""]
@@ -178,6 +201,10 @@ async def add_variant_based_on_previous(
             "Template app variant is not a template, it is a forked variant itself"
         )
 
+    user_instance = await get_user_object(kwargs["uid"])
+
+    # Orphaned soft-deleted variants of the app must not block the new name
+    await clean_soft_deleted_variants(user_instance.id, previous_app_variant.app_name)
     soft_deleted_app_variants = await list_app_variants(
         show_soft_deleted=True, **kwargs
     )
@@ -192,7 +219,6 @@ async def add_variant_based_on_previous(
     if already_exists:
         raise ValueError("App variant with the same name already exists")
 
-    user_instance = await get_user_object(kwargs["uid"])
     db_app_variant = AppVariantDB(
         app_name=template_variant.app_name,
         variant_name=new_variant_name,
@@ -351,8 +377,6 @@ async def list_apps(**kwargs: dict) -> List[App]:
     """
     Lists all the unique app names from the database
     """
-    await clean_soft_deleted_variants()
-
     # Get user object
     user = await get_user_object(kwargs["uid"])
     if user is None:
@@ -371,8 +395,6 @@ async def count_apps(**kwargs: dict) -> int:
     """
     Counts all the unique app names from the database
     """
-    await clean_soft_deleted_variants()
-
     # Get user object
     user = await get_user_object(kwargs["uid"])
     if user is None:
@@ -575,26 +597,62 @@ async def print_all():
         helpers.print_image(image)
 
 
-async def clean_soft_deleted_variants():
-    """Remove soft-deleted app variants if their image is not used by any existing variant."""
+async def clean_soft_deleted_variants(
+        user_id: Optional[ObjectId] = None, app_name: Optional[str] = None
+) -> int:
+    """Remove soft-deleted app variants if their image is not used by any existing variant.
 
-    # Get all soft-deleted app variants
-    soft_deleted_variants: List[AppVariantDB] = await engine.find(
-        AppVariantDB, AppVariantDB.is_deleted == True
-    )
+    The orphaned variants are found with a single aggregation and removed with
+    one bulk delete.
 
-    for variant in soft_deleted_variants:
-        # Build the query expression for the two conditions
-        query_expression = query.eq(
-            AppVariantDB.image_id, variant.image_id.id
-        ) & query.eq(AppVariantDB.is_deleted, False)
+    Arguments:
+        user_id -- if specified, only removes the variants of this user
+        app_name -- if specified, only removes the variants of this app
 
-        # Get non-deleted variants that use the same image
-        image_used = await engine.find_one(AppVariantDB, query_expression)
+    Returns:
+        int: the number of deleted variants
+    """
 
-        # If the image is not used by any non-deleted variant, delete the variant
-        if image_used is None:
-            await engine.delete(variant)
+    collection = engine.get_collection(AppVariantDB)
+    soft_deleted = {"is_deleted": True}
+    if user_id is not None:
+        soft_deleted["user"] = user_id
+    if app_name is not None:
+        soft_deleted["app_name"] = app_name
+    pipeline = [
+        {"$match": soft_deleted},
+        {
+            "$lookup": {
+                "from": collection.name,
+                "let": {"image": "$image"},
+                "pipeline": [
+                    {
+                        "$match": {
+                            "$expr": {
+                                "$and": [
+                                    {"$eq": ["$image", "$$image"]},
+                                    {"$eq": ["$is_deleted", False]},
+                                ]
+                            }
+                        }
+                    },
+                    {"$limit": 1},
+                    {"$project": {"_id": 1}},
+                ],
+                "as": "live_variants",
+            }
+        },
+        {"$match": {"live_variants": {"$size": 0}}},
+        {"$project": {"_id": 1}},
+    ]
+    orphan_ids = [
+        doc["_id"] async for doc in collection.aggregate(pipeline)
+    ]
+    if not orphan_ids:
+        return 0
+
+    result = await collection.delete_many({"_id": {"$in": orphan_ids}})
+    return result.deleted_count
 
 
 async def update_variant_parameters(
@@ -640,6 +698,9 @@ async def update_variant_parameters(
     ):
         db_app_variant.parameters = parameters
         await engine.save(db_app_variant)
+        variant_parameters_cache.pop(
+            (str(user.id), app_variant.app_name, app_variant.variant_name)
+        )
 
     elif db_app_variant.parameters is not None and set(
             db_app_variant.parameters.keys()
@@ -650,6 +711,38 @@ async def update_variant_parameters(
         raise ValueError("Parameters keys don't match")
 
 
+async def get_variant_parameters(
+        user_id: ObjectId, app_name: str, variant_name: str
+) -> Optional[Dict[str, Any]]:
+    """Get the parameters of an app variant from the process cache or the database.
+
+    Arguments:
+        user_id -- the owner of the variant
+        app_name -- the name of the app
+        variant_name -- the name of the variant
+
+    Returns:
+        a copy of the parameters, None if the variant does not exist
+    """
+
+    key = (str(user_id), app_name, variant_name)
+    parameters = variant_parameters_cache.get(key)
+    if parameters is None:
+        query_expression = (
+                query.eq(AppVariantDB.app_name, app_name)
+                & query.eq(AppVariantDB.variant_name, variant_name)
+                & query.eq(AppVariantDB.user_id, user_id)
+        )
+        app_variant = await engine.find_one(AppVariantDB, query_expression)
+        if app_variant is None:
+            return None
+        parameters = app_variant.parameters
+        variant_parameters_cache.set(key, parameters)
+    # The evaluators keep their state between scenarios, one changing its
+    # parameters must not change the cached ones
+    return copy.deepcopy(parameters)
+
+
 async def remove_old_template_from_db(template_ids: list) -> None:
     """Deletes old templates that are no longer in docker hub.
 
@@ -667,8 +760,61 @@ async def remove_old_template_from_db(template_ids: list) -> None:
         await engine.delete(template)
 
 
+def begin_request_scope() -> Token:
+    """Starts a request-scoped memo of the users resolved by `get_user_object`.
+
+    Returns:
+        Token: to be passed to `end_request_scope` once the request is done
+    """
+
+    return _request_users.set({})
+
+
+def end_request_scope(token: Token) -> None:
+    """Drops the request-scoped user memo started by `begin_request_scope`."""
+
+    _request_users.reset(token)
+
+
+def invalidate_user_cache(user_uid: str) -> None:
+    """Removes a user from the process-level cache.
+
+    Arguments:
+        user_uid (str): The user unique identifier
+    """
+
+    user_cache.pop(user_uid)
+    memo = _request_users.get()
+    if memo is not None:
+        memo.pop(user_uid, None)
+
+
+def invalidate_organization_cache(org_id: str) -> None:
+    """Removes an organization, and the users embedding it, from the process-level cache.
+
+    Arguments:
+        org_id (str): The organization id
+    """
+
+    organization_cache.pop(str(org_id))
+    user_cache.pop_where(
+        lambda user: str(user.organization_id.id) == str(org_id)
+    )
+    memo = _request_users.get()
+    if memo is not None:
+        for uid in [
+            uid
+            for uid, user in memo.items()
+            if str(user.organization_id.id) == str(org_id)
+        ]:
+            del memo[uid]
+
+
 async def get_user_object(user_uid: str) -> UserDB:
-    """Get the user object from the database.
+    """Get the user object from the request memo, the process cache or the database.
+
+    The cached instance is never returned, only copies of it, so a caller
+    modifying its user does not modify the one of the other requests.
 
     Arguments:
         user_id (str): The user unique identifier
@@ -677,13 +823,48 @@ async def get_user_object(user_uid: str) -> UserDB:
         UserDB: instance of user
     """
 
-    user = await engine.find_one(UserDB, UserDB.uid == user_uid)
-    if user is None:
-        org = OrganizationDB()
-        return UserDB(uid="0", organization_id=org)
+    memo = _request_users.get()
+    if memo is not None and user_uid in memo:
+        return memo[user_uid]
+
+    cached = user_cache.get(user_uid)
+    if cached is None:
+        cached = await engine.find_one(UserDB, UserDB.uid == user_uid)
+        if cached is None:
+            org = OrganizationDB()
+            return UserDB(uid="0", organization_id=org)
+        user_cache.set(user_uid, cached)
+    # The organization is copied too, odmantic cannot deep copy a reference
+    user = cached.copy(update={"organization_id": cached.organization_id.copy()})
+
+    if memo is not None:
+        memo[user_uid] = user
     return user
 
 
+async def get_organization_object(org_id: str) -> OrganizationDB:
+    """Get the organization object from the process cache or the database.
+
+    Like users, the cached organizations are returned as copies.
+
+    Arguments:
+        org_id (str): The organization id
+
+    Returns:
+        OrganizationDB: instance of organization
+    """
+
+    organization = organization_cache.get(str(org_id))
+    if organization is None:
+        organization = await engine.find_one(
+            OrganizationDB, OrganizationDB.id == ObjectId(org_id)
+        )
+        if organization is None:
+            return None
+        organization_cache.set(str(org_id), organization)
+    return organization.copy()
+
+
 async def get_user_organization(user_id: str) -> OrganizationDB:
     """Get the user organization object from the database.
 
@@ -695,10 +876,7 @@ async def get_user_organization(user_id: str) -> OrganizationDB:
     """
 
     user = await get_user_object(user_id)
-    organization = await engine.find_one(
-        OrganizationDB, OrganizationDB.id == user.organization_id
-    )
-    return organization
+    return await get_organization_object(user.organization_id.id)
 
 
 async def get_user_image_instance(user_id: str, docker_id: str) -> ImageDB:
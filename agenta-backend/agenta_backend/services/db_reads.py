@@ -0,0 +1,219 @@
+"""Read-only fast path for the hot list endpoints.
+
+Documents are read with motor, projected server-side and serialized
+straight to JSON, without building odmantic models and response models.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+
+from agenta_backend.models.db_models import AppVariantDB, EvaluationDB, TestSetDB
+from agenta_backend.services.db_manager import engine
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder is used rather than failing to start
+    orjson = None
+
+EVALUATION_PROJECTION = {
+    "status": 1,
+    "evaluation_type": 1,
+    "custom_code_evaluation_id": 1,
+    "evaluation_type_settings": 1,
+    "llm_app_prompt_template": 1,
+    "variants": 1,
+    "app_name": 1,
+    "testset": 1,
+    "materialization": 1,
+    "run.total": 1,
+    "run.completed": 1,
+    "run.failed": 1,
+    "run.rows_per_second": 1,
+    "run.error": 1,
+    "run.started_at": 1,
+    "run.finished_at": 1,
+    "critique.total": 1,
+    "critique.completed": 1,
+    "critique.failed": 1,
+    "critique.rows_per_second": 1,
+    "critique.error": 1,
+    "critique.started_at": 1,
+    "critique.finished_at": 1,
+    "created_at": 1,
+    "updated_at": 1,
+}
+
+TESTSET_PROJECTION = {"name": 1, "app_name": 1, "created_at": 1}
+
+APP_VARIANT_PROJECTION = {
+    "_id": 0,
+    "app_name": 1,
+    "variant_name": 1,
+    "parameters": 1,
+    "previous_variant_name": 1,
+}
+
+
+def bson_default(value: Any) -> Any:
+    """Encodes the BSON types that JSON has no representation for.
+
+    Arguments:
+        value -- the value the JSON encoder could not serialize
+
+    Raises:
+        TypeError: the value has no JSON representation
+
+    Returns:
+        Any: the JSON representation of the value
+    """
+
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Serializes raw mongo documents to JSON.
+
+    Arguments:
+        content -- the documents to serialize
+
+    Returns:
+        bytes: the JSON document
+    """
+
+    if orjson is not None:
+        return orjson.dumps(content, default=bson_default)
+    return json.dumps(
+        content, default=bson_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class RawJSONResponse(JSONResponse):
+    """JSON response for raw mongo documents, skipping the response model
+    validation and the jsonable_encoder pass of FastAPI.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def evaluation_document_to_json(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Shapes a projected evaluation document like the Evaluation response model."""
+
+    return {
+        "id": str(document["_id"]),
+        "status": document.get("status"),
+        "evaluation_type": document.get("evaluation_type"),
+        "evaluation_type_settings": document.get("evaluation_type_settings"),
+        "custom_code_evaluation_id": document.get("custom_code_evaluation_id"),
+        "llm_app_prompt_template": document.get("llm_app_prompt_template"),
+        "variants": document.get("variants"),
+        "app_name": document.get("app_name"),
+        "testset": document.get("testset"),
+        "materialization": document.get(
+            "materialization",
+            {"total": 0, "materialized": 0, "rows_per_second": None},
+        ),
+        "run": document.get("run"),
+        "critique": document.get("critique"),
+        "created_at": document.get("created_at"),
+        "updated_at": document.get("updated_at"),
+    }
+
+
+def testset_document_to_json(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Shapes a projected test set document like the TestSetOutputResponse model."""
+
+    return {
+        "_id": str(document["_id"]),
+        "name": document.get("name"),
+        "app_name": document.get("app_name"),
+        "created_at": document.get("created_at"),
+    }
+
+
+def app_variant_document_to_json(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Shapes a projected app variant document like the AppVariant model."""
+
+    return {
+        "app_name": document.get("app_name"),
+        "variant_name": document.get("variant_name"),
+        "parameters": document.get("parameters"),
+        "previous_variant_name": document.get("previous_variant_name"),
+    }
+
+
+async def list_evaluations(
+    user_id: ObjectId, app_name: Optional[str]
+) -> List[Dict[str, Any]]:
+    """Lists the evaluations of an app.
+
+    Arguments:
+        user_id -- the owner of the evaluations
+        app_name -- the app of the evaluations
+
+    Returns:
+        List[Dict[str, Any]]: the evaluations, shaped like the Evaluation model
+    """
+
+    collection = engine.get_collection(EvaluationDB)
+    documents = collection.find(
+        {"user": user_id, "app_name": app_name}, projection=EVALUATION_PROJECTION
+    )
+    return [evaluation_document_to_json(document) async for document in documents]
+
+
+async def list_testsets(
+    user_id: ObjectId, app_name: Optional[str]
+) -> List[Dict[str, Any]]:
+    """Lists the test sets of an app, without their rows.
+
+    Arguments:
+        user_id -- the owner of the test sets
+        app_name -- the app of the test sets
+
+    Returns:
+        List[Dict[str, Any]]: the test sets, shaped like TestSetOutputResponse
+    """
+
+    collection = engine.get_collection(TestSetDB)
+    documents = collection.find(
+        {"user": user_id, "app_name": app_name}, projection=TESTSET_PROJECTION
+    )
+    return [testset_document_to_json(document) async for document in documents]
+
+
+async def list_app_variants(
+    user_id: ObjectId, app_name: Optional[str] = None, show_soft_deleted=False
+) -> List[Dict[str, Any]]:
+    """Lists the app variants, with the same filters as db_manager.list_app_variants.
+
+    Arguments:
+        user_id -- the owner of the app variants
+        app_name -- if specified, only returns the variants of this app
+        show_soft_deleted -- if true, returns soft deleted variants as well
+
+    Returns:
+        List[Dict[str, Any]]: the app variants, shaped like the AppVariant model
+    """
+
+    # Build query expression
+    filters: Dict[str, Any] = {"user": user_id}
+    if app_name is not None:
+        filters["app_name"] = app_name
+    if not show_soft_deleted:
+        filters["is_deleted"] = False
+    elif app_name is None:
+        filters["is_deleted"] = True
+
+    collection = engine.get_collection(AppVariantDB)
+    documents = collection.find(filters, projection=APP_VARIANT_PROJECTION).sort(
+        [("app_name", 1), ("variant_name", 1)]
+    )
+    return [app_variant_document_to_json(document) async for document in documents]
@@ -0,0 +1,507 @@
+"""Cold storage of the scenarios of finished evaluations
+
+The scenarios of an archived evaluation are moved out of evaluation_scenarios
+into compressed chunks: the names of the inputs and variants are stored once
+in evaluation_archives, and each chunk holds the scenario ids and one column
+of values per field. The readers of the scenarios decode the chunks of the
+archived evaluations, archiving only shrinks the collections kept hot.
+
+The archived flag of the evaluation is the commit point of both directions:
+the chunks are written before it is set, and it is cleared once every
+scenario is inserted back, the evaluation being marked as restoring in the
+meantime. The archive is only deleted after that, so an interrupted archive
+or restore is resumed by running it again and never loses the scenarios.
+"""
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from agenta_backend.config import settings
+from agenta_backend.models.api.evaluation_model import EvaluationStatusEnum
+from agenta_backend.models.db_models import (
+    EvaluationArchiveChunkDB,
+    EvaluationArchiveDB,
+    EvaluationDB,
+    EvaluationScenarioDB,
+)
+from agenta_backend.services.cleanup_service import delete_in_batches
+from agenta_backend.services.db_manager import engine
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Scenario fields stored as one column of values each
+VALUE_FIELDS = ("vote", "score", "evaluation", "correct_answer")
+DATE_FIELDS = ("created_at", "updated_at")
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Duplicate key error code of mongo
+_DUPLICATE_KEY = 11000
+
+# Passes over the archive before a restore gives up, the archive kept
+RESTORE_ATTEMPTS = 3
+
+
+class EvaluationArchiveError(Exception):
+    """Custom exception for evaluations that cannot be archived."""
+
+    pass
+
+
+def _encode_date(value: Optional[datetime]) -> Optional[int]:
+    if value is None:
+        return None
+    return (value.replace(tzinfo=None) - _EPOCH) // timedelta(milliseconds=1)
+
+
+def _decode_date(value: Optional[int]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return _EPOCH + timedelta(milliseconds=value)
+
+
+def _column_index(names: List[str], name: str) -> int:
+    """Returns the column of a name, adding it to the schema when new."""
+
+    try:
+        return names.index(name)
+    except ValueError:
+        names.append(name)
+        return len(names) - 1
+
+
+def encode_scenarios(
+    documents: List[Dict[str, Any]], input_names: List[str], variant_names: List[str]
+) -> Tuple[bytes, bytes]:
+    """Encodes raw scenario documents to columns.
+
+    The names of inputs and variants not yet in the schema are appended to
+    it, so the chunks encoded earlier keep their columns.
+
+    Arguments:
+        documents -- the scenarios, in _id order
+        input_names -- the input columns of the archive, extended in place
+        variant_names -- the output columns of the archive, extended in place
+
+    Returns:
+        Tuple[bytes, bytes]: the concatenated ids and the compressed columns
+    """
+
+    count = len(documents)
+    inputs: List[List[Optional[str]]] = [[None] * count for _ in input_names]
+    outputs: List[List[Optional[str]]] = [[None] * count for _ in variant_names]
+    columns: Dict[str, Any] = {
+        field: [document.get(field) for document in documents] for field in VALUE_FIELDS
+    }
+    for field in DATE_FIELDS:
+        columns[field] = [_encode_date(document.get(field)) for document in documents]
+
+    for position, document in enumerate(documents):
+        for item in document.get("inputs") or []:
+            column = _column_index(input_names, item["input_name"])
+            if column == len(inputs):
+                inputs.append([None] * count)
+            inputs[column][position] = item["input_value"]
+        for item in document.get("outputs") or []:
+            column = _column_index(variant_names, item["variant_name"])
+            if column == len(outputs):
+                outputs.append([None] * count)
+            outputs[column][position] = item["variant_output"]
+    columns["inputs"] = inputs
+    columns["outputs"] = outputs
+
+    ids = b"".join(document["_id"].binary for document in documents)
+    data = json.dumps(columns, ensure_ascii=False, separators=(",", ":"))
+    return ids, zlib.compress(data.encode("utf-8"))
+
+
+def decode_scenarios(
+    chunk: Dict[str, Any], archive: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Decodes a chunk back to raw scenario documents.
+
+    Arguments:
+        chunk -- the raw chunk document
+        archive -- the raw archive document, holding the schema
+
+    Returns:
+        List[Dict[str, Any]]: the scenarios, shaped like the documents of
+        evaluation_scenarios
+    """
+
+    columns = json.loads(zlib.decompress(chunk["data"]))
+    ids = chunk["ids"]
+    input_columns = list(zip(archive["input_names"], columns["inputs"]))
+    output_columns = list(zip(archive["variant_names"], columns["outputs"]))
+
+    documents = []
+    for position in range(chunk["count"]):
+        document = {
+            "_id": ObjectId(ids[position * 12 : position * 12 + 12]),
+            "inputs": [
+                {"input_name": name, "input_value": values[position]}
+                for name, values in input_columns
+                if values[position] is not None
+            ],
+            "outputs": [
+                {"variant_name": name, "variant_output": values[position]}
+                for name, values in output_columns
+                if values[position] is not None
+            ],
+            "evaluation_id": chunk["evaluation_id"],
+            "user": archive["user"],
+        }
+        for field in VALUE_FIELDS:
+            document[field] = columns[field][position]
+        for field in DATE_FIELDS:
+            document[field] = _decode_date(columns[field][position])
+        documents.append(document)
+    return documents
+
+
+async def is_archived(evaluation_id: str) -> bool:
+    """Tells whether the scenarios of an evaluation are archived."""
+
+    if not ObjectId.is_valid(evaluation_id):
+        return False
+    evaluation = await engine.get_collection(EvaluationDB).find_one(
+        {"_id": ObjectId(evaluation_id)}, projection={"archived": 1}
+    )
+    return evaluation is not None and bool(evaluation.get("archived"))
+
+
+async def check_scenarios_writable(evaluation_id: str) -> None:
+    """Raises EvaluationArchiveError when the scenarios of an evaluation are
+    archived or being restored, an update of them would be lost.
+
+    The writers check before and after updating a scenario: an update that
+    lands before the archived flag is set is seen by archive_evaluation,
+    which then gives up.
+    """
+
+    if not ObjectId.is_valid(evaluation_id):
+        return
+    evaluation = await engine.get_collection(EvaluationDB).find_one(
+        {"_id": ObjectId(evaluation_id)},
+        projection={"archived": 1, "restoring": 1},
+    )
+    if evaluation is None:
+        return
+    if evaluation.get("restoring"):
+        raise EvaluationArchiveError(f"Evaluation {evaluation_id} is being restored")
+    if evaluation.get("archived"):
+        raise EvaluationArchiveError(
+            f"Evaluation {evaluation_id} is archived, restore it to update "
+            "its scenarios"
+        )
+
+
+async def fetch_archive(evaluation_id: str) -> Optional[Dict[str, Any]]:
+    """Reads the schema of an archived evaluation, None when not archived."""
+
+    return await engine.get_collection(EvaluationArchiveDB).find_one(
+        {"evaluation_id": evaluation_id}
+    )
+
+
+async def iter_archived_scenarios(
+    evaluation_id: str, after: Optional[ObjectId] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """Streams the archived scenarios of an evaluation in _id order, one
+    decoded chunk in memory at a time.
+
+    Arguments:
+        evaluation_id -- the archived evaluation
+        after -- only the scenarios with a greater id, all of them when None
+
+    Yields:
+        Dict[str, Any]: the scenarios, shaped like raw scenario documents
+    """
+
+    archive = await fetch_archive(evaluation_id)
+    if archive is None:
+        return
+
+    filters: Dict[str, Any] = {"evaluation_id": evaluation_id}
+    if after is not None:
+        filters["last_id"] = {"$gt": after}
+    chunks = engine.get_collection(EvaluationArchiveChunkDB).find(
+        filters, sort=[("first_id", 1)]
+    )
+    async for chunk in chunks:
+        for document in decode_scenarios(chunk, archive):
+            if after is None or document["_id"] > after:
+                yield document
+
+
+async def _delete_archive(evaluation_id: str) -> None:
+    await engine.get_collection(EvaluationArchiveChunkDB).delete_many(
+        {"evaluation_id": evaluation_id}
+    )
+    await engine.get_collection(EvaluationArchiveDB).delete_one(
+        {"evaluation_id": evaluation_id}
+    )
+
+
+async def archive_evaluation(evaluation_id: str) -> int:
+    """Moves the scenarios of a finished evaluation to compressed chunks.
+
+    The scenarios are read in _id order and encoded by chunks of
+    `settings.evaluation_archive_chunk_size` scenarios, or about
+    `settings.evaluation_archive_chunk_bytes` bytes.
+
+    Arguments:
+        evaluation_id -- the evaluation to archive
+
+    Raises:
+        EvaluationArchiveError: the evaluation does not exist or is not
+        finished, or its scenarios changed while being archived
+
+    Returns:
+        int: the number of archived scenarios
+    """
+
+    evaluations = engine.get_collection(EvaluationDB)
+    scenarios = engine.get_collection(EvaluationScenarioDB)
+    evaluation = await evaluations.find_one(
+        {"_id": ObjectId(evaluation_id)},
+        projection={"status": 1, "archived": 1, "restoring": 1, "user": 1},
+    )
+    if evaluation is None:
+        raise EvaluationArchiveError(f"Evaluation {evaluation_id} not found")
+    if evaluation.get("restoring"):
+        raise EvaluationArchiveError(f"Evaluation {evaluation_id} is being restored")
+    if evaluation.get("archived"):
+        # Finish an interrupted archive
+        await delete_in_batches(scenarios, {"evaluation_id": evaluation_id})
+        archive = await fetch_archive(evaluation_id)
+        return archive["scenario_count"] if archive is not None else 0
+    if evaluation["status"] != EvaluationStatusEnum.EVALUATION_FINISHED.value:
+        raise EvaluationArchiveError(
+            f"Evaluation {evaluation_id} is not finished, it cannot be archived"
+        )
+
+    if await fetch_archive(evaluation_id) is not None:
+        # Left by an interrupted restore, the scenarios are all back already
+        await restore_evaluation(evaluation_id)
+        raise EvaluationArchiveError(
+            f"Evaluation {evaluation_id} was just restored, it is archived later"
+        )
+
+    # Chunks of an interrupted attempt, written before the archive schema
+    await engine.get_collection(EvaluationArchiveChunkDB).delete_many(
+        {"evaluation_id": evaluation_id}
+    )
+
+    # The scenarios updated from now on may be missing from the chunks
+    started = datetime.utcnow()
+    chunks = engine.get_collection(EvaluationArchiveChunkDB)
+    input_names: List[str] = []
+    variant_names: List[str] = []
+    archived = 0
+    archived_bytes = 0
+    batch: List[Dict[str, Any]] = []
+    batch_bytes = 0
+
+    async def flush():
+        nonlocal archived, archived_bytes, batch, batch_bytes
+        ids, data = encode_scenarios(batch, input_names, variant_names)
+        await chunks.insert_one(
+            EvaluationArchiveChunkDB(
+                evaluation_id=evaluation_id,
+                first_id=batch[0]["_id"],
+                last_id=batch[-1]["_id"],
+                count=len(batch),
+                ids=ids,
+                data=data,
+            ).doc()
+        )
+        archived += len(batch)
+        archived_bytes += len(ids) + len(data)
+        batch = []
+        batch_bytes = 0
+
+    scenarios_filter = {"evaluation_id": evaluation_id, "user": evaluation["user"]}
+    documents = scenarios.find(
+        scenarios_filter,
+        sort=[("_id", 1)],
+        batch_size=settings.evaluation_scenarios_batch_size,
+    )
+    async for document in documents:
+        batch.append(document)
+        batch_bytes += len(str(document))
+        if (
+            len(batch) >= settings.evaluation_archive_chunk_size
+            or batch_bytes >= settings.evaluation_archive_chunk_bytes
+        ):
+            await flush()
+    if batch:
+        await flush()
+
+    await engine.get_collection(EvaluationArchiveDB).insert_one(
+        EvaluationArchiveDB(
+            evaluation_id=evaluation_id,
+            user=evaluation["user"],
+            input_names=input_names,
+            variant_names=variant_names,
+            scenario_count=archived,
+            archived_bytes=archived_bytes,
+            created_at=datetime.utcnow(),
+        ).doc()
+    )
+    result = await evaluations.update_one(
+        {
+            "_id": ObjectId(evaluation_id),
+            "status": EvaluationStatusEnum.EVALUATION_FINISHED.value,
+            "restoring": {"$ne": True},
+        },
+        {"$set": {"archived": True}},
+    )
+    if result.matched_count == 0:
+        # Deleted or reopened in the meantime
+        await _delete_archive(evaluation_id)
+        raise EvaluationArchiveError(
+            f"Evaluation {evaluation_id} changed while being archived"
+        )
+
+    # The flag stops the updates, those that landed during the copy are not
+    # all in the chunks
+    updated = await scenarios.count_documents(
+        {**scenarios_filter, "updated_at": {"$gte": started}}, limit=1
+    )
+    if updated or await scenarios.count_documents(scenarios_filter) != archived:
+        # Cleared before the archive is deleted, never archived without one
+        await evaluations.update_one(
+            {"_id": ObjectId(evaluation_id)}, {"$set": {"archived": False}}
+        )
+        await _delete_archive(evaluation_id)
+        raise EvaluationArchiveError(
+            f"The scenarios of evaluation {evaluation_id} changed while being "
+            "archived, it is archived later"
+        )
+
+    await delete_in_batches(scenarios, {"evaluation_id": evaluation_id})
+    logger.info(
+        f"Archived {archived} scenario(s) of evaluation {evaluation_id} "
+        f"in {archived_bytes} bytes"
+    )
+    return archived
+
+
+async def restore_evaluation(evaluation_id: str) -> int:
+    """Moves the archived scenarios of an evaluation back to evaluation_scenarios.
+
+    The evaluation is marked as restoring and stays archived, read from its
+    archive, until every scenario is inserted back; the archive is deleted
+    last. An interrupted restore is resumed by running it again.
+
+    Arguments:
+        evaluation_id -- the archived evaluation
+
+    Raises:
+        EvaluationArchiveError: some scenarios kept disappearing while being
+        restored, the evaluation stays archived
+
+    Returns:
+        int: the number of restored scenarios
+    """
+
+    evaluations = engine.get_collection(EvaluationDB)
+    archive = await fetch_archive(evaluation_id)
+    if archive is None:
+        await evaluations.update_one(
+            {"_id": ObjectId(evaluation_id), "archived": {"$ne": True}},
+            {"$set": {"restoring": False}},
+        )
+        return 0
+    await evaluations.update_one(
+        {"_id": ObjectId(evaluation_id)},
+        {"$set": {"restoring": True, "updated_at": datetime.utcnow()}},
+    )
+
+    scenarios = engine.get_collection(EvaluationScenarioDB)
+    restored = 0
+    batch: List[Dict[str, Any]] = []
+
+    async def flush():
+        nonlocal restored, batch
+        try:
+            await scenarios.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Restored by an interrupted attempt
+            errors = e.details["writeErrors"]
+            if any(error["code"] != _DUPLICATE_KEY for error in errors):
+                raise
+        restored += len(batch)
+        batch = []
+
+    for _ in range(RESTORE_ATTEMPTS):
+        restored = 0
+        async for document in iter_archived_scenarios(evaluation_id):
+            batch.append(document)
+            if len(batch) >= settings.evaluation_scenarios_batch_size:
+                await flush()
+        if batch:
+            await flush()
+        # A cleanup that started before the restore may have deleted some
+        count = await scenarios.count_documents({"evaluation_id": evaluation_id})
+        if count >= archive["scenario_count"]:
+            break
+    else:
+        raise EvaluationArchiveError(
+            f"Evaluation {evaluation_id} could not be restored, try again"
+        )
+
+    # Every scenario is back, the evaluation is read from them from now on
+    await evaluations.update_one(
+        {"_id": ObjectId(evaluation_id)},
+        {
+            "$set": {
+                "archived": False,
+                "restoring": False,
+                "updated_at": datetime.utcnow(),
+            }
+        },
+    )
+    await _delete_archive(evaluation_id)
+    logger.info(f"Restored {restored} scenario(s) of evaluation {evaluation_id}")
+    return restored
+
+
+async def archive_finished_evaluations() -> int:
+    """Archives the evaluations finished for more than
+    `settings.evaluation_archive_after_seconds`.
+
+    Returns:
+        int: the number of archived evaluations
+    """
+
+    cutoff = datetime.utcnow() - timedelta(
+        seconds=settings.evaluation_archive_after_seconds
+    )
+    evaluations = engine.get_collection(EvaluationDB).find(
+        {
+            "status": EvaluationStatusEnum.EVALUATION_FINISHED.value,
+            "archived": {"$ne": True},
+            "restoring": {"$ne": True},
+            "updated_at": {"$lt": cutoff},
+        },
+        projection={"_id": 1},
+    )
+    evaluation_ids = [str(evaluation["_id"]) async for evaluation in evaluations]
+
+    archived = 0
+    for evaluation_id in evaluation_ids:
+        try:
+            await archive_evaluation(evaluation_id)
+            archived += 1
+        except EvaluationArchiveError as e:
+            logger.warning(str(e))
+    return archived
@@ -0,0 +1,146 @@
+"""Streaming CSV and JSON lines export of the scenarios of an evaluation
+
+The scenarios are read from a cursor and written out as they arrive, their
+inputs and outputs flattened into columns, so an export holds one buffer of
+output in memory whatever the number of scenarios.
+"""
+import csv
+import io
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import EvaluationDB, EvaluationScenarioDB
+from agenta_backend.services import db_reads
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.evaluation_archive import iter_archived_scenarios
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+MEDIA_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+# Scenario fields exported as one column each, after the inputs and outputs.
+# evaluation holds the verdict of the AI critique
+SCENARIO_FIELDS = (
+    "vote",
+    "score",
+    "evaluation",
+    "correct_answer",
+    "created_at",
+    "updated_at",
+)
+
+SCENARIO_PROJECTION = {
+    "inputs": 1,
+    "outputs": 1,
+    **{field: 1 for field in SCENARIO_FIELDS},
+}
+
+
+def scenarios_filter(evaluation: EvaluationDB) -> Dict[str, Any]:
+    """Filters the scenarios of an evaluation with the (evaluation_id, user,
+    _id) index, which also serves their _id order."""
+
+    return {"evaluation_id": str(evaluation.id), "user": evaluation.user.id}
+
+
+async def export_columns(evaluation: EvaluationDB) -> List[str]:
+    """Returns the columns of an export: the scenario id, an inputs.<name>
+    column per input of the first scenario, an outputs.<variant> column per
+    variant of the evaluation, then the scenario fields.
+    """
+
+    if evaluation.archived:
+        first = None
+        async for first in iter_archived_scenarios(str(evaluation.id)):
+            break
+    else:
+        first = await engine.get_collection(EvaluationScenarioDB).find_one(
+            scenarios_filter(evaluation),
+            projection={"inputs.input_name": 1},
+            sort=[("_id", 1)],
+        )
+    inputs = (first or {}).get("inputs") or []
+    input_names = [item["input_name"] for item in inputs]
+    return (
+        ["id"]
+        + [f"inputs.{name}" for name in input_names]
+        + [f"outputs.{variant}" for variant in evaluation.variants]
+        + list(SCENARIO_FIELDS)
+    )
+
+
+def flatten_scenario(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Flattens a raw scenario document to one value per column."""
+
+    record: Dict[str, Any] = {"id": str(document["_id"])}
+    for item in document.get("inputs") or []:
+        record[f"inputs.{item['input_name']}"] = item.get("input_value")
+    for item in document.get("outputs") or []:
+        record[f"outputs.{item['variant_name']}"] = item.get("variant_output")
+    for field in SCENARIO_FIELDS:
+        value = document.get(field)
+        record[field] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+async def iter_evaluation_export(
+    evaluation: EvaluationDB, export_format: str, compress: bool = False
+) -> AsyncIterator[bytes]:
+    """Streams the scenarios of an evaluation as CSV or JSON lines.
+
+    The output is flushed every `settings.evaluation_export_flush_bytes`,
+    through a gzip compressor if requested.
+
+    Arguments:
+        evaluation -- the evaluation to export
+        export_format -- "csv" or "jsonl"
+        compress -- gzip the output
+
+    Yields:
+        bytes: the file, piece by piece
+    """
+
+    columns = await export_columns(evaluation)
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    buffer = io.StringIO()
+    writer = None
+    if export_format == "csv":
+        writer = csv.DictWriter(
+            buffer, fieldnames=columns, restval="", extrasaction="ignore"
+        )
+        writer.writeheader()
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor is not None else data
+
+    if evaluation.archived:
+        documents = iter_archived_scenarios(str(evaluation.id))
+    else:
+        documents = engine.get_collection(EvaluationScenarioDB).find(
+            scenarios_filter(evaluation),
+            projection=SCENARIO_PROJECTION,
+            sort=[("_id", 1)],
+            batch_size=settings.evaluation_scenarios_batch_size,
+        )
+    async for document in documents:
+        record = flatten_scenario(document)
+        if writer is not None:
+            writer.writerow(record)
+        else:
+            buffer.write(db_reads.dumps(record).decode("utf-8"))
+            buffer.write("\n")
+        if buffer.tell() >= settings.evaluation_export_flush_bytes:
+            data = drain()
+            if data:
+                yield data
+
+    data = drain()
+    if compressor is not None:
+        data += compressor.flush()
+    if data:
+        yield data
@@ -0,0 +1,617 @@
+"""Server-side run of evaluations, calling the variant containers for every
+scenario and writing their outputs back in bulk
+
+The scenarios are read from a cursor and sent to the variants by
+`settings.evaluation_runner_concurrency` workers sharing the pooled HTTP
+client. A single writer stores the outputs with one bulk_write every
+`settings.evaluation_runner_write_batch_size` scenarios, along with the
+progress kept on the evaluation. The same pipeline runs the AI critique of
+the scenarios, see ai_critique. The scenarios already holding the output of
+every variant are skipped, so an interrupted run resumes where it stopped.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import httpx
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from agenta_backend.config import settings
+from agenta_backend.models.api.evaluation_model import EvaluationStatusEnum
+from agenta_backend.models.db_models import (
+    AppVariantDB,
+    EvaluationDB,
+    EvaluationScenarioDB,
+)
+from agenta_backend.services.auto_evaluators import (
+    AUTO_EVALUATION_TYPES,
+    score_evaluation,
+)
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.http_client import backoff, get_http_client
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Statuses worth retrying, the variant may answer later
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+# The runs of an evaluation, holding their progress and sharing one lease
+RUN_FIELDS = ("run", "critique")
+
+
+class EvaluationRunError(Exception):
+    """Custom exception for evaluations that cannot be run."""
+
+    pass
+
+
+class EvaluationRunInProgress(Exception):
+    """Custom exception for an evaluation already run by another request."""
+
+    pass
+
+
+class VariantCallError(Exception):
+    """Custom exception for variants failing to answer a scenario."""
+
+    pass
+
+
+def variant_container_url(user_id: str, app_name: str, variant_name: str) -> str:
+    """Returns the URL under which traefik routes a variant container, the
+    one set up by docker_utils.start_container."""
+
+    domain = os.environ["BARE_DOMAIN_NAME"]
+    return f"http://{domain}/{user_id}/{app_name}/{variant_name}"
+
+
+def generate_parameters(
+    openapi: Dict[str, Any], saved: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Set[str]]:
+    """Reads the parameters of a variant from the schema of its /generate
+    endpoint, the values saved on the variant overriding the defaults.
+
+    Arguments:
+        openapi -- the openapi.json of the variant container
+        saved -- the parameters saved on the app variant
+
+    Returns:
+        Tuple[Dict[str, Any], Set[str]]: the parameters sent with every call,
+        and the names of the inputs declared by a dict parameter
+    """
+
+    request_body = openapi.get("paths", {}).get("/generate", {}).get("post", {})
+    request_body = request_body.get("requestBody")
+    if not request_body:
+        return {}, set()
+    schema_name = request_body["content"]["application/json"]["schema"]["$ref"]
+    schema = openapi["components"]["schemas"][schema_name.split("/")[-1]]
+
+    parameters: Dict[str, Any] = {}
+    dict_inputs: Set[str] = set()
+    for name, definition in schema.get("properties", {}).items():
+        kind = definition.get("x-parameter")
+        if not kind:
+            # An input of the variant
+            continue
+        value = saved.get(name, definition.get("default"))
+        if kind == "dict":
+            for item in value or []:
+                dict_inputs.add(item["name"] if isinstance(item, dict) else item)
+        elif value:
+            # Like the web app, empty values are left to the variant defaults
+            parameters[name] = value
+    return parameters, dict_inputs
+
+
+class VariantEndpoint:
+    """The /generate endpoint of a variant and the parameters it is called with."""
+
+    def __init__(
+        self,
+        variant_name: str,
+        url: str,
+        parameters: Dict[str, Any],
+        dict_inputs: Set[str],
+    ):
+        self.variant_name = variant_name
+        self.url = url
+        self.parameters = parameters
+        self.dict_inputs = dict_inputs
+
+    def payload(self, inputs: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Builds the body of a call like the web app does: the inputs
+        declared by a dict parameter nested under "inputs", the others at the
+        top level, then the parameters of the variant."""
+
+        nested = {}
+        top_level = {}
+        for item in inputs:
+            if item["input_name"] in self.dict_inputs:
+                nested[item["input_name"]] = item["input_value"]
+            else:
+                top_level[item["input_name"]] = item["input_value"]
+        return {"inputs": nested, **top_level, **self.parameters}
+
+
+async def load_variant_endpoints(
+    evaluation: EvaluationDB, client: Optional[httpx.AsyncClient] = None
+) -> List[VariantEndpoint]:
+    """Resolves the containers of the variants of an evaluation and reads
+    their parameters.
+
+    Arguments:
+        evaluation -- the evaluation to run
+        client -- the HTTP client, the pooled one by default
+
+    Raises:
+        EvaluationRunError: a variant does not exist or its container is down
+
+    Returns:
+        List[VariantEndpoint]: one endpoint per variant of the evaluation
+    """
+
+    client = client or get_http_client()
+    variants = engine.get_collection(AppVariantDB)
+    user_id = evaluation.user.id
+    endpoints = []
+    for variant_name in evaluation.variants:
+        variant = await variants.find_one(
+            {
+                "user": user_id,
+                "app_name": evaluation.app_name,
+                "variant_name": variant_name,
+                "is_deleted": {"$ne": True},
+            },
+            projection={"parameters": 1, "previous_variant_name": 1},
+        )
+        if variant is None:
+            raise EvaluationRunError(
+                f"Variant {variant_name} of {evaluation.app_name} not found"
+            )
+
+        # Variants created from a template are served by its container
+        url = variant_container_url(
+            str(user_id),
+            evaluation.app_name,
+            variant.get("previous_variant_name") or variant_name,
+        )
+        try:
+            response = await client.get(f"{url}/openapi.json")
+        except httpx.TransportError as e:
+            raise EvaluationRunError(
+                f"Container of variant {variant_name} is unreachable: {e}"
+            ) from e
+        if response.status_code != 200:
+            raise EvaluationRunError(
+                f"Container of variant {variant_name} is not running, "
+                "consider restarting it"
+            )
+
+        parameters, dict_inputs = generate_parameters(
+            response.json(), variant.get("parameters") or {}
+        )
+        endpoints.append(VariantEndpoint(variant_name, url, parameters, dict_inputs))
+    return endpoints
+
+
+async def call_variant(
+    client: httpx.AsyncClient, endpoint: VariantEndpoint, inputs: List[Dict[str, str]]
+) -> str:
+    """Calls a variant with the inputs of a scenario, retrying
+    `settings.http_client_retries` times while it is unavailable.
+
+    Raises:
+        VariantCallError: the variant failed to answer
+
+    Returns:
+        str: the output of the variant, as JSON unless it is a string
+    """
+
+    attempt = 0
+    while True:
+        try:
+            response = await client.post(
+                f"{endpoint.url}/generate", json=endpoint.payload(inputs)
+            )
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                break
+            error = f"status {response.status_code}"
+        except httpx.TransportError as e:
+            error = repr(e)
+        attempt += 1
+        if attempt > settings.http_client_retries:
+            raise VariantCallError(f"Variant {endpoint.variant_name} failed: {error}")
+        await backoff(attempt)
+
+    if response.status_code != 200:
+        raise VariantCallError(
+            f"Variant {endpoint.variant_name} answered {response.status_code}: "
+            f"{response.text[:200]}"
+        )
+    try:
+        output = response.json()
+    except ValueError:
+        output = response.text
+    return output if isinstance(output, str) else json.dumps(output)
+
+
+def run_in_progress(evaluation: EvaluationDB) -> bool:
+    """Tells whether a run or the critique of an evaluation holds its lease."""
+
+    now = datetime.utcnow()
+    for name in RUN_FIELDS:
+        lease_expires_at = getattr(evaluation, name).lease_expires_at
+        if lease_expires_at is not None and lease_expires_at > now:
+            return True
+    return False
+
+
+async def claim_run(evaluation: EvaluationDB, field: str = "run") -> ObjectId:
+    """Takes the lease of a run of an evaluation and resets its progress.
+
+    The variants run and the AI critique share the lease, a single one of
+    them processes the scenarios of an evaluation at a time. The lease is
+    renewed and released with the token of the claim only, so a run whose
+    lease expired and was claimed again stops instead of writing over the
+    new one.
+
+    Arguments:
+        evaluation -- the evaluation
+        field -- the run to claim, "run" or "critique"
+
+    Raises:
+        EvaluationRunError: the evaluation is archived or still materializing
+        EvaluationRunInProgress: another process holds the lease
+
+    Returns:
+        ObjectId: the token of the claim
+    """
+
+    if evaluation.archived:
+        raise EvaluationRunError(
+            f"Evaluation {evaluation.id} is archived, restore it to run it"
+        )
+    if evaluation.status == EvaluationStatusEnum.EVALUATION_MATERIALIZING:
+        raise EvaluationRunError(f"Evaluation {evaluation.id} is still materializing")
+
+    now = datetime.utcnow()
+    token = ObjectId()
+    result = await engine.get_collection(EvaluationDB).update_one(
+        {
+            "_id": evaluation.id,
+            **{
+                f"{name}.lease_expires_at": {"$not": {"$gt": now}}
+                for name in RUN_FIELDS
+            },
+        },
+        {
+            "$set": {
+                "status": EvaluationStatusEnum.EVALUATION_STARTED.value,
+                field: {
+                    "total": 0,
+                    "completed": 0,
+                    "failed": 0,
+                    "rows_per_second": None,
+                    "error": None,
+                    "started_at": now,
+                    "finished_at": None,
+                    "lease_expires_at": now
+                    + timedelta(seconds=settings.evaluation_runner_lease_seconds),
+                    "token": token,
+                },
+                "updated_at": now,
+            }
+        },
+    )
+    if result.matched_count == 0:
+        raise EvaluationRunInProgress(f"Evaluation {evaluation.id} is already running")
+    return token
+
+
+async def process_scenarios(
+    evaluation: EvaluationDB,
+    token: ObjectId,
+    field: str,
+    projection: Dict[str, int],
+    pending: Callable[[Dict[str, Any]], bool],
+    handle: Callable[[Dict[str, Any]], Awaitable[Tuple[Dict[str, Any], bool]]],
+    concurrency: int,
+    finalize: Optional[Callable[[], Awaitable[Any]]] = None,
+) -> Dict[str, int]:
+    """Handles the pending scenarios of an evaluation concurrently and saves
+    what the handler returns, then releases the lease of the run.
+
+    A producer reads the scenarios from a cursor, `concurrency` workers run
+    the handler and a single writer saves the fields with one bulk_write
+    every `settings.evaluation_runner_write_batch_size` scenarios, along
+    with the progress and a renewed lease. The evaluation is finished when
+    no scenario failed, failed otherwise. The run stops as soon as the lease
+    is held by another claim.
+
+    Arguments:
+        evaluation -- the evaluation, its run claimed with claim_run
+        token -- the token returned by claim_run
+        field -- the run claimed, holding the progress
+        projection -- the fields of the scenarios read by the handler
+        pending -- tells whether a scenario must be handled, the others count
+        as completed
+        handle -- returns the fields to set on a scenario and whether it failed
+        concurrency -- the number of scenarios handled at once
+        finalize -- called once every scenario was handled successfully
+
+    Returns:
+        Dict[str, int]: the progress of the run
+    """
+
+    evaluations = engine.get_collection(EvaluationDB)
+    scenarios = engine.get_collection(EvaluationScenarioDB)
+    evaluation_id = str(evaluation.id)
+    scenarios_filter = {"evaluation_id": evaluation_id, "user": evaluation.user.id}
+    lease = timedelta(seconds=settings.evaluation_runner_lease_seconds)
+
+    jobs: asyncio.Queue = asyncio.Queue(maxsize=2 * concurrency)
+    results: asyncio.Queue = asyncio.Queue(maxsize=2 * concurrency)
+    progress = {
+        "total": await scenarios.count_documents(scenarios_filter),
+        "completed": 0,
+        "failed": 0,
+    }
+    started = time.monotonic()
+
+    async def produce():
+        async for document in scenarios.find(
+            scenarios_filter, projection=projection, sort=[("_id", 1)]
+        ):
+            if pending(document):
+                await jobs.put(document)
+            else:
+                progress["completed"] += 1
+
+    async def work():
+        while True:
+            document = await jobs.get()
+            if document is None:
+                return
+            fields, failed = await handle(document)
+            await results.put((document["_id"], fields, failed))
+
+    async def then_put(coroutine, queue: asyncio.Queue, count: int):
+        # Ends the next stage however the coroutine ended, so it never waits
+        # for a stage that is gone
+        try:
+            await coroutine
+        finally:
+            for _ in range(count):
+                await queue.put(None)
+
+    async def flush(batch: List[Tuple[ObjectId, Dict[str, Any], bool]]):
+        now = datetime.utcnow()
+        for _, _, failed in batch:
+            progress["failed" if failed else "completed"] += 1
+        # The lease is renewed before the scenarios are written, a run that
+        # lost it writes nothing more
+        result = await evaluations.update_one(
+            {"_id": evaluation.id, f"{field}.token": token},
+            {
+                "$set": {
+                    **{f"{field}.{key}": value for key, value in progress.items()},
+                    f"{field}.lease_expires_at": now + lease,
+                    "updated_at": now,
+                }
+            },
+        )
+        if result.matched_count == 0:
+            raise EvaluationRunError(
+                f"Evaluation {evaluation_id} was deleted or claimed by another run"
+            )
+        operations = [
+            UpdateOne({"_id": scenario_id}, {"$set": {**fields, "updated_at": now}})
+            for scenario_id, fields, _ in batch
+            if fields
+        ]
+        if operations:
+            await scenarios.bulk_write(operations, ordered=False)
+
+    async def write():
+        running = concurrency
+        batch = []
+        while running:
+            try:
+                # Renew the lease while the handlers are slow
+                item = await asyncio.wait_for(
+                    results.get(), timeout=lease.total_seconds() / 3
+                )
+            except asyncio.TimeoutError:
+                await flush(batch)
+                batch = []
+                continue
+            if item is None:
+                running -= 1
+                continue
+            batch.append(item)
+            if len(batch) >= settings.evaluation_runner_write_batch_size:
+                await flush(batch)
+                batch = []
+        await flush(batch)
+
+    tasks = [asyncio.create_task(then_put(produce(), jobs, concurrency))]
+    tasks += [
+        asyncio.create_task(then_put(work(), results, 1)) for _ in range(concurrency)
+    ]
+    error = None
+    try:
+        await write()
+        # Raises the failures of the producer and the workers. Gathered as
+        # results, a cancelled stage is told apart from a cancelled run
+        for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(outcome, asyncio.CancelledError):
+                raise EvaluationRunError(
+                    f"A worker of evaluation {evaluation_id} stopped"
+                )
+            if isinstance(outcome, BaseException):
+                raise outcome
+        if finalize is not None:
+            await finalize()
+    except Exception as e:
+        error = e
+    finally:
+        for task in tasks:
+            task.cancel()
+        # The cancelled stages still post their end markers, nothing reads them
+        while not all(task.done() for task in tasks):
+            for queue in (jobs, results):
+                while not queue.empty():
+                    queue.get_nowait()
+            await asyncio.wait(tasks, timeout=0.01)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    elapsed = time.monotonic() - started
+    processed = progress["completed"] + progress["failed"]
+    status = (
+        EvaluationStatusEnum.EVALUATION_FINISHED
+        if error is None and progress["failed"] == 0
+        else EvaluationStatusEnum.EVALUATION_FAILED
+    )
+    now = datetime.utcnow()
+    result = await evaluations.update_one(
+        {"_id": evaluation.id, f"{field}.token": token},
+        {
+            "$set": {
+                "status": status.value,
+                **{f"{field}.{key}": value for key, value in progress.items()},
+                f"{field}.rows_per_second": round(processed / elapsed, 2)
+                if elapsed > 0
+                else None,
+                f"{field}.error": None if error is None else repr(error),
+                f"{field}.finished_at": now,
+                f"{field}.lease_expires_at": now,
+                "updated_at": now,
+            }
+        },
+    )
+    if result.matched_count == 0:
+        logger.warning(f"The {field} of evaluation {evaluation_id} lost its lease")
+    logger.info(
+        f"Processed the {field} of evaluation {evaluation_id}: "
+        f"{progress['completed']} scenario(s) completed, {progress['failed']} "
+        f"failed in {elapsed:.2f}s"
+    )
+    if error is not None:
+        raise error
+    return progress
+
+
+async def execute_run(
+    evaluation: EvaluationDB,
+    token: ObjectId,
+    endpoints: List[VariantEndpoint],
+    client: Optional[httpx.AsyncClient] = None,
+) -> Dict[str, Any]:
+    """Calls the variants for every scenario still missing an output, scores
+    the outputs when the evaluation type is scored on the backend, then
+    releases the lease. The evaluation is finished when every scenario got
+    an output of every variant, failed otherwise, and running it again
+    retries the failed scenarios only.
+
+    Arguments:
+        evaluation -- the evaluation, its run claimed with claim_run
+        token -- the token returned by claim_run
+        endpoints -- the endpoints of its variants
+        client -- the HTTP client, the pooled one by default
+
+    Returns:
+        Dict[str, Any]: the progress of the run
+    """
+
+    client = client or get_http_client()
+
+    def missing(document: Dict[str, Any]) -> List[VariantEndpoint]:
+        done = {item["variant_name"] for item in document.get("outputs") or []}
+        return [endpoint for endpoint in endpoints if endpoint.variant_name not in done]
+
+    async def call_variants(document: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        missing_endpoints = missing(document)
+        answers = await asyncio.gather(
+            *(
+                call_variant(client, endpoint, document.get("inputs") or [])
+                for endpoint in missing_endpoints
+            ),
+            return_exceptions=True,
+        )
+        outputs = {
+            item["variant_name"]: item["variant_output"]
+            for item in document.get("outputs") or []
+        }
+        failed = False
+        for endpoint, answer in zip(missing_endpoints, answers):
+            if isinstance(answer, VariantCallError):
+                logger.warning(f"Scenario {document['_id']}: {answer}")
+                failed = True
+            elif isinstance(answer, BaseException):
+                raise answer
+            else:
+                outputs[endpoint.variant_name] = answer
+        if not outputs:
+            return {}, failed
+        return {
+            "outputs": [
+                {"variant_name": name, "variant_output": outputs[name]}
+                for name in evaluation.variants
+                if name in outputs
+            ]
+        }, failed
+
+    async def score():
+        if evaluation.evaluation_type in AUTO_EVALUATION_TYPES:
+            await score_evaluation(evaluation)
+
+    return await process_scenarios(
+        evaluation,
+        token,
+        "run",
+        {"inputs": 1, "outputs": 1},
+        lambda document: bool(missing(document)),
+        call_variants,
+        settings.evaluation_runner_concurrency,
+        score,
+    )
+
+
+async def run_evaluation(
+    evaluation: EvaluationDB, client: Optional[httpx.AsyncClient] = None
+) -> Dict[str, Any]:
+    """Runs an evaluation end to end: resolves its variants, claims the run
+    and calls the variants for every scenario.
+
+    Arguments:
+        evaluation -- the evaluation to run
+        client -- the HTTP client, the pooled one by default
+
+    Raises:
+        EvaluationRunError: the evaluation cannot be run
+        EvaluationRunInProgress: the evaluation is already running
+
+    Returns:
+        Dict[str, Any]: the progress of the run
+    """
+
+    endpoints = await load_variant_endpoints(evaluation, client)
+    token = await claim_run(evaluation)
+    return await execute_run(evaluation, token, endpoints, client)
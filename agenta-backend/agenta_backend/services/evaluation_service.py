@@ -1,8 +1,10 @@
-import os
+import time
+import asyncio
+import logging
 
 from bson import ObjectId
-from datetime import datetime
-from typing import Dict, List, Any
+from datetime import datetime, timedelta
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, List, Any, Optional, Tuple
 
 from fastapi import HTTPException
 
@@ -17,23 +19,65 @@ from agenta_backend.models.api.evaluation_model import (
     EvaluationScenarioUpdate,
     CreateCustomEvaluation,
     EvaluationUpdate,
+    EvaluationMaterialization,
+    EvaluationStatusEnum,
 )
+from agenta_backend.config import settings
 from agenta_backend.services.security.sandbox import execute_code_safely
-from agenta_backend.services.db_manager import engine, query, get_user_object
+from agenta_backend.services.ai_critique import critique_scenario
+from agenta_backend.services.db_manager import (
+    engine,
+    query,
+    get_user_object,
+    get_variant_parameters,
+)
+from agenta_backend.services.helpers import TTLCache
+from agenta_backend.services.background_tasks import spawn_background_task
+from agenta_backend.services.cleanup_service import delete_evaluation_scenarios
+from agenta_backend.services.evaluation_archive import (
+    check_scenarios_writable,
+    is_archived,
+    iter_archived_scenarios,
+)
+from agenta_backend.services.testset_service import (
+    iter_testset_rows,
+    read_testset_rows,
+    testset_row_count,
+)
+from agenta_backend.services.testset_selection import (
+    RowsSelectionError,
+    select_testset_rows,
+)
+from agenta_backend.services.results_service import (
+    COUNTED_RESULT_FIELDS,
+    create_result_counters,
+    increment_result_counters,
+    record_scenario_result_change,
+)
 from agenta_backend.models.db_models import (
-    AppVariantDB,
     EvaluationDB,
+    EvaluationResultsDB,
     EvaluationScenarioDB,
     TestSetDB,
     EvaluationTypeSettings,
     EvaluationScenarioInput,
     EvaluationScenarioOutput,
     CustomEvaluationDB,
+    EvaluationMaterialization as EvaluationMaterializationDB,
+    UserDB,
 )
 
-from langchain.chains import LLMChain
-from langchain.llms import OpenAI
-from langchain.prompts import PromptTemplate
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# Code of the custom evaluations, keyed by user id and custom evaluation id
+custom_evaluation_cache = TTLCache(
+    maxsize=settings.custom_evaluation_cache_size,
+    ttl=settings.custom_evaluation_cache_ttl_seconds,
+)
 
 
 class UpdateEvaluationScenarioError(Exception):
@@ -42,6 +86,18 @@ class UpdateEvaluationScenarioError(Exception):
     pass
 
 
+class EvaluationDeletedError(Exception):
+    """Custom exception for evaluations deleted while being materialized."""
+
+    pass
+
+
+class EvaluationMaterializingError(Exception):
+    """Custom exception for updates of evaluations being materialized."""
+
+    pass
+
+
 async def create_new_evaluation(payload: NewEvaluation, **kwargs: dict) -> Dict:
     # Get user object
     user = await get_user_object(kwargs["uid"])
@@ -65,9 +121,31 @@ async def create_new_evaluation(payload: NewEvaluation, **kwargs: dict) -> Dict:
         webhook_url="" if webhook_url is None else webhook_url,
     )
 
-    # Initialize evaluation instance and save to database
+    # Get testset using the provided _id
+    testsetId = payload.testset["_id"]
+    testset = await engine.find_one(TestSetDB, TestSetDB.id == ObjectId(testsetId))
+    row_count = testset_row_count(testset)
+    rows = iter_testset_rows(testset)
+
+    # Only materialize the selected rows, selected by mongo
+    if payload.rows_selection is not None:
+        try:
+            row_count, selected_rows = await select_testset_rows(
+                testset, payload.rows_selection
+            )
+        except RowsSelectionError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        rows = (row async for _, row in selected_rows)
+
+    # Reject a mismatching column mapping before creating anything
+    first_rows = await read_testset_rows(testset, 0, 1)
+    if first_rows:
+        validate_testset_columns(payload.inputs, first_rows[0].keys())
+
+    # Initialize evaluation instance and save to database, the scenarios
+    # are materialized in the background
     eval_instance = EvaluationDB(
-        status=payload.status,
+        status=EvaluationStatusEnum.EVALUATION_MATERIALIZING,
         evaluation_type=payload.evaluation_type,
         custom_code_evaluation_id=payload.custom_code_evaluation_id,
         evaluation_type_settings=evaluation_type_settings,
@@ -75,6 +153,9 @@ async def create_new_evaluation(payload: NewEvaluation, **kwargs: dict) -> Dict:
         variants=payload.variants,
         app_name=payload.app_name,
         testset=payload.testset,
+        materialization=EvaluationMaterializationDB(
+            total=row_count, lease_expires_at=_materialization_lease()
+        ),
         user=user,
         created_at=evaluation_dict["created_at"],
         updated_at=evaluation_dict["updated_at"],
@@ -85,58 +166,236 @@ async def create_new_evaluation(payload: NewEvaluation, **kwargs: dict) -> Dict:
         raise HTTPException(
             status_code=500, detail="Failed to create evaluation_scenario"
         )
+    await create_result_counters(str(newEvaluation.id), newEvaluation.evaluation_type)
 
-    # Get testset using the provided _id
-    testsetId = eval_instance.testset["_id"]
-    testset = await engine.find_one(TestSetDB, TestSetDB.id == ObjectId(testsetId))
+    spawn_background_task(
+        finish_evaluation_materialization(
+            newEvaluation, payload, rows, user
+        )
+    )
 
-    csvdata = testset.csvdata
-    for datum in csvdata:
-        try:
-            inputs = [
-                {"input_name": name, "input_value": datum[name]}
-                for name in payload.inputs
-            ]
-        except KeyError:
-            await engine.delete(newEvaluation)
-            msg = f"""
-            Columns in the test set should match the names of the inputs in the variant.
-            Inputs names in variant are: {payload.inputs} while
-            columns in test set are: {[col for col in datum.keys() if col != 'correct_answer']}
-            """
-            raise HTTPException(
-                status_code=400,
-                detail=msg,
-            )
+    evaluation_dict["id"] = str(newEvaluation.id)
+    evaluation_dict["status"] = newEvaluation.status
+    evaluation_dict["materialization"] = EvaluationMaterialization(
+        total=row_count, materialized=0
+    )
+    return evaluation_dict
 
-        list_of_scenario_input = []
-        for scenario_input in inputs:
-            eval_scenario_input_instance = EvaluationScenarioInput(
-                input_name=scenario_input["input_name"],
-                input_value=scenario_input["input_value"],
-            )
-            list_of_scenario_input.append(eval_scenario_input_instance)
 
-        evaluation_scenario_payload = {
-            **{
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow(),
+def _materialization_lease() -> datetime:
+    return datetime.utcnow() + timedelta(
+        seconds=settings.evaluation_materialization_lease_seconds
+    )
+
+
+def validate_testset_columns(inputs: List[str], columns: Iterable[str]) -> None:
+    """Checks that the test set columns contain every input of the variant.
+
+    Args:
+        inputs (List[str]): the input names of the variant
+        columns (Iterable[str]): the columns of a test set row
+
+    Raises:
+        HTTPException: the columns do not match the inputs
+    """
+
+    columns = list(columns)
+    missing = [name for name in inputs if name not in columns]
+    if missing:
+        msg = f"""
+        Columns in the test set should match the names of the inputs in the variant.
+        Inputs names in variant are: {inputs} while
+        columns in test set are: {[col for col in columns if col != 'correct_answer']}
+        """
+        raise HTTPException(
+            status_code=400,
+            detail=msg,
+        )
+
+
+async def materialize_evaluation_scenarios(
+        evaluation: EvaluationDB,
+        payload: NewEvaluation,
+        rows: AsyncIterable[Dict[str, str]],
+        user: UserDB,
+) -> EvaluationMaterialization:
+    """Creates one evaluation scenario per test set row.
+
+    Scenarios are built in chunks of `settings.evaluation_scenarios_batch_size`
+    and written with one unordered insert_many per chunk, after which the
+    progress stored on the evaluation and its result counters are updated. The column mapping is
+    validated once per distinct set of columns rather than once per row.
+    The lease of the materialization is renewed with the progress, an
+    evaluation whose lease expired is failed by fail_stale_materializations.
+
+    Args:
+        evaluation (EvaluationDB): the evaluation the scenarios belong to
+        payload (NewEvaluation): the evaluation creation payload
+        rows (AsyncIterable[Dict[str, str]]): the test set rows, streamed
+        user (UserDB): the owner of the scenarios
+
+    Raises:
+        HTTPException: the test set columns do not match the variant inputs
+        EvaluationDeletedError: the evaluation was deleted or failed in the meantime
+
+    Returns:
+        EvaluationMaterialization: the number of rows written and the throughput
+    """
+
+    collection = engine.get_collection(EvaluationScenarioDB)
+    evaluations_collection = engine.get_collection(EvaluationDB)
+    batch_size = settings.evaluation_scenarios_batch_size
+    evaluation_id = str(evaluation.id)
+    extra_fields = extend_with_evaluation(payload.evaluation_type)
+    counted_field = COUNTED_RESULT_FIELDS.get(payload.evaluation_type)
+    validated_columns = set()
+
+    started = time.monotonic()
+    materialized = 0
+    batch = []
+
+    async def flush():
+        nonlocal materialized, batch
+        await collection.insert_many(batch, ordered=False)
+        if counted_field is not None:
+            increments = {}
+            for doc in batch:
+                value = doc.get(counted_field)
+                increments[value] = increments.get(value, 0) + 1
+            await increment_result_counters(evaluation_id, increments, len(batch))
+        materialized += len(batch)
+        batch = []
+        result = await evaluations_collection.update_one(
+            {
+                "_id": evaluation.id,
+                "status": EvaluationStatusEnum.EVALUATION_MATERIALIZING.value,
             },
-            **extend_with_evaluation(payload.evaluation_type),
-            **extend_with_correct_answer(payload.evaluation_type, datum),
-        }
+            {
+                "$set": {
+                    "materialization.materialized": materialized,
+                    "materialization.lease_expires_at": _materialization_lease(),
+                }
+            },
+        )
+        if result.matched_count == 0:
+            # The scenarios written so far are removed on failure
+            raise EvaluationDeletedError(
+                f"Evaluation {evaluation_id} was deleted or failed"
+            )
+
+    async for datum in rows:
+        columns = frozenset(datum.keys())
+        if columns not in validated_columns:
+            validate_testset_columns(payload.inputs, columns)
+            validated_columns.add(columns)
 
+        now = datetime.utcnow()
         eval_scenario_instance = EvaluationScenarioDB(
-            **evaluation_scenario_payload,
+            **extra_fields,
+            **extend_with_correct_answer(payload.evaluation_type, datum),
+            created_at=now,
+            updated_at=now,
             user=user,
-            evaluation_id=str(newEvaluation.id),
-            inputs=list_of_scenario_input,
+            evaluation_id=evaluation_id,
+            inputs=[
+                EvaluationScenarioInput(input_name=name, input_value=datum[name])
+                for name in payload.inputs
+            ],
             outputs=[],
         )
-        await engine.save(eval_scenario_instance)
+        batch.append(eval_scenario_instance.doc())
 
-    evaluation_dict["id"] = str(newEvaluation.id)
-    return evaluation_dict
+        if len(batch) >= batch_size:
+            await flush()
+
+    if batch:
+        await flush()
+
+    elapsed = time.monotonic() - started
+    rows_per_second = round(materialized / elapsed, 2) if elapsed > 0 else None
+    logger.info(
+        f"Materialized {materialized} scenarios for evaluation {evaluation_id} "
+        f"in {elapsed:.2f}s ({rows_per_second} rows/s)"
+    )
+    return EvaluationMaterialization(
+        total=materialized,
+        materialized=materialized,
+        rows_per_second=rows_per_second,
+    )
+
+
+async def finish_evaluation_materialization(
+        evaluation: EvaluationDB,
+        payload: NewEvaluation,
+        rows: AsyncIterable[Dict[str, str]],
+        user: UserDB,
+) -> None:
+    """Materializes the scenarios of a new evaluation, then moves it to the
+    status requested at creation. On failure the partial scenarios are
+    removed and the evaluation is marked as failed. When cancelled, on
+    shutdown, the lease is released so the evaluation is failed by the next
+    fail_stale_materializations.
+
+    Args:
+        evaluation (EvaluationDB): the evaluation in materializing state
+        payload (NewEvaluation): the evaluation creation payload
+        rows (AsyncIterable[Dict[str, str]]): the test set rows, streamed
+        user (UserDB): the owner of the scenarios
+    """
+
+    evaluations_collection = engine.get_collection(EvaluationDB)
+    try:
+        materialization = await materialize_evaluation_scenarios(
+            evaluation, payload, rows, user
+        )
+    except asyncio.CancelledError:
+        await evaluations_collection.update_one(
+            {
+                "_id": evaluation.id,
+                "status": EvaluationStatusEnum.EVALUATION_MATERIALIZING.value,
+            },
+            {"$set": {"materialization.lease_expires_at": datetime.utcnow()}},
+        )
+        raise
+    except Exception as e:
+        logger.error(f"Failed to materialize evaluation {evaluation.id}: {repr(e)}")
+        await engine.get_collection(EvaluationScenarioDB).delete_many(
+            {"evaluation_id": str(evaluation.id)}
+        )
+        await engine.get_collection(EvaluationResultsDB).delete_one(
+            {"evaluation_id": str(evaluation.id)}
+        )
+        await evaluations_collection.update_one(
+            {"_id": evaluation.id},
+            {
+                "$set": {
+                    "status": EvaluationStatusEnum.EVALUATION_FAILED.value,
+                    "materialization.materialized": 0,
+                    "updated_at": datetime.utcnow(),
+                }
+            },
+        )
+        return
+
+    result = await evaluations_collection.update_one(
+        {
+            "_id": evaluation.id,
+            "status": EvaluationStatusEnum.EVALUATION_MATERIALIZING.value,
+        },
+        {
+            "$set": {
+                "status": payload.status,
+                "materialization": materialization.dict(),
+                "updated_at": datetime.utcnow(),
+            }
+        },
+    )
+    if result.matched_count == 0:
+        # Failed as stale in the meantime, or deleted
+        logger.warning(f"Evaluation {evaluation.id} failed during its materialization")
+        await engine.get_collection(EvaluationScenarioDB).delete_many(
+            {"evaluation_id": str(evaluation.id)}
+        )
 
 
 async def create_new_evaluation_scenario(
@@ -179,6 +438,48 @@ async def create_new_evaluation_scenario(
     )
 
 
+async def delete_evaluations(evaluation_ids: List[str], user: UserDB) -> List[str]:
+    """Deletes evaluations with their result counters and their scenarios.
+
+    The evaluations and their counters are deleted with one delete_many
+    each, the scenarios in batches by a background task, so deleting large
+    evaluations does not hold the request.
+
+    Args:
+        evaluation_ids (List[str]): the evaluations to delete
+        user (UserDB): the owner of the evaluations
+
+    Raises:
+        HTTPException: one of the evaluations does not exist, none is deleted
+
+    Returns:
+        List[str]: the ids of the deleted evaluations
+    """
+
+    filters = {
+        "_id": {"$in": [ObjectId(evaluation_id) for evaluation_id in evaluation_ids]},
+        "user": user.id,
+    }
+    collection = engine.get_collection(EvaluationDB)
+    found = {
+        str(document["_id"])
+        async for document in collection.find(filters, projection={"_id": 1})
+    }
+    for evaluation_id in evaluation_ids:
+        if evaluation_id not in found:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Comparison table {evaluation_id} not found",
+            )
+
+    await collection.delete_many(filters)
+    await engine.get_collection(EvaluationResultsDB).delete_many(
+        {"evaluation_id": {"$in": evaluation_ids}}
+    )
+    spawn_background_task(delete_evaluation_scenarios(evaluation_ids))
+    return evaluation_ids
+
+
 async def update_evaluation(
         evaluation_id: str, update_payload: EvaluationUpdate, **kwargs: dict
 ) -> Evaluation:
@@ -191,6 +492,16 @@ async def update_evaluation(
     result = await engine.find_one(EvaluationDB, query_expression)
 
     if result is not None:
+        # The materialization fails the evaluation once its status is changed
+        if result.status == EvaluationStatusEnum.EVALUATION_MATERIALIZING:
+            raise EvaluationMaterializingError(
+                f"Evaluation {evaluation_id} is still materializing its scenarios"
+            )
+        if update_payload.status == EvaluationStatusEnum.EVALUATION_MATERIALIZING:
+            raise EvaluationMaterializingError(
+                "Only a new evaluation materializes its scenarios"
+            )
+
         # Update status and save to database
         updates = {}
         if update_payload.status is not None:
@@ -212,7 +523,12 @@ async def update_evaluation(
             )
 
         result.update(updates)
-        await engine.save(result)
+        if updates:
+            # Saving the whole evaluation would overwrite the progress of its
+            # run written in the meantime
+            await engine.get_collection(EvaluationDB).update_one(
+                {"_id": result.id}, {"$set": result.doc(include=set(updates))}
+            )
 
         return Evaluation(
             id=str(result.id),
@@ -231,16 +547,22 @@ async def update_evaluation(
 
 
 async def update_evaluation_scenario(
+        evaluation_id: str,
         evaluation_scenario_id: str,
         evaluation_scenario_data: EvaluationScenarioUpdate,
         evaluation_type: EvaluationType,
         **kwargs,
 ) -> Dict:
+    # The update of an archived scenario would be lost
+    await check_scenarios_writable(evaluation_id)
     evaluation_scenario_dict = evaluation_scenario_data.dict()
     evaluation_scenario_dict["updated_at"] = datetime.utcnow()
 
     # Construct new evaluation set and get user object
-    new_evaluation_set = {"outputs": evaluation_scenario_dict["outputs"]}
+    new_evaluation_set = {
+        "outputs": evaluation_scenario_dict["outputs"],
+        "updated_at": evaluation_scenario_dict["updated_at"],
+    }
     user = await get_user_object(kwargs["uid"])
 
     # COnstruct query expression builder for evaluation and evaluation scenario
@@ -275,7 +597,7 @@ async def update_evaluation_scenario(
             ),
         )
 
-        evaluation = evaluate_with_ai_critique(
+        evaluation = await evaluate_with_ai_critique(
             llm_app_prompt_template=current_evaluation.llm_app_prompt_template,
             llm_app_inputs=[
                 scenario_input.dict()
@@ -290,9 +612,6 @@ async def update_evaluation_scenario(
         )
         new_evaluation_set["evaluation"] = evaluation
 
-    # Get an evaluation scenario with the provided id
-    result = await engine.find_one(EvaluationScenarioDB, query_expression_eval_scen)
-
     # Loop through the evaluation set outputs, create an evaluation scenario
     # output instance and append the instance in the list
     list_of_eval_outputs = []
@@ -303,12 +622,22 @@ async def update_evaluation_scenario(
         )
         list_of_eval_outputs.append(eval_output.dict())
 
-    # Update evaluation scenario
+    # Update evaluation scenario, getting back its previous vote and score
+    # so that the result counters can be moved atomically
     new_evaluation_set["outputs"] = list_of_eval_outputs
-    result.update(new_evaluation_set)
-
-    # Save update to database
-    await engine.save(result)
+    result = await engine.get_collection(EvaluationScenarioDB).find_one_and_update(
+        {
+            "_id": ObjectId(evaluation_scenario_id),
+            "evaluation_id": evaluation_id,
+            "user": user.id,
+        },
+        {"$set": new_evaluation_set},
+        projection={"evaluation_id": 1, "vote": 1, "score": 1},
+    )
+    if result is not None:
+        await record_scenario_result_change(result, new_evaluation_set)
+    # Archived in the meantime, the update may not be in the archive
+    await check_scenarios_writable(evaluation_id)
 
     if result is not None:
         evaluation_scenario = await engine.find_one(
@@ -348,17 +677,27 @@ async def update_evaluation_scenario_score(
     # Get user object
     user = await get_user_object(kwargs["uid"])
 
-    # Build query expression
-    query_expression = query.eq(
-        EvaluationScenarioDB.id, ObjectId(evaluation_scenario_id)
-    ) & query.eq(EvaluationScenarioDB.user, user.id)
-
-    # Find evaluation scenario if it meets with the query expression
-    evaluation_scenario = await engine.find_one(EvaluationScenarioDB, query_expression)
-    evaluation_scenario.score = score
-
-    # Save the evaluation scenario
-    await engine.save(evaluation_scenario)
+    # The update of an archived scenario would be lost
+    scenarios = engine.get_collection(EvaluationScenarioDB)
+    scenario = await scenarios.find_one(
+        {"_id": ObjectId(evaluation_scenario_id), "user": user.id},
+        projection={"evaluation_id": 1},
+    )
+    if scenario is None:
+        return
+    await check_scenarios_writable(scenario["evaluation_id"])
+
+    # Update the score, getting back the previous one for the result counters
+    changes = {"score": score}
+    previous = await scenarios.find_one_and_update(
+        {"_id": ObjectId(evaluation_scenario_id), "user": user.id},
+        {"$set": {**changes, "updated_at": datetime.utcnow()}},
+        projection={"evaluation_id": 1, "vote": 1, "score": 1},
+    )
+    if previous is not None:
+        await record_scenario_result_change(previous, changes)
+    # Archived in the meantime, the update may not be in the archive
+    await check_scenarios_writable(scenario["evaluation_id"])
 
 
 async def get_evaluation_scenario_score(
@@ -389,7 +728,117 @@ async def get_evaluation_scenario_score(
     }
 
 
-def evaluate_with_ai_critique(
+# Scenario fields that can be requested in a scenarios listing projection
+EVALUATION_SCENARIO_FIELDS = [
+    "inputs",
+    "outputs",
+    "vote",
+    "score",
+    "evaluation",
+    "correct_answer",
+]
+
+
+async def _filter_archived_scenarios(
+        documents: AsyncIterable[Dict[str, Any]],
+        user: UserDB,
+        unvoted: bool,
+        unscored: bool,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Applies the filters of a scenarios listing to archived scenarios."""
+
+    async for document in documents:
+        if document["user"] != user.id:
+            return
+        if unvoted and document.get("vote") not in ("", None):
+            continue
+        if unscored and document.get("score") not in ("", None):
+            continue
+        yield document
+
+
+async def fetch_evaluation_scenarios_page(
+        evaluation_id: str,
+        user: UserDB,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        unvoted: bool = False,
+        unscored: bool = False,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Lists the scenarios of an evaluation in _id order, one page at a time.
+
+    The documents are read with the raw collection rather than hydrated
+    through odmantic, and only the requested fields are fetched. The
+    scenarios of archived evaluations are decoded from their archive.
+
+    Args:
+        evaluation_id (str): the evaluation the scenarios belong to
+        user (UserDB): the owner of the scenarios
+        limit (Optional[int]): the page size, every scenario when None
+        cursor (Optional[str]): the id of the last scenario of the previous page
+        fields (Optional[List[str]]): the fields to return, all when None
+        unvoted (bool): only return the scenarios without a vote
+        unscored (bool): only return the scenarios without a score
+
+    Raises:
+        HTTPException: an unknown field or an invalid cursor was requested
+
+    Returns:
+        Tuple[List[Dict[str, Any]], Optional[str]]: the scenarios and the
+        cursor of the next page, None on the last page
+    """
+
+    if fields is None:
+        fields = EVALUATION_SCENARIO_FIELDS
+    unknown_fields = set(fields) - set(EVALUATION_SCENARIO_FIELDS)
+    if unknown_fields:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown scenario fields: {', '.join(sorted(unknown_fields))}",
+        )
+
+    # Build query expression
+    filters: Dict[str, Any] = {"evaluation_id": evaluation_id, "user": user.id}
+    if cursor is not None:
+        if not ObjectId.is_valid(cursor):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        filters["_id"] = {"$gt": ObjectId(cursor)}
+    if unvoted:
+        filters["vote"] = {"$in": ["", None]}
+    if unscored:
+        filters["score"] = {"$in": ["", None]}
+
+    if await is_archived(evaluation_id):
+        documents = _filter_archived_scenarios(
+            iter_archived_scenarios(evaluation_id, filters.get("_id", {}).get("$gt")),
+            user,
+            unvoted,
+            unscored,
+        )
+    else:
+        collection = engine.get_collection(EvaluationScenarioDB)
+        documents = collection.find(
+            filters, projection={field: 1 for field in fields}
+        ).sort("_id", 1)
+        if limit is not None:
+            # One extra document tells whether there is a next page
+            documents = documents.limit(limit + 1)
+
+    scenarios = []
+    next_cursor = None
+    async for document in documents:
+        if limit is not None and len(scenarios) == limit:
+            next_cursor = scenarios[-1]["id"]
+            break
+        scenario = {"id": str(document["_id"]), "evaluation_id": evaluation_id}
+        for field in fields:
+            scenario[field] = document.get(field)
+        scenarios.append(scenario)
+    return scenarios, next_cursor
+
+
+async def evaluate_with_ai_critique(
         llm_app_prompt_template: str,
         llm_app_inputs: dict,
         correct_answer: str,
@@ -411,50 +860,22 @@ def evaluate_with_ai_critique(
         app_variant_output (str): the output of an ll app variant with given parameters
         evaluation_prompt_template (str): evaluation prompt set by an agenta user in the ai evaluation view
 
+    Raises:
+        AICritiqueError: the template is invalid or the model failed to answer
+
     Returns:
         str: returns an evaluation
     """
-    openai_proxy: str = "http://192.168.153.1:3389"
-    if os.getenv("OPENAI_PROXY"):
-        openai_proxy = os.getenv("OPENAI_PROXY")
-
-    llm = OpenAI(openai_api_key=open_ai_key, temperature=temperature, openai_proxy=openai_proxy)
-
-    input_variables = []
-
-    # List of default variables
-    default_vars = [
-        "app_variant_output",
-        "llm_app_prompt_template",
-        "correct_answer",
-    ]
-
-    # Check default variables
-    for var in default_vars:
-        if "{%s}" % var in evaluation_prompt_template:
-            input_variables.append(var)
-
-    # Iterate over llm_app_inputs and check if the variable name exists in the evaluation_prompt_template
-    for input_item in llm_app_inputs:
-        if "{%s}" % input_item["input_name"] in evaluation_prompt_template:
-            input_variables.append(input_item["input_name"])
-
-    chain_run_args = {
-        "llm_app_prompt_template": llm_app_prompt_template,
-        "correct_answer": correct_answer,
-        "app_variant_output": app_variant_output,
-    }
-
-    for input_item in llm_app_inputs:
-        chain_run_args[input_item["input_name"]] = input_item["input_value"]
 
-    prompt = PromptTemplate(
-        input_variables=input_variables, template=evaluation_prompt_template
+    return await critique_scenario(
+        llm_app_prompt_template=llm_app_prompt_template,
+        llm_app_inputs=llm_app_inputs,
+        correct_answer=correct_answer,
+        app_variant_output=app_variant_output,
+        evaluation_prompt_template=evaluation_prompt_template,
+        open_ai_key=open_ai_key,
+        temperature=temperature,
     )
-    chain = LLMChain(llm=llm, prompt=prompt)
-
-    output = chain.run(**chain_run_args)
-    return output.strip()
 
 
 def extend_with_evaluation(evaluation_type: EvaluationType):
@@ -542,34 +963,25 @@ async def execute_custom_code_evaluation(
     # Get user object
     user = await get_user_object(kwargs["uid"])
 
-    # Build query expression
-    query_expression = query.eq(
-        CustomEvaluationDB.id, ObjectId(evaluation_id)
-    ) & query.eq(CustomEvaluationDB.user, user.id)
-
-    # Get custom evaluation
-    custom_eval = await engine.find_one(CustomEvaluationDB, query_expression)
-    if not custom_eval:
+    # Get the code of the custom evaluation
+    python_code = await get_custom_evaluation_code(user.id, evaluation_id)
+    if python_code is None:
         raise HTTPException(status_code=404, detail="Evaluation not found")
 
-    # Build query expression for app variant
-    appvar_query_expression = query.eq(AppVariantDB.app_name, app_name) & query.eq(
-        AppVariantDB.variant_name, variant_name
-    )
-
-    # Get app variant object
-    app_variant = await engine.find_one(AppVariantDB, appvar_query_expression)
-    if not app_variant:
+    # Get the parameters of the app variant
+    parameters = await get_variant_parameters(user.id, app_name, variant_name)
+    if parameters is None:
         raise HTTPException(status_code=404, detail="App variant not found")
 
     # Execute the Python code with the provided inputs
     try:
         result = execute_code_safely(
-            app_variant.parameters,
+            parameters,
             inputs,
             output,
             correct_answer,
-            custom_eval.python_code,
+            python_code,
+            evaluation_id,
         )
     except Exception as e:
         raise HTTPException(
@@ -579,6 +991,33 @@ async def execute_custom_code_evaluation(
     return result
 
 
+async def get_custom_evaluation_code(
+        user_id: ObjectId, evaluation_id: str
+) -> Optional[str]:
+    """Get the code of a custom evaluation from the process cache or the database.
+
+    Args:
+        user_id (ObjectId): the owner of the custom evaluation
+        evaluation_id (str): the custom evaluation id
+
+    Returns:
+        str: the python code, None if the custom evaluation does not exist
+    """
+
+    key = (str(user_id), evaluation_id)
+    python_code = custom_evaluation_cache.get(key)
+    if python_code is None:
+        query_expression = query.eq(
+            CustomEvaluationDB.id, ObjectId(evaluation_id)
+        ) & query.eq(CustomEvaluationDB.user, user_id)
+        custom_eval = await engine.find_one(CustomEvaluationDB, query_expression)
+        if not custom_eval:
+            return None
+        python_code = custom_eval.python_code
+        custom_evaluation_cache.set(key, python_code)
+    return python_code
+
+
 async def fetch_custom_evaluations(
         app_name: str, **kwargs: dict
 ) -> List[CustomEvaluationOutput]:
@@ -1,5 +1,7 @@
 import json
-from typing import List, Dict, Any
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List
 
 
 def print_app_variant(app_variant):
@@ -74,3 +76,51 @@ def include_dynamic_values(json_data: Dict, inputs: Dict[str, Any]) -> Dict:
         json_data = json_data.replace(f"{key}", value)
 
     return json_data
+
+
+class TTLCache:
+    """A small in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def pop_where(self, predicate: Callable[[Any], bool]) -> int:
+        """Removes the entries whose value matches `predicate`.
+
+        Returns:
+          The number of removed entries.
+        """
+
+        keys = [key for key, (_, value) in self._data.items() if predicate(value)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,62 @@
+"""Shared HTTP client, keeping connections to remote hosts open across requests
+"""
+import asyncio
+import random
+from typing import Optional
+
+import httpx
+
+from agenta_backend.config import settings
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the pooled HTTP client, created on first use.
+
+    Connection failures are retried `settings.http_client_retries` times by
+    the transport; errors once the response started are left to the caller.
+
+    Returns:
+        httpx.AsyncClient: the shared client
+    """
+
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                retries=settings.http_client_retries,
+                limits=httpx.Limits(
+                    max_connections=settings.http_client_max_connections,
+                    max_keepalive_connections=settings.http_client_max_keepalive_connections,
+                ),
+            ),
+            timeout=settings.http_client_timeout_seconds,
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Closes the pooled HTTP client and its connections."""
+
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def backoff(
+    attempt: int, base_seconds: float = 0.5, jitter: bool = False
+) -> None:
+    """Waits before retrying, twice as long after each failed attempt.
+
+    Arguments:
+        attempt -- the number of failed attempts so far, starting at 1
+        base_seconds -- the wait after the first failed attempt
+        jitter -- wait a random time up to that instead, spreading the
+        retries of concurrent callers
+    """
+
+    delay = base_seconds * 2 ** (attempt - 1)
+    await asyncio.sleep(random.uniform(0, delay) if jitter else delay)
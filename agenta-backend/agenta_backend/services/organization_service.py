@@ -1,5 +1,10 @@
 from bson import ObjectId
-from agenta_backend.services.db_manager import engine, OrganizationDB
+from agenta_backend.services.db_manager import (
+    engine,
+    OrganizationDB,
+    get_organization_object,
+    invalidate_organization_cache,
+)
 from agenta_backend.models.api.organization_models import (
     Organization,
     OrganizationUpdate,
@@ -7,7 +12,7 @@ from agenta_backend.models.api.organization_models import (
 
 
 async def get_organization(org_id: str) -> OrganizationDB:
-    org = await engine.find_one(OrganizationDB, OrganizationDB.id == ObjectId(org_id))
+    org = await get_organization_object(org_id)
     return org
 
 
@@ -25,6 +30,7 @@ async def update_organization(
         values_to_update = {key: value for key, value in payload.dict()}
         updated_org = org.update(values_to_update)
         await engine.save(updated_org)
+        invalidate_organization_cache(org_id)
         return org
     raise NotFound("Organization not found")
 
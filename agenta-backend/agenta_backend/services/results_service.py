@@ -1,5 +1,268 @@
-from agenta_backend.services.db_manager import engine, query
-from agenta_backend.models.db_models import EvaluationScenarioDB
+import logging
+import math
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from agenta_backend.config import settings
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.evaluation_archive import (
+    is_archived,
+    iter_archived_scenarios,
+)
+from agenta_backend.models.api.evaluation_model import (
+    EvaluationStatusEnum,
+    EvaluationType,
+)
+from agenta_backend.models.db_models import (
+    EvaluationDB,
+    EvaluationResultsDB,
+    EvaluationScenarioDB,
+)
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The scenario field whose values are counted, per evaluation type
+COUNTED_RESULT_FIELDS: Dict[str, str] = {
+    EvaluationType.human_a_b_testing.value: "vote",
+    EvaluationType.auto_exact_match.value: "score",
+    EvaluationType.auto_similarity_match.value: "score",
+    EvaluationType.auto_regex_test.value: "score",
+}
+
+# Evaluation types whose scenarios hold a numeric score
+NUMERIC_SCORE_EVALUATION_TYPES = [
+    EvaluationType.custom_code_run.value,
+    EvaluationType.human_scoring.value,
+]
+
+# Strings holding a decimal number, the only legacy scores converted
+NUMERIC_SCORE_PATTERN = r"^[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?$"
+
+# Percentiles reported by the score analytics
+SCORE_PERCENTILES = (25, 50, 75, 90, 95, 99)
+
+# Stands for a missing or null value among the counter keys
+_NULL_COUNTER_KEY = "%00"
+
+
+def encode_counter_key(value: Optional[str]) -> str:
+    """Escapes a scenario value so that it can be used as a mongo field name.
+
+    Variant names may contain dots, which mongo would read as a path.
+
+    Arguments:
+        value -- the vote or score of a scenario
+
+    Returns:
+        str: the counter key
+    """
+
+    if value is None:
+        return _NULL_COUNTER_KEY
+    return str(value).replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def decode_counter_key(key: str) -> Optional[str]:
+    """Reverses `encode_counter_key`."""
+
+    if key == _NULL_COUNTER_KEY:
+        return None
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+async def increment_result_counters(
+    evaluation_id: str, increments: Dict[Optional[str], int], total: int = 0
+) -> None:
+    """Atomically adds to the result counters of an evaluation.
+
+    Only evaluations whose counters exist are touched, evaluations of a type
+    without counters are left alone.
+
+    Arguments:
+        evaluation_id -- the evaluation the counters belong to
+        increments -- the change of the count of each scenario value
+        total -- the change of the number of scenarios
+    """
+
+    inc = {
+        f"counts.{encode_counter_key(value)}": amount
+        for value, amount in increments.items()
+        if amount
+    }
+    if total:
+        inc["total"] = total
+    if not inc:
+        return
+
+    await engine.get_collection(EvaluationResultsDB).update_one(
+        {"evaluation_id": evaluation_id},
+        {"$inc": inc, "$set": {"updated_at": datetime.utcnow()}},
+    )
+
+
+async def create_result_counters(evaluation_id: str, evaluation_type: str) -> None:
+    """Creates the empty result counters of a new evaluation, if its type has any.
+
+    Arguments:
+        evaluation_id -- the new evaluation
+        evaluation_type -- the type of the evaluation
+    """
+
+    counted_field = COUNTED_RESULT_FIELDS.get(evaluation_type)
+    if counted_field is None:
+        return
+
+    await engine.save(
+        EvaluationResultsDB(
+            evaluation_id=evaluation_id,
+            counted_field=counted_field,
+            updated_at=datetime.utcnow(),
+        )
+    )
+
+
+async def record_scenario_result_change(
+    previous: Dict[str, Any], changes: Dict[str, Any]
+) -> None:
+    """Moves one unit between counters after a scenario vote or score changed.
+
+    Arguments:
+        previous -- the scenario document before the update, with at least
+            its evaluation_id, vote and score
+        changes -- the fields set by the update
+    """
+
+    for field in ("vote", "score"):
+        if field not in changes or changes[field] == previous.get(field):
+            continue
+        await engine.get_collection(EvaluationResultsDB).update_one(
+            {"evaluation_id": previous["evaluation_id"], "counted_field": field},
+            {
+                "$inc": {
+                    f"counts.{encode_counter_key(previous.get(field))}": -1,
+                    f"counts.{encode_counter_key(changes[field])}": 1,
+                },
+                "$set": {"updated_at": datetime.utcnow()},
+            },
+        )
+
+
+async def scenario_value_counts(evaluation_id: str, field: str) -> Dict[Any, int]:
+    """Counts the scenarios of an evaluation per value of a field, decoding
+    the archive of an archived evaluation.
+
+    Arguments:
+        evaluation_id -- the evaluation
+        field -- the scenario field
+
+    Returns:
+        Dict[Any, int]: the number of scenarios per value
+    """
+
+    if await is_archived(evaluation_id):
+        counts: Dict[Any, int] = {}
+        async for document in iter_archived_scenarios(evaluation_id):
+            value = document.get(field)
+            counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    pipeline = [
+        {"$match": {"evaluation_id": evaluation_id}},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+    ]
+    collection = engine.get_collection(EvaluationScenarioDB)
+    groups = await collection.aggregate(pipeline).to_list(length=None)
+    return {group["_id"]: group["count"] for group in groups}
+
+
+async def rebuild_result_counters(
+    evaluation_id: str, evaluation_type: str
+) -> Optional[Dict[str, Any]]:
+    """Recomputes the result counters of an evaluation from its scenarios.
+
+    Arguments:
+        evaluation_id -- the evaluation to reconcile
+        evaluation_type -- the type of the evaluation
+
+    Returns:
+        Optional[Dict[str, Any]]: the counters document, None when the
+        evaluation type has no counters
+    """
+
+    counted_field = COUNTED_RESULT_FIELDS.get(evaluation_type)
+    if counted_field is None:
+        return None
+
+    counts = await scenario_value_counts(evaluation_id, counted_field)
+    counters = {
+        "evaluation_id": evaluation_id,
+        "counted_field": counted_field,
+        "total": sum(counts.values()),
+        "counts": {encode_counter_key(value): count for value, count in counts.items()},
+        "updated_at": datetime.utcnow(),
+    }
+    await engine.get_collection(EvaluationResultsDB).replace_one(
+        {"evaluation_id": evaluation_id}, counters, upsert=True
+    )
+    return counters
+
+
+async def fetch_result_counters(
+    evaluation_id: str, evaluation_type: str
+) -> Tuple[int, Dict[Optional[str], int]]:
+    """Reads the result counters of an evaluation, rebuilding them when missing.
+
+    Arguments:
+        evaluation_id -- the evaluation
+        evaluation_type -- the type of the evaluation
+
+    Returns:
+        Tuple[int, Dict[Optional[str], int]]: the number of scenarios and the
+        number of scenarios per value of the counted field
+    """
+
+    counters = await engine.get_collection(EvaluationResultsDB).find_one(
+        {"evaluation_id": evaluation_id}
+    )
+    if counters is None:
+        counters = await rebuild_result_counters(evaluation_id, evaluation_type)
+
+    counts = {
+        decode_counter_key(key): count
+        for key, count in counters.get("counts", {}).items()
+    }
+    return counters.get("total", 0), counts
+
+
+async def reconcile_result_counters() -> int:
+    """Rebuilds the result counters of every evaluation that has counters.
+
+    Returns:
+        int: the number of evaluations reconciled
+    """
+
+    evaluations = engine.get_collection(EvaluationDB).find(
+        {
+            "evaluation_type": {"$in": list(COUNTED_RESULT_FIELDS)},
+            "status": {"$ne": EvaluationStatusEnum.EVALUATION_MATERIALIZING.value},
+            # The scenarios of archived evaluations no longer change
+            "archived": {"$ne": True},
+        },
+        projection={"evaluation_type": 1},
+    )
+
+    reconciled = 0
+    async for evaluation in evaluations:
+        await rebuild_result_counters(
+            str(evaluation["_id"]), evaluation["evaluation_type"]
+        )
+        reconciled += 1
+    logger.info(f"Reconciled the result counters of {reconciled} evaluation(s)")
+    return reconciled
 
 
 async def fetch_results_for_human_a_b_testing_evaluation(
@@ -7,11 +270,10 @@ async def fetch_results_for_human_a_b_testing_evaluation(
 ):
     results = {}
 
-    # Construct query expression builder for evaluation_rows_nb
-    query_exp_one = query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    ) & query.ne(EvaluationScenarioDB.vote, "")
-    evaluation_rows_nb = await engine.count(EvaluationScenarioDB, query_exp_one)
+    total, counts = await fetch_result_counters(
+        evaluation_id, EvaluationType.human_a_b_testing.value
+    )
+    evaluation_rows_nb = total - counts.get("", 0)
     if evaluation_rows_nb == 0:
         return results
 
@@ -19,11 +281,7 @@ async def fetch_results_for_human_a_b_testing_evaluation(
     results["variants_votes_data"] = {}
     results["nb_of_rows"] = evaluation_rows_nb
 
-    # Construct query expression builder for flag_votes_nb
-    query_exp_two = query.eq(EvaluationScenarioDB.vote, "0") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    flag_votes_nb = await engine.count(EvaluationScenarioDB, query_exp_two)
+    flag_votes_nb = counts.get("0", 0)
 
     # Update results dict
     results["flag_votes"] = {}
@@ -34,14 +292,7 @@ async def fetch_results_for_human_a_b_testing_evaluation(
 
     for item in variants:
         results["variants_votes_data"][item] = {}
-
-        # Construct query expression builder for variant_votes_nb
-        query_exp_three = query.eq(EvaluationScenarioDB.vote, item) & query.eq(
-            EvaluationScenarioDB.evaluation_id, evaluation_id
-        )
-        variant_votes_nb: int = await engine.count(
-            EvaluationScenarioDB, query_exp_three
-        )
+        variant_votes_nb: int = counts.get(item, 0)
         results["variants_votes_data"][item]["number_of_votes"] = variant_votes_nb
         results["variants_votes_data"][item]["percentage"] = (
             round(variant_votes_nb / evaluation_rows_nb * 100, 2)
@@ -56,11 +307,10 @@ async def fetch_results_for_auto_exact_match_evaluation(
 ):
     results = {}
 
-    # Construct query expression builder for evaluation_rows_nb
-    query_exp_one = query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    ) & query.ne(EvaluationScenarioDB.score, "")
-    evaluation_rows_nb = await engine.count(EvaluationScenarioDB, query_exp_one)
+    total, counts = await fetch_result_counters(
+        evaluation_id, EvaluationType.auto_exact_match.value
+    )
+    evaluation_rows_nb = total - counts.get("", 0)
 
     if evaluation_rows_nb == 0:
         return results
@@ -69,22 +319,10 @@ async def fetch_results_for_auto_exact_match_evaluation(
     # results["variants_scores_data"] = {}
     results["nb_of_rows"] = evaluation_rows_nb
 
-    # Construct query expression builder for correct_scores_nb
-    query_exp_two = query.eq(EvaluationScenarioDB.score, "correct") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    correct_scores_nb = await engine.count(EvaluationScenarioDB, query_exp_two)
-
-    # Construct query expression builder for wrong_scores_nb
-    query_exp_three = query.eq(EvaluationScenarioDB.score, "wrong") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    wrong_scores_nb: int = await engine.count(EvaluationScenarioDB, query_exp_three)
-
     # Update results dict
     results["scores"] = {}
-    results["scores"]["correct"] = correct_scores_nb
-    results["scores"]["wrong"] = wrong_scores_nb
+    results["scores"]["correct"] = counts.get("correct", 0)
+    results["scores"]["wrong"] = counts.get("wrong", 0)
     return results
 
 
@@ -92,11 +330,10 @@ async def fetch_results_for_auto_similarity_match_evaluation(
     evaluation_id: str, variant: str
 ):
     results = {}
-    # Construct query expression builder for evaluation_rows_nb
-    query_exp_one = query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    ) & query.ne(EvaluationScenarioDB.score, "")
-    evaluation_rows_nb = await engine.count(EvaluationScenarioDB, query_exp_one)
+    total, counts = await fetch_result_counters(
+        evaluation_id, EvaluationType.auto_similarity_match.value
+    )
+    evaluation_rows_nb = total - counts.get("", 0)
 
     if evaluation_rows_nb == 0:
         return results
@@ -104,34 +341,19 @@ async def fetch_results_for_auto_similarity_match_evaluation(
     results["variant"] = variant
     results["nb_of_rows"] = evaluation_rows_nb
 
-    # Construct query expression builder for similar_scores_nb
-    query_exp_two = query.eq(EvaluationScenarioDB.score, "true") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    similar_scores_nb = await engine.count(EvaluationScenarioDB, query_exp_two)
-
-    # Construct query expression builder for wrong_scores_nb
-    query_exp_three = query.eq(EvaluationScenarioDB.score, "false") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    dissimilar_scores_nb: int = await engine.count(
-        EvaluationScenarioDB, query_exp_three
-    )
-
     # Update results dict
     results["scores"] = {}
-    results["scores"]["true"] = similar_scores_nb
-    results["scores"]["false"] = dissimilar_scores_nb
+    results["scores"]["true"] = counts.get("true", 0)
+    results["scores"]["false"] = counts.get("false", 0)
     return results
 
 
 async def fetch_results_for_auto_regex_test(evaluation_id: str, variant: str):
     results = {}
-    # Construct query expression builder for evaluation_rows_nb
-    query_exp_one = query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    ) & query.ne(EvaluationScenarioDB.score, "")
-    evaluation_rows_nb = await engine.count(EvaluationScenarioDB, query_exp_one)
+    total, counts = await fetch_result_counters(
+        evaluation_id, EvaluationType.auto_regex_test.value
+    )
+    evaluation_rows_nb = total - counts.get("", 0)
 
     if evaluation_rows_nb == 0:
         return results
@@ -139,63 +361,361 @@ async def fetch_results_for_auto_regex_test(evaluation_id: str, variant: str):
     results["variant"] = variant
     results["nb_of_rows"] = evaluation_rows_nb
 
-    # Construct query expression builder for similar_scores_nb
-    query_exp_two = query.eq(EvaluationScenarioDB.score, "correct") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    correct_score = await engine.count(EvaluationScenarioDB, query_exp_two)
-
-    # Construct query expression builder for wrong_scores_nb
-    query_exp_three = query.eq(EvaluationScenarioDB.score, "wrong") & query.eq(
-        EvaluationScenarioDB.evaluation_id, evaluation_id
-    )
-    incorrect_score: int = await engine.count(EvaluationScenarioDB, query_exp_three)
-
     # Update results dict
     results["scores"] = {}
-    results["scores"]["correct"] = correct_score
-    results["scores"]["wrong"] = incorrect_score
+    results["scores"]["correct"] = counts.get("correct", 0)
+    results["scores"]["wrong"] = counts.get("wrong", 0)
     return results
 
 
 async def fetch_results_for_auto_webhook_test(evaluation_id: str):
+    return await scenario_value_counts(evaluation_id, "score")
+
+
+async def fetch_results_for_auto_ai_critique(evaluation_id: str):
+    return await scenario_value_counts(evaluation_id, "evaluation")
+
+
+def numeric_score_value(score: Any) -> Optional[float]:
+    """Converts a score to a float like _numeric_score does inside mongo,
+    None when it is not a number."""
+
+    if score is None:
+        return None
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return None
+
+
+def _numeric_score(on_error: Any = None) -> Dict[str, Any]:
+    """Returns the expression converting a scenario score to a double.
+
+    Scores written before they were stored as numbers are strings.
+    """
+
+    return {
+        "$convert": {
+            "input": "$score",
+            "to": "double",
+            "onError": on_error,
+            "onNull": on_error,
+        }
+    }
+
+
+async def fetch_average_score_for_custom_code_run(evaluation_id: str) -> float:
+    """Averages the scores of an evaluation inside mongo, unscored scenarios
+    counting as 0. The archive of an archived evaluation is averaged as it
+    is decoded.
+
+    Arguments:
+        evaluation_id -- the evaluation
+
+    Returns:
+        float: the average score, 0 when the evaluation has no scenarios
+    """
+
+    if await is_archived(evaluation_id):
+        scores = [
+            numeric_score_value(document.get("score")) or 0
+            async for document in iter_archived_scenarios(evaluation_id)
+        ]
+        return sum(scores) / len(scores) if scores else 0
+
     pipeline = [
         {"$match": {"evaluation_id": evaluation_id}},
-        {"$group": {"_id": "$score", "count": {"$sum": 1}}},
+        {
+            "$group": {
+                "_id": None,
+                "average_score": {"$avg": _numeric_score(0)},
+            }
+        },
     ]
-
-    results = {}
     collection = engine.get_collection(EvaluationScenarioDB)
-    aggregation_cursor = await collection.aggregate(pipeline).to_list(length=None)
-    for doc in aggregation_cursor:
-        results[doc["_id"]] = doc["count"]
+    groups = await collection.aggregate(pipeline).to_list(length=None)
+    if not groups or groups[0]["average_score"] is None:
+        return 0
+    return groups[0]["average_score"]
+
+
+def percentile_rank(percentile: float, count: int) -> int:
+    """Returns the 1-based position of a percentile among `count` sorted
+    values, using the nearest-rank method.
+
+    The same arithmetic runs inside the analytics pipeline, so the positions
+    computed here match the ones selected by mongo.
+    """
+
+    return max(1, math.ceil(percentile / 100 * count))
+
+
+async def _archived_score_analytics(
+    evaluation_id: str, bins: int, percentiles: List[float]
+) -> Dict[str, Any]:
+    """Computes the score analytics of an archived evaluation while decoding
+    its archive, with the same definitions as the mongo pipelines."""
+
+    scores: Dict[str, List[float]] = {}
+    unscored = 0
+    async for document in iter_archived_scenarios(evaluation_id):
+        score = numeric_score_value(document.get("score"))
+        if score is None:
+            unscored += 1
+            continue
+        outputs = document.get("outputs") or []
+        variant = (outputs[0].get("variant_name") if outputs else None) or ""
+        scores.setdefault(variant, []).append(score)
+
+    results: Dict[str, Any] = {
+        "nb_of_scored_rows": sum(len(values) for values in scores.values()),
+        "nb_of_unscored_rows": unscored,
+        "histogram_edges": [],
+        "variants": {},
+    }
+    if not scores:
+        return results
+
+    low = min(min(values) for values in scores.values())
+    high = max(max(values) for values in scores.values())
+    width = (high - low) / bins or 1
+    results["histogram_edges"] = [low + width * i for i in range(bins + 1)]
+
+    for variant, values in scores.items():
+        values.sort()
+        count = len(values)
+        mean = sum(values) / count
+        histogram = [0] * bins
+        for value in values:
+            histogram[min(bins - 1, math.floor((value - low) / width))] += 1
+        results["variants"][variant] = {
+            "count": count,
+            "mean": mean,
+            "stddev": math.sqrt(sum((value - mean) ** 2 for value in values) / count),
+            "min": values[0],
+            "max": values[-1],
+            "percentiles": {
+                f"p{percentile:g}": values[percentile_rank(percentile, count) - 1]
+                for percentile in percentiles
+            },
+            "histogram": histogram,
+        }
     return results
 
 
-async def fetch_results_for_auto_ai_critique(evaluation_id: str):
-    pipeline = [
+async def fetch_score_analytics(
+    evaluation_id: str, bins: int = 10, percentiles: Iterable[float] = SCORE_PERCENTILES
+) -> Dict[str, Any]:
+    """Computes the score distribution of an evaluation per variant, entirely
+    inside mongo.
+
+    The first aggregation returns the summary statistics and the values at
+    the requested percentiles, the second one a histogram with `bins` bins of
+    equal width spanning the scores of all variants. The analytics of an
+    archived evaluation are computed while decoding its archive.
+
+    Arguments:
+        evaluation_id -- the evaluation
+        bins -- the number of histogram bins
+        percentiles -- the percentiles to report, between 0 and 100
+
+    Returns:
+        Dict[str, Any]: the number of scored and unscored scenarios, the
+        histogram bin edges and the statistics of each variant
+    """
+
+    percentiles = list(percentiles)
+    if await is_archived(evaluation_id):
+        return await _archived_score_analytics(evaluation_id, bins, percentiles)
+
+    collection = engine.get_collection(EvaluationScenarioDB)
+    scores = [
         {"$match": {"evaluation_id": evaluation_id}},
-        {"$group": {"_id": "$evaluation", "count": {"$sum": 1}}},
+        {
+            "$project": {
+                "_id": 0,
+                "variant": {
+                    "$ifNull": [{"$arrayElemAt": ["$outputs.variant_name", 0]}, ""]
+                },
+                "score": _numeric_score(),
+            }
+        },
+    ]
+    scored = {"$match": {"score": {"$ne": None}}}
+
+    pipeline = scores + [
+        {
+            "$facet": {
+                "summary": [
+                    scored,
+                    {
+                        "$group": {
+                            "_id": "$variant",
+                            "count": {"$sum": 1},
+                            "mean": {"$avg": "$score"},
+                            "stddev": {"$stdDevPop": "$score"},
+                            "min": {"$min": "$score"},
+                            "max": {"$max": "$score"},
+                        }
+                    },
+                ],
+                "percentiles": [
+                    scored,
+                    {
+                        "$setWindowFields": {
+                            "partitionBy": "$variant",
+                            "sortBy": {"score": 1},
+                            "output": {
+                                "position": {"$documentNumber": {}},
+                                "count": {
+                                    "$count": {},
+                                    "window": {"documents": ["unbounded", "unbounded"]},
+                                },
+                            },
+                        }
+                    },
+                    {
+                        "$match": {
+                            "$expr": {
+                                "$in": [
+                                    "$position",
+                                    [
+                                        {
+                                            "$max": [
+                                                1,
+                                                {
+                                                    "$ceil": {
+                                                        "$multiply": [
+                                                            percentile / 100,
+                                                            "$count",
+                                                        ]
+                                                    }
+                                                },
+                                            ]
+                                        }
+                                        for percentile in percentiles
+                                    ],
+                                ]
+                            }
+                        }
+                    },
+                ],
+                "unscored": [
+                    {"$match": {"score": None}},
+                    {"$count": "count"},
+                ],
+            }
+        },
     ]
+    facets = (await collection.aggregate(pipeline).to_list(length=None))[0]
+
+    unscored = facets["unscored"][0]["count"] if facets["unscored"] else 0
+    results: Dict[str, Any] = {
+        "nb_of_scored_rows": sum(group["count"] for group in facets["summary"]),
+        "nb_of_unscored_rows": unscored,
+        "histogram_edges": [],
+        "variants": {},
+    }
+    if not facets["summary"]:
+        return results
 
-    results = {}
-    collection = engine.get_collection(EvaluationScenarioDB)
-    aggregation_cursor = await collection.aggregate(pipeline).to_list(length=None)
-    for doc in aggregation_cursor:
-        results[doc["_id"]] = doc["count"]
+    values_at = {
+        (doc["variant"], doc["position"]): doc["score"] for doc in facets["percentiles"]
+    }
+    for group in facets["summary"]:
+        results["variants"][group["_id"]] = {
+            "count": group["count"],
+            "mean": group["mean"],
+            "stddev": group["stddev"],
+            "min": group["min"],
+            "max": group["max"],
+            "percentiles": {
+                f"p{percentile:g}": values_at.get(
+                    (group["_id"], percentile_rank(percentile, group["count"]))
+                )
+                for percentile in percentiles
+            },
+            "histogram": [0] * bins,
+        }
+
+    # Bins of equal width over the range of every variant, so that the
+    # histograms of the variants can be compared
+    low = min(group["min"] for group in facets["summary"])
+    high = max(group["max"] for group in facets["summary"])
+    width = (high - low) / bins or 1
+    results["histogram_edges"] = [low + width * i for i in range(bins + 1)]
+
+    histogram_pipeline = scores + [
+        scored,
+        {
+            "$group": {
+                "_id": {
+                    "variant": "$variant",
+                    "bin": {
+                        "$min": [
+                            bins - 1,
+                            {"$floor": {"$divide": [{"$subtract": ["$score", low]}, width]}},
+                        ]
+                    },
+                },
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    async for group in collection.aggregate(histogram_pipeline):
+        variant = results["variants"][group["_id"]["variant"]]
+        variant["histogram"][int(group["_id"]["bin"])] = group["count"]
     return results
 
 
-async def fetch_average_score_for_custom_code_run(evaluation_id: str) -> float:
-    query_exp = query.eq(EvaluationScenarioDB.evaluation_id, evaluation_id)
-    eval_scenarios = await engine.find(EvaluationScenarioDB, query_exp)
-
-    list_of_scores = []
-    for scenario in eval_scenarios:
-        score = scenario.score
-        if not scenario.score:
-            score = 0
-        list_of_scores.append(round(float(score), 2))
-
-    average_score = sum(list_of_scores) / len(list_of_scores)
-    return average_score
+async def convert_legacy_scores() -> int:
+    """Converts the scores stored as numeric strings to numbers, for the
+    evaluation types with a numeric score. The other strings are left as
+    they are. Run once by the convert_legacy_scores migration.
+
+    Returns:
+        int: the number of converted scenarios
+    """
+
+    evaluation_ids = [
+        str(evaluation["_id"])
+        async for evaluation in engine.get_collection(EvaluationDB).find(
+            {"evaluation_type": {"$in": NUMERIC_SCORE_EVALUATION_TYPES}},
+            projection={"_id": 1},
+        )
+    ]
+    if not evaluation_ids:
+        return 0
+
+    collection = engine.get_collection(EvaluationScenarioDB)
+    converted = 0
+    operations = []
+
+    async def flush():
+        nonlocal converted, operations
+        result = await collection.bulk_write(operations, ordered=False)
+        converted += result.modified_count
+        operations = []
+
+    async for document in collection.find(
+        {
+            "evaluation_id": {"$in": evaluation_ids},
+            "score": {"$type": "string", "$regex": NUMERIC_SCORE_PATTERN},
+        },
+        projection={"score": 1},
+    ):
+        operations.append(
+            UpdateOne(
+                # Unless scored again in the meantime
+                {"_id": document["_id"], "score": document["score"]},
+                {"$set": {"score": float(document["score"])}},
+            )
+        )
+        if len(operations) >= settings.evaluation_scenarios_batch_size:
+            await flush()
+    if operations:
+        await flush()
+
+    if converted:
+        logger.info(f"Converted {converted} scenario score(s) to numbers")
+    return converted
@@ -1,4 +1,6 @@
-from typing import Union, Text, Dict, Any
+import hashlib
+from functools import lru_cache
+from typing import Union, Text, Dict, Any, Callable, Optional
 
 from RestrictedPython import safe_builtins, compile_restricted
 from RestrictedPython.Eval import (
@@ -10,6 +12,27 @@ from RestrictedPython.Guards import (
     full_write_guard,
 )
 
+from agenta_backend.config import settings
+from agenta_backend.services.helpers import TTLCache
+
+# Supported packages
+ALLOWED_IMPORTS = [
+    "math",
+    "random",
+    "datetime",
+    "json",
+    "jsonschema",
+    "requests",
+    "numpy",
+]
+
+# Evaluators compiled by this process, keyed by custom evaluation id and code
+# hash. Compiling an edited code drops the evaluator of its previous version
+evaluator_cache = TTLCache(
+    maxsize=settings.custom_evaluation_cache_size,
+    ttl=settings.compiled_evaluator_cache_ttl_seconds,
+)
+
 
 def is_import_safe(python_code: Text) -> bool:
     """Checks if the imports in the python code contains a system-level import.
@@ -28,12 +51,85 @@ def is_import_safe(python_code: Text) -> bool:
     return True
 
 
+@lru_cache(maxsize=None)
+def _restricted_globals() -> Dict[str, Any]:
+    """Returns the globals the evaluators run with, the allowed modules
+    imported once per process. Copied by compile_evaluator, never mutated."""
+
+    # Define the available built-ins
+    local_builtins = safe_builtins.copy()
+
+    # Add the __import__ built-in function to the local builtins
+    local_builtins["__import__"] = __import__
+
+    # Add the allowed modules to the local built-ins
+    local_builtins.update(
+        {package_name: __import__(package_name) for package_name in ALLOWED_IMPORTS}
+    )
+
+    # Define the environment for the code execution
+    return {
+        "_getiter_": default_guarded_getiter,
+        "_getitem_": default_guarded_getitem,
+        "_iter_unpack_sequence_": guarded_iter_unpack_sequence,
+        "_write_": full_write_guard,
+        "__builtins__": local_builtins,
+    }
+
+
+def compile_evaluator(code: Text) -> Callable[..., Any]:
+    """Compiles the code of a custom evaluation in a restricted environment.
+
+    Args:
+        code (Text): The Python code defining an `evaluate` function
+
+    Returns:
+        Callable: the `evaluate` function
+    """
+
+    byte_code = compile_restricted(code, filename="<inline>", mode="exec")
+    environment = dict(_restricted_globals())
+    # Each evaluator gets its own built-ins, the evaluators share none
+    environment["__builtins__"] = dict(environment["__builtins__"])
+    exec(byte_code, environment)
+    return environment["evaluate"]
+
+
+def get_evaluator(
+    code: Text, evaluation_id: Optional[str] = None
+) -> Callable[..., Any]:
+    """Returns the compiled `evaluate` function of some code, compiling it
+    on the first call only.
+
+    Args:
+        code (Text): The Python code defining an `evaluate` function
+        evaluation_id (str): The custom evaluation the code belongs to, its
+        evaluator compiled from a previous version of the code is dropped
+
+    Returns:
+        Callable: the `evaluate` function
+    """
+
+    code_hash = hashlib.sha256(code.encode()).hexdigest()
+    entry = evaluator_cache.get((evaluation_id, code_hash))
+    if entry is not None:
+        return entry[1]
+
+    evaluate = compile_evaluator(code)
+    if evaluation_id is not None:
+        # The code of the evaluation was edited
+        evaluator_cache.pop_where(lambda entry: entry[0] == evaluation_id)
+    evaluator_cache.set((evaluation_id, code_hash), (evaluation_id, evaluate))
+    return evaluate
+
+
 def execute_code_safely(
     app_params: Dict[str, str],
     inputs: Dict[str, str],
     output: str,
     correct_answer: str,
     code: Text,
+    evaluation_id: Optional[str] = None,
 ) -> Union[float, None]:
     """
     Execute the provided Python code safely using RestrictedPython.
@@ -44,54 +140,18 @@ def execute_code_safely(
         - output (str): The output of the app variant after being called.
         - correct_answer (str): The correct answer (or target) of the app variant.
         - code (Text): The Python code to be executed.
+        - evaluation_id (str): The custom evaluation the code belongs to.
 
     Returns:
     - (float): Result of the execution if successful. Should be between 0 and 1.
     - None if execution fails or result is not a float between 0 and 1.
     """
-    # Define the available built-ins
-    local_builtins = safe_builtins.copy()
-
-    # Add the __import__ built-in function to the local builtins
-    local_builtins["__import__"] = __import__
-
-    # Define supported packages
-    allowed_imports = [
-        "math",
-        "random",
-        "datetime",
-        "json",
-        "jsonschema",
-        "requests",
-        "numpy",
-    ]
-
-    # Create a dictionary to simulate allowed imports
-    allowed_modules = {}
-    for package_name in allowed_imports:
-        allowed_modules[package_name] = __import__(package_name)
-
-    # Add the allowed modules to the local built-ins
-    local_builtins.update(allowed_modules)
-
-    # Define the environment for the code execution
-    environment = {
-        "_getiter_": default_guarded_getiter,
-        "_getitem_": default_guarded_getitem,
-        "_iter_unpack_sequence_": guarded_iter_unpack_sequence,
-        "_write_": full_write_guard,
-        "__builtins__": local_builtins,
-    }
-
-    # Compile the code in a restricted environment
-    byte_code = compile_restricted(code, filename="<inline>", mode="exec")
-
-    # Execute the code
-    exec(byte_code, environment)
+    # Compiled once per code, see get_evaluator
+    evaluate = get_evaluator(code, evaluation_id)
 
     # Call the evaluation function, extract the result if it exists
     # and is a float between 0 and 1
-    result = environment["evaluate"](app_params, inputs, correct_answer, output)
+    result = evaluate(app_params, inputs, correct_answer, output)
     if isinstance(result, float) and 0 <= result <= 1:
         return result
     return None
@@ -0,0 +1,214 @@
+"""Parquet and Arrow IPC import and export of test sets, batch by batch
+"""
+import io
+import json
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import TestSetDB
+from agenta_backend.services.testset_parsers import TestSetParsingError
+from agenta_backend.services.testset_service import iter_testset_chunks
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # columnar formats are refused rather than failing to start
+    pa = None
+
+COLUMNAR_FORMATS = ("parquet", "arrow")
+
+MEDIA_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+class ColumnarFormatUnavailable(Exception):
+    """Custom exception for columnar files sent to a backend without pyarrow."""
+
+    pass
+
+
+def require_pyarrow() -> None:
+    """Raises ColumnarFormatUnavailable when pyarrow is not installed."""
+
+    if pa is None:
+        raise ColumnarFormatUnavailable(
+            "Parquet and Arrow test sets need pyarrow installed on the backend"
+        )
+
+
+def _to_string(value: Any) -> Optional[str]:
+    """Converts a value without a string cast, a nested value to JSON."""
+
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return json.dumps(value, default=str)
+
+
+def _string_column(column: "pa.Array") -> List[str]:
+    """Converts a column to the strings stored in test set rows, nulls
+    becoming empty strings."""
+
+    try:
+        strings = pc.cast(column, pa.string())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # Nested values, and binary values that are not UTF-8
+        strings = pa.array(
+            [_to_string(value) for value in column.to_pylist()], pa.string()
+        )
+    return pc.fill_null(strings, "").to_pylist()
+
+
+def batch_to_rows(batch: "pa.RecordBatch") -> List[Dict[str, str]]:
+    """Converts a record batch to test set rows, column by column."""
+
+    columns = [_string_column(column) for column in batch.columns]
+    names = batch.schema.names
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+async def _iter_batch_rows(
+    batches: Iterator["pa.RecordBatch"],
+) -> AsyncIterator[Dict[str, str]]:
+    """Reads record batches in a worker thread and yields their rows."""
+
+    while True:
+        try:
+            batch = await run_in_threadpool(next, batches, None)
+        except pa.ArrowException as e:
+            raise TestSetParsingError(f"Invalid columnar file: {e}") from e
+        if batch is None:
+            return
+        for row in batch_to_rows(batch):
+            yield row
+
+
+def _open_arrow(source: Any) -> Iterator["pa.RecordBatch"]:
+    """Opens an Arrow IPC file, in the file format or in the stream format."""
+
+    try:
+        reader = ipc.open_file(source)
+    except pa.ArrowInvalid:
+        source.seek(0)
+        return iter(ipc.open_stream(source))
+    return (
+        reader.get_batch(index) for index in range(reader.num_record_batches)
+    )
+
+
+async def iter_columnar_rows(
+    file: UploadFile, file_format: str
+) -> AsyncIterator[Dict[str, str]]:
+    """Reads an uploaded Parquet or Arrow IPC file in record batches.
+
+    Arguments:
+        file -- the uploaded file, spooled by starlette so it can be seeked
+        file_format -- "parquet" or "arrow"
+
+    Raises:
+        ColumnarFormatUnavailable: pyarrow is not installed
+        TestSetParsingError: the file cannot be read
+
+    Yields:
+        Dict[str, str]: the rows, their values as strings
+    """
+
+    require_pyarrow()
+    try:
+        if file_format == "parquet":
+            parquet_file = await run_in_threadpool(pq.ParquetFile, file.file)
+            batches = parquet_file.iter_batches(
+                batch_size=settings.testset_rows_chunk_size
+            )
+        else:
+            batches = await run_in_threadpool(_open_arrow, file.file)
+    except pa.ArrowException as e:
+        raise TestSetParsingError(f"Invalid {file_format} file: {e}") from e
+
+    async for row in _iter_batch_rows(batches):
+        yield row
+
+
+class _StreamSink(io.RawIOBase):
+    """Write-only file collecting what the pyarrow writers output, drained
+    after each batch so the export is streamed."""
+
+    def __init__(self):
+        super().__init__()
+        self._parts: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+async def iter_columnar_export(
+    testset: TestSetDB, file_format: str
+) -> AsyncIterator[bytes]:
+    """Streams a test set as a Parquet file or an Arrow IPC stream, one
+    record batch (and Parquet row group) per stored chunk of rows, its
+    columns built by pyarrow from the rows of the chunk document.
+
+    The columns are the ones of the first row, all of them strings.
+
+    Arguments:
+        testset -- the test set to export
+        file_format -- "parquet" or "arrow"
+
+    Yields:
+        bytes: the file, piece by piece
+    """
+
+    require_pyarrow()
+    sink = _StreamSink()
+    schema = None
+    writer = None
+
+    async for rows in iter_testset_chunks(testset):
+        if not rows:
+            continue
+        if writer is None:
+            schema = pa.schema([(name, pa.string()) for name in rows[0]])
+            writer = (
+                pq.ParquetWriter(sink, schema)
+                if file_format == "parquet"
+                else ipc.new_stream(sink, schema)
+            )
+        batch = pa.RecordBatch.from_pylist(rows, schema=schema)
+        if file_format == "parquet":
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.drain()
+
+    if writer is None:
+        # Empty test set
+        schema = pa.schema([])
+        writer = (
+            pq.ParquetWriter(sink, schema)
+            if file_format == "parquet"
+            else ipc.new_stream(sink, schema)
+        )
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,284 @@
+"""Streaming, resumable import of test sets from remote endpoints
+
+The rows of an import are written to testset_rows as they arrive, and the
+number of rows stored is checkpointed in testset_imports after each chunk.
+An import interrupted by a network failure, or by a restart of the backend,
+resumes from its checkpoint when the same import is requested again. The
+rows are registered as a content, and the test set created, only once every
+row is written.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterable, AsyncIterator, Dict
+
+import httpx
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import (
+    TestSetDB,
+    TestSetImportDB,
+    TestSetRowsChunkDB,
+    UserDB,
+)
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.http_client import backoff, get_http_client
+from agenta_backend.services.testset_parsers import (
+    TestSetParsingError,
+    check_columns,
+    iter_json_rows,
+)
+from agenta_backend.services.testset_service import (
+    CONTENT_ROWS_VERSION,
+    delete_testset_rows,
+    register_content,
+    stored_rows_hash,
+    write_testset_rows,
+)
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Statuses worth retrying, the endpoint may answer later
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+
+class TestSetImportError(Exception):
+    """Custom exception for endpoints not serving a test set."""
+
+    pass
+
+
+class TestSetImportInProgress(Exception):
+    """Custom exception for an import already run by another request."""
+
+    pass
+
+
+class TestSetImportInterrupted(Exception):
+    """Custom exception for an import stopped by network failures, resumed
+    when requested again."""
+
+    pass
+
+
+class _RemoteUnavailable(Exception):
+    pass
+
+
+async def _skip(
+    rows: AsyncIterable[Dict[str, Any]], count: int
+) -> AsyncIterator[Dict[str, Any]]:
+    """Skips the first rows of a stream."""
+
+    skipped = 0
+    async for row in rows:
+        if skipped < count:
+            skipped += 1
+            continue
+        yield row
+
+
+async def claim_import(
+    user: UserDB, app_name: str, name: str, endpoint: str
+) -> Dict[str, Any]:
+    """Starts an import, or takes over the checkpoint of an interrupted one.
+
+    Arguments:
+        user -- the owner of the test set
+        app_name -- the app of the test set
+        name -- the name of the test set
+        endpoint -- the URL the rows are read from
+
+    Raises:
+        TestSetImportInProgress: the same import is run by another request
+
+    Returns:
+        Dict[str, Any]: the import checkpoint document
+    """
+
+    now = datetime.utcnow()
+    collection = engine.get_collection(TestSetImportDB)
+    try:
+        return await collection.find_one_and_update(
+            {
+                "user": user.id,
+                "app_name": app_name,
+                "name": name,
+                "endpoint": endpoint,
+                "lease_expires_at": {"$lte": now},
+            },
+            {
+                "$set": {
+                    "lease_expires_at": now
+                    + timedelta(seconds=settings.testset_import_lease_seconds),
+                    "updated_at": now,
+                },
+                "$setOnInsert": {
+                    "testset_id": ObjectId(),
+                    "rows_key": ObjectId(),
+                    "rows_written": 0,
+                    "validator": None,
+                    "created_at": now,
+                },
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError as e:
+        # The import exists and its lease is held
+        raise TestSetImportInProgress(
+            f"The import of {name} from {endpoint} is already running"
+        ) from e
+
+
+async def import_rows(job: Dict[str, Any]) -> int:
+    """Streams the rows of an import into testset_rows, from its checkpoint.
+
+    The stream is requested again after a network failure, up to
+    `settings.http_client_retries` times, skipping the rows already stored.
+    When the remote data changed in between, as told by its ETag or
+    Last-Modified header, the import starts over.
+
+    Arguments:
+        job -- the import checkpoint document
+
+    Raises:
+        TestSetImportError: the endpoint does not serve a test set
+        TestSetParsingError: the endpoint does not serve valid JSON rows
+        TestSetImportInterrupted: the endpoint could not be read
+
+    Returns:
+        int: the number of rows of the test set
+    """
+
+    imports = engine.get_collection(TestSetImportDB)
+    chunks = engine.get_collection(TestSetRowsChunkDB)
+    rows_key = job["rows_key"]
+    written = job["rows_written"]
+    validator = job.get("validator")
+
+    async def checkpoint(rows_written: int, **updates: Any):
+        nonlocal written
+        written = rows_written
+        now = datetime.utcnow()
+        await imports.update_one(
+            {"_id": job["_id"]},
+            {
+                "$set": {
+                    **updates,
+                    "rows_written": rows_written,
+                    "lease_expires_at": now
+                    + timedelta(seconds=settings.testset_import_lease_seconds),
+                    "updated_at": now,
+                }
+            },
+        )
+
+    attempt = 0
+    while True:
+        # Drop the chunk written after the last checkpoint, if any
+        await chunks.delete_many(
+            {
+                "testset_id": rows_key,
+                "version": CONTENT_ROWS_VERSION,
+                "first_row": {"$gte": written},
+            }
+        )
+        try:
+            async with get_http_client().stream("GET", job["endpoint"]) as response:
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    raise _RemoteUnavailable(f"status {response.status_code}")
+                if response.status_code != 200:
+                    raise TestSetImportError("Failed to fetch testset from endpoint")
+
+                remote_validator = response.headers.get(
+                    "etag", response.headers.get("last-modified")
+                )
+                if remote_validator != validator:
+                    if written:
+                        logger.info(
+                            f"Data of {job['endpoint']} changed, importing it again"
+                        )
+                    validator = remote_validator
+                    await checkpoint(0, validator=validator)
+                    await chunks.delete_many({"testset_id": rows_key})
+
+                rows = check_columns(iter_json_rows(response.aiter_bytes()))
+                await write_testset_rows(
+                    rows_key,
+                    CONTENT_ROWS_VERSION,
+                    _skip(rows, written),
+                    first_row=written,
+                    on_flush=checkpoint,
+                )
+                return written
+
+        except (httpx.TransportError, _RemoteUnavailable) as e:
+            attempt += 1
+            if attempt > settings.http_client_retries:
+                raise TestSetImportInterrupted(
+                    f"Import of {job['endpoint']} interrupted after {written} rows: {e}"
+                ) from e
+            logger.warning(
+                f"Import of {job['endpoint']} failed after {written} rows ({e}), "
+                f"retrying (attempt {attempt})"
+            )
+            await backoff(attempt)
+
+
+async def import_testset(
+    endpoint: str, name: str, app_name: str, user: UserDB
+) -> TestSetDB:
+    """Imports a test set from an endpoint serving a JSON array or JSON lines.
+
+    Arguments:
+        endpoint -- the URL the rows are read from
+        name -- the name of the test set
+        app_name -- the app of the test set
+        user -- the owner of the test set
+
+    Returns:
+        TestSetDB: the created test set
+    """
+
+    imports = engine.get_collection(TestSetImportDB)
+    job = await claim_import(user, app_name, name, endpoint)
+
+    try:
+        row_count = await import_rows(job)
+    except (TestSetImportError, TestSetParsingError):
+        # Requesting it again would fail the same way
+        await delete_testset_rows(job["rows_key"])
+        await imports.delete_one({"_id": job["_id"]})
+        raise
+    except Exception:
+        # Keep the checkpoint, and let the next request resume right away
+        await imports.update_one(
+            {"_id": job["_id"]}, {"$set": {"lease_expires_at": datetime.utcnow()}}
+        )
+        raise
+
+    # Deduplicate the rows like the uploaded ones
+    content_hash = await stored_rows_hash(job["rows_key"], CONTENT_ROWS_VERSION)
+    content_id = await register_content(job["rows_key"], content_hash, row_count)
+
+    testset = TestSetDB(
+        id=job["testset_id"],
+        name=name,
+        app_name=app_name,
+        row_count=row_count,
+        rows_version=1,
+        last_rows_version=1,
+        rows_key=content_id,
+        content_id=content_id,
+        content_hash=content_hash,
+        user=user,
+        created_at=job["created_at"],
+    )
+    await engine.save(testset)
+    await imports.delete_one({"_id": job["_id"]})
+    return testset
@@ -0,0 +1,241 @@
+"""Incremental parsers turning a stream of bytes into test set rows
+"""
+import codecs
+import csv
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Optional
+
+from fastapi import UploadFile
+
+from agenta_backend.config import settings
+
+
+class TestSetParsingError(Exception):
+    """Custom exception for malformed test set files."""
+
+    pass
+
+
+async def iter_upload_chunks(
+    file: UploadFile, chunk_size: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    """Reads an uploaded file in bounded chunks.
+
+    Arguments:
+        file -- the uploaded file
+        chunk_size -- the size of a chunk, `settings.testset_upload_chunk_bytes` by default
+
+    Yields:
+        bytes: the chunks of the file
+    """
+
+    chunk_size = chunk_size or settings.testset_upload_chunk_bytes
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def iter_text(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Decodes UTF-8 chunks, characters split across two chunks included.
+
+    A leading byte order mark is dropped.
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    try:
+        async for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+    except UnicodeDecodeError as e:
+        raise TestSetParsingError(f"The file is not valid UTF-8: {e}") from e
+    if text:
+        yield text
+
+
+async def iter_csv_rows(chunks: AsyncIterable[bytes]) -> AsyncIterator[Dict[str, str]]:
+    """Parses a CSV stream whose first line holds the column names.
+
+    Lines are parsed once the quotes they hold are balanced, so quoted
+    values spanning several lines or chunks are kept whole.
+
+    Arguments:
+        chunks -- the CSV file, in chunks
+
+    Raises:
+        TestSetParsingError: a row does not have one value per column
+
+    Yields:
+        Dict[str, str]: the rows, empty lines excepted
+    """
+
+    columns: Optional[List[str]] = None
+    line_number = 0
+    partial_line = ""
+    # Complete lines not parsed yet, and the quotes they hold
+    lines: List[str] = []
+    quotes = 0
+
+    def parse(records: List[str]):
+        nonlocal columns, line_number
+        for values in csv.reader(records):
+            line_number += 1
+            if not values:
+                continue
+            if columns is None:
+                columns = values
+                continue
+            if len(values) != len(columns):
+                raise TestSetParsingError(
+                    f"Row {line_number} has {len(values)} values, "
+                    f"expected {len(columns)} ({', '.join(columns)})"
+                )
+            yield dict(zip(columns, values))
+
+    async for text in iter_text(chunks):
+        *complete_lines, partial_line = (partial_line + text).split("\n")
+        balanced = None
+        for line in complete_lines:
+            lines.append(line + "\n")
+            quotes += line.count('"')
+            if quotes % 2 == 0:
+                balanced = len(lines)
+        if balanced is not None:
+            for row in parse(lines[:balanced]):
+                yield row
+            lines = lines[balanced:]
+
+    if partial_line:
+        lines.append(partial_line)
+    for row in parse(lines):
+        yield row
+
+
+async def iter_json_rows(chunks: AsyncIterable[bytes]) -> AsyncIterator[Dict[str, Any]]:
+    """Parses a stream holding either a JSON array of objects or JSON lines.
+
+    Arguments:
+        chunks -- the JSON file, in chunks
+
+    Raises:
+        TestSetParsingError: the stream is not a JSON array or JSON lines,
+            or holds something else than objects
+
+    Yields:
+        Dict[str, Any]: the rows
+    """
+
+    decoder = json.JSONDecoder()
+    texts = iter_text(chunks)
+    buffer = ""
+    position = 0
+    exhausted = False
+    row_number = 0
+
+    async def read_more() -> bool:
+        nonlocal buffer, position, exhausted
+        if exhausted:
+            return False
+        try:
+            text = await texts.__anext__()
+        except StopAsyncIteration:
+            exhausted = True
+            return False
+        buffer = buffer[position:] + text
+        position = 0
+        return True
+
+    async def skip_whitespace() -> Optional[str]:
+        """Returns the next significant character, None at the end of the stream"""
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not await read_more():
+                return None
+
+    async def decode_value() -> Any:
+        nonlocal position
+        await skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # The value may continue in the next chunk
+                if await read_more():
+                    continue
+                raise TestSetParsingError(f"Invalid JSON: {e}") from e
+            # A number at the end of the buffer may be cut
+            if end == len(buffer) and not exhausted and await read_more():
+                continue
+            position = end
+            return value
+
+    def check_row(value: Any) -> Dict[str, Any]:
+        nonlocal row_number
+        row_number += 1
+        if not isinstance(value, dict):
+            raise TestSetParsingError(f"Row {row_number} is not a JSON object")
+        return value
+
+    first = await skip_whitespace()
+    if first is None:
+        return
+
+    if first == "{":
+        # JSON lines
+        while await skip_whitespace() is not None:
+            yield check_row(await decode_value())
+        return
+
+    if first != "[":
+        raise TestSetParsingError("The JSON file should hold an array of objects")
+    position += 1
+
+    if await skip_whitespace() == "]":
+        position += 1
+    else:
+        while True:
+            yield check_row(await decode_value())
+            separator = await skip_whitespace()
+            position += 1
+            if separator == "]":
+                break
+            if separator != ",":
+                raise TestSetParsingError(
+                    f"Expected ',' or ']' after row {row_number}"
+                )
+
+    if await skip_whitespace() is not None:
+        raise TestSetParsingError("Unexpected data after the JSON array")
+
+
+async def check_columns(
+    rows: AsyncIterable[Dict[str, Any]]
+) -> AsyncIterator[Dict[str, Any]]:
+    """Checks that every row has the columns of the first row.
+
+    Raises:
+        TestSetParsingError: a row has different columns
+
+    Yields:
+        Dict[str, Any]: the rows
+    """
+
+    columns = None
+    row_number = 0
+    async for row in rows:
+        row_number += 1
+        if columns is None:
+            columns = set(row)
+        elif set(row) != columns:
+            raise TestSetParsingError(
+                f"Row {row_number} has the columns {', '.join(sorted(row))}, "
+                f"expected {', '.join(sorted(columns))}"
+            )
+        yield row
@@ -0,0 +1,242 @@
+"""Selection of test set rows in the database: column filters, and seeded
+random samples, stratified by a column or not
+"""
+import re
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from agenta_backend.config import settings
+from agenta_backend.models.api.testset_model import (
+    TestsetRowFilter,
+    TestsetRowFilterOperator,
+    TestsetRowsSelection,
+)
+from agenta_backend.models.db_models import TestSetDB, TestSetRowsChunkDB
+from agenta_backend.services.db_manager import engine
+from agenta_backend.services.testset_service import (
+    rows_location,
+    testset_row_count,
+    write_rows_version,
+)
+
+# Modulus of the row scores, a prime below 2**31 so squares fit in an int64
+SCORE_MODULUS = 2147483647
+
+
+class RowsSelectionError(Exception):
+    """Custom exception for selections the rows cannot be filtered with."""
+
+    pass
+
+
+def row_field(column: str) -> str:
+    """Returns the path of a column in the unwound rows.
+
+    Raises:
+        RowsSelectionError: the column name cannot be used as a field path
+    """
+
+    if not column or "." in column or column.startswith("$"):
+        raise RowsSelectionError(f"Cannot select rows on the column {column!r}")
+    return f"row.{column}"
+
+
+def row_filter_condition(row_filter: TestsetRowFilter) -> Dict[str, Any]:
+    """Translates a column filter to a query condition on the unwound rows."""
+
+    field = row_field(row_filter.column)
+    value = row_filter.value
+    operator = row_filter.operator
+    if operator in (TestsetRowFilterOperator.in_, TestsetRowFilterOperator.not_in):
+        values = value if isinstance(value, list) else [value]
+        if operator == TestsetRowFilterOperator.in_:
+            return {field: {"$in": values}}
+        return {field: {"$nin": values}}
+
+    if isinstance(value, list):
+        raise RowsSelectionError(
+            f"The {operator.value} operator takes a single value"
+        )
+    if operator == TestsetRowFilterOperator.ne:
+        return {field: {"$ne": value}}
+    if operator == TestsetRowFilterOperator.contains:
+        return {field: {"$regex": re.escape(value)}}
+    return {field: value}
+
+
+def row_score(seed: int) -> Dict[str, Any]:
+    """Returns an expression giving each row a pseudo random score from its
+    index and the seed, the sample being the rows with the lowest scores.
+
+    Two rounds of squaring modulo a prime mix the index and the seed, which
+    a linear expression would not: samples of different seeds overlap no
+    more than random ones.
+    """
+
+    salt = (seed * seed * 69621 + seed * 48271 + 12345) % SCORE_MODULUS
+
+    def square(value: Any, offset: Any) -> Dict[str, Any]:
+        return {
+            "$mod": [
+                {"$add": [{"$multiply": [value, value]}, offset]},
+                SCORE_MODULUS,
+            ]
+        }
+
+    first = {
+        "$mod": [
+            {"$add": [{"$multiply": [{"$add": ["$index", 1]}, 48271]}, salt]},
+            SCORE_MODULUS,
+        ]
+    }
+    second = {"$let": {"vars": {"first": first}, "in": square("$$first", salt)}}
+    return {"$let": {"vars": {"second": second}, "in": square("$$second", "$index")}}
+
+
+def allocate_strata(counts: Dict[Any, int], sample_size: int) -> Dict[Any, int]:
+    """Splits a sample between strata in proportion to their sizes, with the
+    largest remainder method.
+
+    Arguments:
+        counts -- the number of rows of each stratum
+        sample_size -- the size of the whole sample
+
+    Returns:
+        Dict[Any, int]: the number of rows to sample in each stratum
+    """
+
+    total = sum(counts.values())
+    if sample_size >= total:
+        return dict(counts)
+
+    quotas = {stratum: sample_size * count // total for stratum, count in counts.items()}
+    remainders = sorted(
+        counts,
+        key=lambda stratum: (-(sample_size * counts[stratum] % total), str(stratum)),
+    )
+    for stratum in remainders[: sample_size - sum(quotas.values())]:
+        quotas[stratum] += 1
+    return quotas
+
+
+async def _no_rows() -> AsyncIterator[Tuple[int, Dict[str, str]]]:
+    return
+    yield
+
+
+async def _count(collection, pipeline: List[Dict[str, Any]]) -> int:
+    """Counts the documents a pipeline outputs."""
+
+    documents = collection.aggregate(pipeline + [{"$count": "count"}], allowDiskUse=True)
+    counted = [document async for document in documents]
+    return counted[0]["count"] if counted else 0
+
+
+async def select_testset_rows(
+    testset: TestSetDB, selection: TestsetRowsSelection
+) -> Tuple[int, AsyncIterator[Tuple[int, Dict[str, str]]]]:
+    """Selects rows of a test set, the filtering and the sampling being done
+    by mongo so only the selected rows are sent back.
+
+    Arguments:
+        testset -- the test set to read
+        selection -- the filters and the sample to take
+
+    Raises:
+        RowsSelectionError: a column cannot be selected on, or too many strata
+
+    Returns:
+        the number of selected rows, and the (index, row) of the selected rows
+        in the order of the test set
+    """
+
+    if testset.rows_version == 0:
+        # Rows still inline, move them to chunks first
+        await write_rows_version(testset.id, testset.csvdata)
+        document = await engine.get_collection(TestSetDB).find_one({"_id": testset.id})
+        for field in ("rows_version", "row_count", "rows_key", "content_id"):
+            setattr(testset, field, document.get(field))
+
+    rows_key, rows_version = rows_location(testset)
+    collection = engine.get_collection(TestSetRowsChunkDB)
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": {"testset_id": rows_key, "version": rows_version}},
+        {"$sort": {"first_row": 1}},
+        {"$unwind": {"path": "$rows", "includeArrayIndex": "offset"}},
+        {
+            "$project": {
+                "_id": 0,
+                "row": "$rows",
+                "index": {"$add": ["$first_row", "$offset"]},
+            }
+        },
+    ]
+    conditions = [row_filter_condition(row_filter) for row_filter in selection.filters]
+    if conditions:
+        pipeline.append({"$match": {"$and": conditions}})
+
+    sample_size = selection.sample_size
+    if selection.stratify_by is not None and sample_size is not None:
+        stratum = {"$ifNull": [f"${row_field(selection.stratify_by)}", None]}
+        strata = collection.aggregate(
+            pipeline + [{"$group": {"_id": stratum, "count": {"$sum": 1}}}],
+            allowDiskUse=True,
+        )
+        counts = {document["_id"]: document["count"] async for document in strata}
+        if len(counts) > settings.testset_selection_max_strata:
+            raise RowsSelectionError(
+                f"{selection.stratify_by} has {len(counts)} values, "
+                f"at most {settings.testset_selection_max_strata} strata are supported"
+            )
+        quotas = allocate_strata(counts, sample_size)
+        total = sum(quotas.values())
+        if total == 0:
+            return 0, _no_rows()
+        quota = {
+            "$switch": {
+                "branches": [
+                    {"case": {"$eq": [stratum, value]}, "then": count}
+                    for value, count in quotas.items()
+                ],
+                "default": 0,
+            }
+        }
+        pipeline += [
+            {"$addFields": {"score": row_score(selection.seed)}},
+            {
+                "$setWindowFields": {
+                    "partitionBy": stratum,
+                    "sortBy": {"score": 1, "index": 1},
+                    "output": {"rank": {"$documentNumber": {}}},
+                }
+            },
+            {"$match": {"$expr": {"$lte": ["$rank", quota]}}},
+            {"$sort": {"index": 1}},
+        ]
+
+    elif sample_size is not None:
+        if conditions:
+            total = min(sample_size, await _count(collection, pipeline))
+        else:
+            total = min(sample_size, testset_row_count(testset))
+        # Top k sort, only the sample is kept in memory
+        pipeline += [
+            {"$addFields": {"score": row_score(selection.seed)}},
+            {"$sort": {"score": 1, "index": 1}},
+            {"$limit": sample_size},
+            {"$sort": {"index": 1}},
+        ]
+
+    elif conditions:
+        total = await _count(collection, pipeline)
+
+    else:
+        total = testset_row_count(testset)
+
+    async def selected_rows():
+        documents = collection.aggregate(
+            pipeline + [{"$project": {"index": 1, "row": 1}}], allowDiskUse=True
+        )
+        async for document in documents:
+            yield document["index"], document["row"]
+
+    return total, selected_rows()
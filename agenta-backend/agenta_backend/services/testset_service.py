@@ -0,0 +1,1061 @@
+"""Storage of the test set rows, in chunks kept next to the test set document
+
+Rows are stored as contents: chunks written once under a content id, and
+registered in testset_contents by the hash of their rows. Test sets with the
+same rows reference the same content. Contents are never modified, editing
+the rows of a test set writes them as a new content.
+
+Each chunk keeps the hash of each of its rows, and the hash of a test set is
+the hash of the hashes of all its rows in order, so it does not depend on how
+the rows are chunked, and an edit only hashes again the rows it changed.
+"""
+import hashlib
+import json
+import logging
+from bisect import bisect_right
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import (
+    TestSetContentDB,
+    TestSetDB,
+    TestSetRowsChunkDB,
+    TestSetUploadDB,
+    UserDB,
+)
+from agenta_backend.services.db_manager import engine
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+Rows = Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]]
+
+# Test sets whose rows are still inline in the test set document
+INLINE_ROWS_FILTER = {"$or": [{"rows_version": {"$exists": False}}, {"rows_version": 0}]}
+
+# Version of the chunks of a content, contents are never rewritten
+CONTENT_ROWS_VERSION = 0
+
+# Number of chunks copied per insert_many, a few tens of MB at most
+COPY_BATCH_SIZE = 8
+
+# Size of the hash of a row, a sha256 digest
+ROW_HASH_SIZE = 32
+
+
+async def _iterate(rows: Rows) -> AsyncIterator[Dict[str, Any]]:
+    """Iterates over synchronous and asynchronous row iterables alike."""
+
+    if hasattr(rows, "__aiter__"):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
+
+
+def estimate_row_size(row: Dict[str, Any]) -> int:
+    """Roughly estimates the size of a row once encoded to BSON, in bytes."""
+
+    return sum(len(str(key)) + len(str(value)) + 16 for key, value in row.items())
+
+
+def row_hash(row: Dict[str, Any]) -> bytes:
+    """Hashes a row, the order of its columns included."""
+
+    encoded = json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).digest()
+
+
+def row_hashes(rows: Iterable[Dict[str, Any]]) -> bytes:
+    """Concatenates the hashes of rows, as kept on their chunk."""
+
+    return b"".join(row_hash(row) for row in rows)
+
+
+async def _chunked(rows: Rows) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Groups rows in chunks of `settings.testset_rows_chunk_size` rows or
+    about `settings.testset_rows_chunk_bytes` bytes."""
+
+    chunk: List[Dict[str, Any]] = []
+    chunk_bytes = 0
+    async for row in _iterate(rows):
+        chunk.append(row)
+        chunk_bytes += estimate_row_size(row)
+        if (
+            len(chunk) >= settings.testset_rows_chunk_size
+            or chunk_bytes >= settings.testset_rows_chunk_bytes
+        ):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+    if chunk:
+        yield chunk
+
+
+class TestSetUploadExpired(Exception):
+    """Custom exception for uploads stalled for so long that the orphan
+    cleanup dropped their rows."""
+
+    pass
+
+
+def _upload_lease() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=settings.testset_upload_lease_seconds)
+
+
+@asynccontextmanager
+async def pending_rows(key: ObjectId) -> AsyncIterator[Callable[..., Awaitable[None]]]:
+    """Marks the chunks written under a key as pending until they are
+    referenced, so the orphan cleanup leaves them alone.
+
+    Arguments:
+        key -- the key the chunks are written under
+
+    Yields:
+        renews the lease of the marker, to call after each chunk
+
+    Raises:
+        TestSetUploadExpired: the lease expired before being renewed
+    """
+
+    uploads = engine.get_collection(TestSetUploadDB)
+    marker = TestSetUploadDB(
+        rows_key=key, lease_expires_at=_upload_lease(), created_at=datetime.utcnow()
+    ).doc()
+    await uploads.insert_one(marker)
+
+    async def renew(*args: Any) -> None:
+        result = await uploads.update_one(
+            {"_id": marker["_id"]}, {"$set": {"lease_expires_at": _upload_lease()}}
+        )
+        if result.matched_count == 0:
+            raise TestSetUploadExpired(f"The rows written under {key} were dropped")
+
+    try:
+        yield renew
+    finally:
+        await uploads.delete_one({"_id": marker["_id"]})
+
+
+async def write_testset_rows(
+    testset_id: ObjectId,
+    version: int,
+    rows: Rows,
+    first_row: int = 0,
+    on_flush: Optional[Callable[[int], Awaitable[None]]] = None,
+    digest: Optional[Any] = None,
+) -> int:
+    """Writes rows as chunks of the given key and version.
+
+    A chunk is flushed once it holds `settings.testset_rows_chunk_size` rows
+    or about `settings.testset_rows_chunk_bytes` bytes, well below the 16 MB
+    document limit of mongo.
+
+    Arguments:
+        testset_id -- the key of the chunks, a content id
+        version -- the version of the chunks
+        rows -- the rows, possibly streamed
+        first_row -- the index of the first row, to append to written chunks
+        on_flush -- called with the number of rows stored after each chunk
+        digest -- a hashlib hash updated with the hash of each row
+
+    Returns:
+        int: the number of rows written
+    """
+
+    collection = engine.get_collection(TestSetRowsChunkDB)
+    written = 0
+    async for chunk in _chunked(rows):
+        document = TestSetRowsChunkDB(
+            testset_id=testset_id,
+            version=version,
+            first_row=first_row + written,
+            rows=chunk,
+        ).doc()
+        document["row_hashes"] = row_hashes(document["rows"])
+        await collection.insert_one(document)
+        if digest is not None:
+            digest.update(document["row_hashes"])
+        written += len(chunk)
+        if on_flush is not None:
+            await on_flush(first_row + written)
+    return written
+
+
+async def register_content(key: ObjectId, content_hash: str, row_count: int) -> ObjectId:
+    """Registers the chunks written under a key as a content, or drops them
+    when a content with the same rows is already stored.
+
+    Arguments:
+        key -- the key the chunks were written under
+        content_hash -- the hash of the rows
+        row_count -- the number of rows
+
+    Returns:
+        ObjectId: the id of the content holding the rows, with a new reference
+    """
+
+    contents = engine.get_collection(TestSetContentDB)
+    while True:
+        existing = await contents.find_one_and_update(
+            {"content_hash": content_hash},
+            {"$inc": {"refs": 1}},
+            projection={"_id": 1},
+        )
+        if existing is not None:
+            if existing["_id"] != key:
+                await delete_testset_rows(key)
+            return existing["_id"]
+
+        try:
+            await contents.insert_one(
+                TestSetContentDB(
+                    id=key,
+                    content_hash=content_hash,
+                    row_count=row_count,
+                    refs=1,
+                    created_at=datetime.utcnow(),
+                ).doc()
+            )
+            return key
+        except DuplicateKeyError:
+            # Registered in the meantime by another writer, reference it
+            continue
+
+
+async def store_rows(rows: Rows) -> Tuple[ObjectId, int, str]:
+    """Stores rows as a content, deduplicated by the hash of the rows.
+
+    Arguments:
+        rows -- the rows, possibly streamed
+
+    Returns:
+        Tuple[ObjectId, int, str]: the content id, the number of rows and
+        their hash
+    """
+
+    key = ObjectId()
+    digest = hashlib.sha256()
+    async with pending_rows(key) as renew:
+        try:
+            row_count = await write_testset_rows(
+                key, CONTENT_ROWS_VERSION, rows, on_flush=renew, digest=digest
+            )
+            # Fails, rather than referencing dropped rows, once expired
+            await renew()
+        except Exception:
+            await delete_testset_rows(key)
+            raise
+
+        content_hash = digest.hexdigest()
+        content_id = await register_content(key, content_hash, row_count)
+    return content_id, row_count, content_hash
+
+
+async def release_content(content_id: ObjectId, count: int = 1) -> None:
+    """Drops references to a content, deleting its rows with the last one.
+
+    Arguments:
+        content_id -- the content no longer referenced
+        count -- the number of references dropped
+    """
+
+    contents = engine.get_collection(TestSetContentDB)
+    content = await contents.find_one_and_update(
+        {"_id": content_id},
+        {"$inc": {"refs": -count}},
+        projection={"refs": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if content is None or content["refs"] > 0:
+        return
+
+    # Unless referenced again in the meantime
+    result = await contents.delete_one({"_id": content_id, "refs": {"$lte": 0}})
+    if result.deleted_count:
+        await delete_testset_rows(content_id)
+
+
+async def _release_rows(
+    testset_id: ObjectId,
+    content_id: Optional[ObjectId],
+    rows_key: Optional[ObjectId],
+) -> None:
+    if content_id is not None:
+        await release_content(content_id)
+    elif rows_key is not None:
+        await delete_testset_rows(rows_key)
+    else:
+        # Chunks written under the test set id, before contents
+        await delete_testset_rows(testset_id)
+
+
+async def release_testset_rows(testset: TestSetDB) -> None:
+    """Releases the rows of a deleted test set: its reference to a content,
+    or the chunks it owns.
+
+    Arguments:
+        testset -- the deleted test set
+    """
+
+    await _release_rows(testset.id, testset.content_id, testset.rows_key)
+
+
+async def delete_testsets(filters: Dict[str, Any]) -> List[ObjectId]:
+    """Deletes the test sets matching a filter with one delete_many, then
+    releases their rows: one release per content, whatever the number of
+    test sets sharing it, and one delete_many for the chunks they own.
+
+    Arguments:
+        filters -- the query selecting the test sets
+
+    Returns:
+        List[ObjectId]: the ids of the deleted test sets
+    """
+
+    collection = engine.get_collection(TestSetDB)
+    documents = [
+        document
+        async for document in collection.find(
+            filters, projection={"content_id": 1, "rows_key": 1}
+        )
+    ]
+    if not documents:
+        return []
+
+    testset_ids = [document["_id"] for document in documents]
+    await collection.delete_many({"_id": {"$in": testset_ids}})
+
+    released = Counter(
+        document["content_id"]
+        for document in documents
+        if document.get("content_id") is not None
+    )
+    for content_id, count in released.items():
+        await release_content(content_id, count)
+    owned_keys = [
+        document.get("rows_key") or document["_id"]
+        for document in documents
+        if document.get("content_id") is None
+    ]
+    if owned_keys:
+        await engine.get_collection(TestSetRowsChunkDB).delete_many(
+            {"testset_id": {"$in": owned_keys}}
+        )
+    return testset_ids
+
+
+async def create_testset(
+    name: str,
+    app_name: str,
+    rows: Rows,
+    user: UserDB,
+    created_at: Optional[Union[datetime, str]] = None,
+) -> TestSetDB:
+    """Creates a test set and writes its rows.
+
+    Arguments:
+        name -- the name of the test set
+        app_name -- the app the test set belongs to
+        rows -- the rows, possibly streamed
+        user -- the owner of the test set
+        created_at -- the creation date, now by default
+
+    Returns:
+        TestSetDB: the created test set
+    """
+
+    content_id, row_count, content_hash = await store_rows(rows)
+    testset = TestSetDB(
+        name=name,
+        app_name=app_name,
+        row_count=row_count,
+        rows_version=1,
+        last_rows_version=1,
+        rows_key=content_id,
+        content_id=content_id,
+        content_hash=content_hash,
+        user=user,
+        created_at=created_at or datetime.utcnow(),
+    )
+    try:
+        await engine.save(testset)
+    except Exception:
+        await release_content(content_id)
+        raise
+    return testset
+
+
+async def reserve_rows_version(testset_id: ObjectId) -> int:
+    """Hands out a version no other writer of the test set will use.
+
+    Arguments:
+        testset_id -- the test set about to be written
+
+    Returns:
+        int: the reserved version
+    """
+
+    testset = await engine.get_collection(TestSetDB).find_one_and_update(
+        {"_id": testset_id},
+        {"$inc": {"last_rows_version": 1}},
+        projection={"last_rows_version": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return testset["last_rows_version"]
+
+
+async def _make_rows_current(
+    testset_id: ObjectId,
+    rows_filter: Dict[str, Any],
+    version: int,
+    content_id: ObjectId,
+    row_count: int,
+    content_hash: str,
+    updates: Optional[Dict[str, Any]] = None,
+) -> bool:
+    """Points a test set to a stored content, in one atomic update, then
+    releases its previous rows.
+
+    Arguments:
+        testset_id -- the test set to update
+        rows_filter -- the condition on the current rows of the test set
+        version -- the new rows version
+        content_id -- the content holding the new rows
+        row_count -- the number of rows of the content
+        content_hash -- the hash of the rows of the content
+        updates -- other test set fields to set along with the new version
+
+    Returns:
+        bool: whether the content was made current, it is released otherwise
+    """
+
+    previous = await engine.get_collection(TestSetDB).find_one_and_update(
+        {"_id": testset_id, **rows_filter},
+        {
+            "$set": {
+                **(updates or {}),
+                "csvdata": [],
+                "row_count": row_count,
+                "rows_version": version,
+                "rows_key": content_id,
+                "content_id": content_id,
+                "content_hash": content_hash,
+            }
+        },
+        projection={"content_id": 1, "rows_key": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if previous is None:
+        await release_content(content_id)
+        return False
+
+    await _release_rows(testset_id, previous.get("content_id"), previous.get("rows_key"))
+    return True
+
+
+async def write_rows_version(
+    testset_id: ObjectId, rows: Rows, updates: Optional[Dict[str, Any]] = None
+) -> Optional[int]:
+    """Stores the rows of a test set as a new content, and makes it current
+    once complete, so readers never see a half written test set.
+
+    When two writers race, the most recent version wins and the content of
+    the other one is released.
+
+    Arguments:
+        testset_id -- the test set to write
+        rows -- the new rows, possibly streamed
+        updates -- other test set fields to set along with the new version
+
+    Returns:
+        Optional[int]: the number of rows written, None when a more recent
+        version was made current in the meantime
+    """
+
+    version = await reserve_rows_version(testset_id)
+    content_id, row_count, content_hash = await store_rows(rows)
+
+    current = await _make_rows_current(
+        testset_id,
+        {"$or": [{"rows_version": {"$lt": version}}, *INLINE_ROWS_FILTER["$or"]]},
+        version,
+        content_id,
+        row_count,
+        content_hash,
+        updates,
+    )
+    return row_count if current else None
+
+
+async def replace_testset_rows(
+    testset: TestSetDB, rows: Rows, name: Optional[str] = None
+) -> int:
+    """Replaces every row of a test set.
+
+    Arguments:
+        testset -- the test set to update
+        rows -- the new rows, possibly streamed
+        name -- the new name of the test set, unchanged by default
+
+    Returns:
+        int: the number of rows written
+    """
+
+    updates: Dict[str, Any] = {"updated_at": datetime.utcnow()}
+    if name is not None:
+        updates["name"] = name
+    row_count = await write_rows_version(testset.id, rows, updates=updates)
+    return row_count or 0
+
+
+def rows_location(testset: TestSetDB) -> Tuple[ObjectId, int]:
+    """Returns the key and the version of the chunks holding the rows of a
+    test set."""
+
+    if testset.rows_key is not None:
+        return testset.rows_key, CONTENT_ROWS_VERSION
+    return testset.id, testset.rows_version
+
+
+class TestSetPatchError(Exception):
+    """Custom exception for patches referring to rows that do not exist."""
+
+    pass
+
+
+class TestSetPatchConflict(Exception):
+    """Custom exception for patches of test sets whose rows changed while
+    being patched."""
+
+    pass
+
+
+async def _chunk_sizes(testset_id: ObjectId, version: int) -> List[Dict[str, Any]]:
+    """Lists the chunks of a test set version with their number of rows,
+    without reading the rows."""
+
+    chunks = engine.get_collection(TestSetRowsChunkDB).aggregate(
+        [
+            {"$match": {"testset_id": testset_id, "version": version}},
+            {"$project": {"first_row": 1, "size": {"$size": "$rows"}}},
+            {"$sort": {"first_row": 1}},
+        ]
+    )
+    return [chunk async for chunk in chunks]
+
+
+def _chunk_starts(chunks: List[Dict[str, Any]]) -> List[int]:
+    """Returns the index of the first row of each chunk, given their sizes."""
+
+    return list(accumulate((chunk["size"] for chunk in chunks[:-1]), initial=0))
+
+
+def _locate(
+    chunks: List[Dict[str, Any]], starts: List[int], index: int
+) -> Tuple[Dict[str, Any], int]:
+    """Finds the chunk holding a row.
+
+    Returns:
+        the chunk and the position of the row in it
+    """
+
+    position = bisect_right(starts, index) - 1
+    return chunks[position], index - starts[position]
+
+
+def _chunk_bounds(rows: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+    """Splits rows like `_chunked`, in chunks of
+    `settings.testset_rows_chunk_size` rows or about
+    `settings.testset_rows_chunk_bytes` bytes.
+
+    Returns:
+        List[Tuple[int, int]]: the start and stop indexes of each chunk
+    """
+
+    bounds = []
+    start = 0
+    chunk_bytes = 0
+    for index, row in enumerate(rows):
+        chunk_bytes += estimate_row_size(row)
+        if (
+            index + 1 - start >= settings.testset_rows_chunk_size
+            or chunk_bytes >= settings.testset_rows_chunk_bytes
+        ):
+            bounds.append((start, index + 1))
+            start = index + 1
+            chunk_bytes = 0
+    if start < len(rows):
+        bounds.append((start, len(rows)))
+    return bounds
+
+
+def _edit_chunk(
+    document: Dict[str, Any], chunk: Dict[str, Any]
+) -> Tuple[List[Dict[str, Any]], List[bytes]]:
+    """Applies the edits planned on a chunk to a copy of its rows, hashing
+    only the rows it changes.
+
+    Arguments:
+        document -- the stored chunk, with its rows and their hashes
+        chunk -- the planned updates, deletes and inserts of the chunk
+
+    Returns:
+        the edited rows and their hashes
+    """
+
+    rows = list(document["rows"])
+    hashes = document.get("row_hashes")
+    if hashes is None:
+        hashes = [row_hash(row) for row in rows]
+    else:
+        hashes = [
+            hashes[offset : offset + ROW_HASH_SIZE]
+            for offset in range(0, len(hashes), ROW_HASH_SIZE)
+        ]
+    for position, row in chunk["updates"].items():
+        rows[position] = row
+        hashes[position] = row_hash(row)
+    kept = [
+        position for position in range(len(rows)) if position not in chunk["deletes"]
+    ]
+    rows = [rows[position] for position in kept]
+    hashes = [hashes[position] for position in kept]
+    for position, row in chunk["inserts"]:
+        rows.insert(position, row)
+        hashes.insert(position, row_hash(row))
+    return rows, hashes
+
+
+async def patch_testset_rows(
+    testset: TestSetDB,
+    updates: Optional[List[Tuple[int, Dict[str, Any]]]] = None,
+    deletes: Optional[Iterable[int]] = None,
+    inserts: Optional[List[Tuple[Optional[int], Dict[str, Any]]]] = None,
+    name: Optional[str] = None,
+) -> int:
+    """Edits some rows of a test set.
+
+    Updates and deletes refer to the row indexes before the patch. Inserts
+    are applied next, in order, each at an index of the test set as it is
+    then, at the end when no index is given.
+
+    The patched rows are written as a new content, made current once
+    complete like by `write_rows_version`, so readers never see a half
+    applied patch and the stored chunks are never modified. Only the chunks
+    holding edited rows are split again and have their edited rows hashed,
+    the other chunks are copied as they are stored.
+
+    Arguments:
+        testset -- the test set to edit
+        updates -- the (index, row) replacing rows
+        deletes -- the indexes of the rows to delete
+        inserts -- the (index, row) to insert
+        name -- the new name of the test set, unchanged by default
+
+    Raises:
+        TestSetPatchError: an index is out of the test set
+        TestSetPatchConflict: the rows of the test set changed during the patch
+
+    Returns:
+        int: the number of rows of the test set after the patch
+    """
+
+    updates = updates or []
+    deletes = sorted(set(deletes or []))
+    inserts = inserts or []
+    collection = engine.get_collection(TestSetRowsChunkDB)
+
+    if testset.rows_version == 0:
+        # Rows still inline, move them to chunks first
+        await write_rows_version(testset.id, testset.csvdata)
+        document = await engine.get_collection(TestSetDB).find_one(
+            {"_id": testset.id},
+            projection={
+                "rows_version": 1,
+                "row_count": 1,
+                "rows_key": 1,
+                "content_id": 1,
+                "content_hash": 1,
+            },
+        )
+        testset.rows_version = document["rows_version"]
+        testset.row_count = document["row_count"]
+        testset.rows_key = document["rows_key"]
+        testset.content_id = document["content_id"]
+        testset.content_hash = document["content_hash"]
+        testset.csvdata = []
+    rows_key, rows_version = rows_location(testset)
+
+    row_count = testset.row_count
+    for index in [index for index, _ in updates] + deletes:
+        if not 0 <= index < row_count:
+            raise TestSetPatchError(f"Row {index} does not exist")
+
+    # Plan the edits of each chunk, without reading the rows
+    chunks = await _chunk_sizes(rows_key, rows_version)
+    if sum(chunk["size"] for chunk in chunks) != testset.row_count:
+        # Released by a newer version since the test set was read
+        raise TestSetPatchConflict(f"The rows of test set {testset.id} changed")
+    for chunk in chunks:
+        chunk.update(updates={}, deletes=set(), inserts=[])
+    starts = _chunk_starts(chunks)
+    for index, row in updates:
+        chunk, position = _locate(chunks, starts, index)
+        chunk["updates"][position] = row
+    for index in deletes:
+        chunk, position = _locate(chunks, starts, index)
+        chunk["deletes"].add(position)
+        chunk["size"] -= 1
+    # The chunks left empty are not written
+    chunks = [chunk for chunk in chunks if chunk["size"] > 0]
+    row_count -= len(deletes)
+
+    # Insert the new rows in the chunks holding their index, appended rows
+    # going to the last chunk
+    for index, row in inserts:
+        index = row_count if index is None else index
+        if not 0 <= index <= row_count:
+            raise TestSetPatchError(f"Cannot insert a row at {index}")
+        if not chunks:
+            chunks.append(
+                {"_id": None, "size": 0, "updates": {}, "deletes": set(), "inserts": []}
+            )
+        if index < row_count:
+            chunk, position = _locate(chunks, _chunk_starts(chunks), index)
+        else:
+            chunk, position = chunks[-1], chunks[-1]["size"]
+        chunk["inserts"].append((position, row))
+        chunk["size"] += 1
+        row_count += 1
+
+    plans = {chunk["_id"]: chunk for chunk in chunks}
+    key = ObjectId()
+    digest = hashlib.sha256()
+    async with pending_rows(key) as renew:
+        try:
+            batch: List[Dict[str, Any]] = []
+            first_row = 0
+
+            async def write(document: Dict[str, Any]) -> None:
+                nonlocal batch, first_row
+                document.update(
+                    testset_id=key, version=CONTENT_ROWS_VERSION, first_row=first_row
+                )
+                digest.update(document["row_hashes"])
+                batch.append(document)
+                first_row += len(document["rows"])
+                if len(batch) >= COPY_BATCH_SIZE:
+                    await collection.insert_many(batch)
+                    await renew()
+                    batch = []
+
+            async def write_edited(document: Dict[str, Any], chunk: Dict[str, Any]):
+                rows, hashes = _edit_chunk(document, chunk)
+                for start, stop in _chunk_bounds(rows):
+                    await write(
+                        {
+                            "rows": rows[start:stop],
+                            "row_hashes": b"".join(hashes[start:stop]),
+                        }
+                    )
+
+            documents = collection.find(
+                {"testset_id": rows_key, "version": rows_version},
+                projection={"rows": 1, "row_hashes": 1},
+                sort=[("first_row", 1)],
+            )
+            async for document in documents:
+                chunk = plans.get(document.pop("_id"))
+                if chunk is None:
+                    continue
+                if chunk["updates"] or chunk["deletes"] or chunk["inserts"]:
+                    await write_edited(document, chunk)
+                else:
+                    if document.get("row_hashes") is None:
+                        document["row_hashes"] = row_hashes(document["rows"])
+                    await write(document)
+            if None in plans:
+                # Rows inserted in a test set left empty
+                await write_edited({"rows": []}, plans[None])
+            if batch:
+                await collection.insert_many(batch)
+            # Fails, rather than referencing dropped rows, once expired
+            await renew()
+        except Exception:
+            await delete_testset_rows(key)
+            raise
+
+        content_hash = digest.hexdigest()
+        content_id = await register_content(key, content_hash, row_count)
+
+    testset_updates: Dict[str, Any] = {"updated_at": datetime.utcnow()}
+    if name is not None:
+        testset_updates["name"] = name
+    version = await reserve_rows_version(testset.id)
+    current = await _make_rows_current(
+        testset.id,
+        {"rows_version": testset.rows_version},
+        version,
+        content_id,
+        row_count,
+        content_hash,
+        testset_updates,
+    )
+    if not current:
+        raise TestSetPatchConflict(
+            f"The rows of test set {testset.id} changed during the patch"
+        )
+
+    testset.rows_version = version
+    testset.rows_key = content_id
+    testset.content_id = content_id
+    testset.content_hash = content_hash
+    testset.row_count = row_count
+    return row_count
+
+
+def testset_row_count(testset: TestSetDB) -> int:
+    """Returns the number of rows of a test set, inline or chunked."""
+
+    if testset.rows_version == 0:
+        return len(testset.csvdata)
+    return testset.row_count
+
+
+async def iter_stored_rows(
+    rows_key: ObjectId, rows_version: int, start: int = 0, stop: Optional[int] = None
+) -> AsyncIterator[Dict[str, str]]:
+    """Streams the rows of the chunks of a key and version, one chunk in
+    memory at a time.
+
+    Arguments:
+        rows_key -- the key of the chunks
+        rows_version -- the version of the chunks
+        start -- the index of the first row to read
+        stop -- the index after the last row to read, the end by default
+
+    Yields:
+        Dict[str, str]: the rows in order
+    """
+
+    collection = engine.get_collection(TestSetRowsChunkDB)
+    filters: Dict[str, Any] = {"testset_id": rows_key, "version": rows_version}
+
+    # Start from the chunk holding the first requested row
+    first_chunk = await collection.find_one(
+        {**filters, "first_row": {"$lte": start}},
+        projection={"first_row": 1},
+        sort=[("first_row", -1)],
+    )
+    first_row_filter: Dict[str, int] = {
+        "$gte": first_chunk["first_row"] if first_chunk else 0
+    }
+    if stop is not None:
+        first_row_filter["$lt"] = stop
+
+    chunks = collection.find(
+        {**filters, "first_row": first_row_filter}, projection={"_id": 0}
+    ).sort("first_row", 1)
+    async for chunk in chunks:
+        chunk_start = chunk["first_row"]
+        for offset, row in enumerate(chunk["rows"]):
+            index = chunk_start + offset
+            if index < start:
+                continue
+            if stop is not None and index >= stop:
+                return
+            yield row
+
+
+async def iter_testset_rows(
+    testset: TestSetDB, start: int = 0, stop: Optional[int] = None
+) -> AsyncIterator[Dict[str, str]]:
+    """Streams the rows of a test set, one chunk in memory at a time.
+
+    Arguments:
+        testset -- the test set to read
+        start -- the index of the first row to read
+        stop -- the index after the last row to read, the end by default
+
+    Yields:
+        Dict[str, str]: the rows in order
+    """
+
+    if testset.rows_version == 0:
+        for row in testset.csvdata[start:stop]:
+            yield row
+        return
+
+    rows_key, rows_version = rows_location(testset)
+    async for row in iter_stored_rows(rows_key, rows_version, start, stop):
+        yield row
+
+
+async def iter_testset_chunks(
+    testset: TestSetDB,
+) -> AsyncIterator[List[Dict[str, str]]]:
+    """Streams the rows of a test set chunk by chunk, as stored, the inline
+    rows in slices of `settings.testset_rows_chunk_size`.
+
+    Arguments:
+        testset -- the test set to read
+
+    Yields:
+        List[Dict[str, str]]: the rows of each chunk, in order
+    """
+
+    if testset.rows_version == 0:
+        size = settings.testset_rows_chunk_size
+        for start in range(0, len(testset.csvdata), size):
+            yield testset.csvdata[start : start + size]
+        return
+
+    rows_key, rows_version = rows_location(testset)
+    chunks = engine.get_collection(TestSetRowsChunkDB).find(
+        {"testset_id": rows_key, "version": rows_version},
+        projection={"_id": 0, "rows": 1},
+    ).sort("first_row", 1)
+    async for chunk in chunks:
+        yield chunk["rows"]
+
+
+async def read_testset_rows(
+    testset: TestSetDB, start: int = 0, stop: Optional[int] = None
+) -> List[Dict[str, str]]:
+    """Reads the rows of a test set into a list, see `iter_testset_rows`."""
+
+    return [row async for row in iter_testset_rows(testset, start, stop)]
+
+
+async def hash_rows(rows: Rows) -> str:
+    """Hashes rows not stored yet, like stored_rows_hash hashes them once
+    stored.
+
+    Returns:
+        str: the hex digest
+    """
+
+    digest = hashlib.sha256()
+    async for row in _iterate(rows):
+        digest.update(row_hash(row))
+    return digest.hexdigest()
+
+
+async def stored_rows_hash(rows_key: ObjectId, rows_version: int) -> str:
+    """Hashes the rows of the chunks of a key and version from the row hashes
+    kept on the chunks, hashing the rows of the chunks written without them.
+
+    Arguments:
+        rows_key -- the key of the chunks
+        rows_version -- the version of the chunks
+
+    Returns:
+        str: the hex digest
+    """
+
+    collection = engine.get_collection(TestSetRowsChunkDB)
+    chunks = collection.find(
+        {"testset_id": rows_key, "version": rows_version},
+        projection={"row_hashes": 1},
+        sort=[("first_row", 1)],
+    )
+    digest = hashlib.sha256()
+    async for chunk in chunks:
+        hashes = chunk.get("row_hashes")
+        if hashes is None:
+            document = await collection.find_one(
+                {"_id": chunk["_id"]}, projection={"rows": 1}
+            )
+            hashes = row_hashes(document["rows"])
+            await collection.update_one(
+                {"_id": chunk["_id"]}, {"$set": {"row_hashes": hashes}}
+            )
+        digest.update(hashes)
+    return digest.hexdigest()
+
+
+async def testset_content_hash(testset: TestSetDB) -> str:
+    """Returns the hash of the rows of a test set, to tell whether they changed.
+
+    The hash is kept on the test set, and kept current by the edits in
+    place. It is only computed for the test sets stored without it.
+
+    Arguments:
+        testset -- the test set
+
+    Returns:
+        str: the hex digest of the hashes of the rows
+    """
+
+    if testset.content_hash is None:
+        if testset.rows_version == 0:
+            content_hash = await hash_rows(testset.csvdata)
+        else:
+            content_hash = await stored_rows_hash(*rows_location(testset))
+        await engine.get_collection(TestSetDB).update_one(
+            {"_id": testset.id, "rows_version": testset.rows_version},
+            {"$set": {"content_hash": content_hash}},
+        )
+        testset.content_hash = content_hash
+    return testset.content_hash
+
+
+async def delete_testset_rows(rows_key: ObjectId) -> None:
+    """Deletes every row chunk written under a key.
+
+    Arguments:
+        rows_key -- a content id, or the id of a test set written before contents
+    """
+
+    await engine.get_collection(TestSetRowsChunkDB).delete_many(
+        {"testset_id": rows_key}
+    )
+
+
+async def migrate_inline_testsets() -> int:
+    """Moves the rows of the test sets created before chunking into testset_rows.
+
+    A test set is switched to its chunks only after they are all written, so
+    an interrupted migration is resumed from scratch on the next run.
+
+    Returns:
+        int: the number of migrated test sets
+    """
+
+    collection = engine.get_collection(TestSetDB)
+    legacy_testsets = collection.find(INLINE_ROWS_FILTER, projection={"csvdata": 1})
+
+    migrated = 0
+    async for testset in legacy_testsets:
+        row_count = await write_rows_version(
+            testset["_id"], testset.get("csvdata") or []
+        )
+        if row_count is not None:
+            migrated += 1
+
+    if migrated:
+        logger.info(f"Moved the rows of {migrated} test set(s) to chunks")
+    return migrated
@@ -1,4 +1,4 @@
-from agenta_backend.services.db_manager import engine, UserDB
+from agenta_backend.services.db_manager import engine, UserDB, invalidate_user_cache
 from agenta_backend.models.api.user_models import User, UserUpdate
 from agenta_backend.services.organization_service import get_organization
 
@@ -22,6 +22,7 @@ async def update_user(user_uid: str, payload: UserUpdate) -> UserDB:
         values_to_update = {key: value for key, value in payload.dict()}
         updated_user = user.update(values_to_update)
         await engine.save(updated_user)
+        invalidate_user_cache(user_uid)
         return user
     raise NotFound("Credentials not found. Please try again!")
 
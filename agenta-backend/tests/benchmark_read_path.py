@@ -0,0 +1,163 @@
+"""Compares the per-document CPU cost of the odmantic read path with the raw
+read path of db_reads, on synthetic documents shaped like motor returns them.
+
+Run with: python tests/benchmark_read_path.py [number_of_documents]
+"""
+import sys
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from agenta_backend.models.api.evaluation_model import Evaluation
+from agenta_backend.models.api.testset_model import TestSetOutputResponse
+from agenta_backend.models.db_models import EvaluationDB, TestSetDB
+from agenta_backend.services import db_reads
+
+
+def now():
+    # Mongo stores datetimes with a millisecond precision
+    moment = datetime.utcnow()
+    return moment.replace(microsecond=moment.microsecond // 1000 * 1000)
+
+
+def user_document():
+    # The referenced user, as embedded by the $lookup odmantic runs on find
+    return {
+        "_id": ObjectId(),
+        "uid": "0",
+        "username": "user",
+        "email": "user@example.com",
+        "org": {"_id": ObjectId(), "name": "org", "description": ""},
+    }
+
+
+def evaluation_document():
+    return {
+        "_id": ObjectId(),
+        "status": "EVALUATION_FINISHED",
+        "evaluation_type": "human_a_b_testing",
+        "custom_code_evaluation_id": None,
+        "evaluation_type_settings": {
+            "similarity_threshold": 0.0,
+            "regex_pattern": "",
+            "regex_should_match": True,
+            "webhook_url": "",
+        },
+        "llm_app_prompt_template": "Tell me about {country}",
+        "variants": ["v1", "v2"],
+        "app_name": "app",
+        "testset": {"_id": str(ObjectId()), "name": "countries"},
+        "materialization": {"total": 100, "materialized": 100, "rows_per_second": None},
+        "user": user_document(),
+        "created_at": now(),
+        "updated_at": now(),
+    }
+
+
+def testset_document(rows):
+    return {
+        "_id": ObjectId(),
+        "name": "countries",
+        "app_name": "app",
+        "csvdata": [
+            {"country": f"country {i}", "correct_answer": "-"} for i in range(rows)
+        ],
+        "user": user_document(),
+        "created_at": now(),
+        "updated_at": now(),
+    }
+
+
+def odm_evaluations(documents):
+    evaluations = [EvaluationDB.parse_doc(document) for document in documents]
+    content = [
+        Evaluation(
+            id=str(evaluation.id),
+            status=evaluation.status,
+            evaluation_type=evaluation.evaluation_type,
+            custom_code_evaluation_id=evaluation.custom_code_evaluation_id,
+            evaluation_type_settings=evaluation.evaluation_type_settings,
+            llm_app_prompt_template=evaluation.llm_app_prompt_template,
+            variants=evaluation.variants,
+            app_name=evaluation.app_name,
+            testset=evaluation.testset,
+            materialization=evaluation.materialization,
+            created_at=evaluation.created_at,
+            updated_at=evaluation.updated_at,
+        )
+        for evaluation in evaluations
+    ]
+    return JSONResponse(content=jsonable_encoder(content)).body
+
+
+def raw_evaluations(documents):
+    content = [db_reads.evaluation_document_to_json(document) for document in documents]
+    return db_reads.RawJSONResponse(content=content).body
+
+
+def odm_testsets(documents):
+    testsets = [TestSetDB.parse_doc(document) for document in documents]
+    content = [
+        TestSetOutputResponse(
+            id=str(testset.id),
+            name=testset.name,
+            app_name=testset.app_name,
+            created_at=testset.created_at,
+        )
+        for testset in testsets
+    ]
+    return JSONResponse(content=jsonable_encoder(content, by_alias=True)).body
+
+
+def raw_testsets(documents):
+    # The projection leaves the rows on the server
+    projected = [
+        {key: document[key] for key in ("_id", "name", "app_name", "created_at")}
+        for document in documents
+    ]
+    content = [db_reads.testset_document_to_json(document) for document in projected]
+    return db_reads.RawJSONResponse(content=content).body
+
+
+def per_document_microseconds(function, documents, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(documents)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(documents) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    cases = [
+        (
+            "evaluations",
+            [evaluation_document() for _ in range(count)],
+            odm_evaluations,
+            raw_evaluations,
+        ),
+        (
+            "testsets (100 rows each)",
+            [testset_document(100) for _ in range(count // 10)],
+            odm_testsets,
+            raw_testsets,
+        ),
+    ]
+    encoder = "orjson" if db_reads.orjson is not None else "json"
+    print(f"raw path encoder: {encoder}")
+    for name, documents, odm, raw in cases:
+        odm_cost = per_document_microseconds(odm, documents)
+        raw_cost = per_document_microseconds(raw, documents)
+        print(
+            f"{name}: odmantic {odm_cost:.1f} us/doc, raw {raw_cost:.1f} us/doc, "
+            f"{odm_cost / raw_cost:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,19 @@
+import atexit
+import os
+
 import pytest
 from fastapi.testclient import TestClient
 
+if "MONGODB_URI" not in os.environ:
+    # Without a database server, the tests run against an in-memory mongod
+    from pymongo_inmemory import Mongod
+    from pymongo_inmemory.context import Context
+
+    mongod = Mongod(Context())
+    mongod.start()
+    atexit.register(mongod.stop)
+    os.environ["MONGODB_URI"] = mongod.connection_string
+
 from agenta_backend.models.db_engine import DBEngine
 from agenta_backend.main import app
 
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from agenta_backend.services import ai_critique
+from agenta_backend.services.ai_critique import (
+    AICritiqueAuthError,
+    AICritiqueError,
+    TokenBucket,
+    build_critique_prompt,
+    critique,
+)
+from agenta_backend.services.helpers import TTLCache
+
+INPUTS = [{"input_name": "country", "input_value": "France"}]
+
+
+def test_build_critique_prompt():
+    prompt = build_critique_prompt(
+        "Capital of {country}",
+        INPUTS,
+        "Paris",
+        "Paris",
+        "Is {app_variant_output} the capital of {country}? Expected {correct_answer}",
+    )
+    assert prompt == "Is Paris the capital of France? Expected Paris"
+
+
+def test_build_critique_prompt_unknown_variable():
+    with pytest.raises(AICritiqueError):
+        build_critique_prompt("", INPUTS, None, "Paris", "Is {city} right?")
+
+
+def test_token_bucket():
+    async def acquire_all():
+        bucket = TokenBucket(rate=50.0, capacity=2)
+        started = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # Two at once, then one every 20ms
+    assert 0.03 < asyncio.run(acquire_all()) < 0.5
+
+
+def _fake_openai(monkeypatch, statuses):
+    """Answers completions with the next status, the prompt echoed."""
+
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        status = statuses.pop(0) if statuses else 200
+        body = json.loads(request.content)
+        return httpx.Response(
+            status, json={"choices": [{"text": f"  {body['prompt']}\n"}]}
+        )
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(ai_critique, "get_critique_client", lambda: client)
+    monkeypatch.setattr(ai_critique, "_buckets", TTLCache())
+    monkeypatch.setattr(ai_critique, "_semaphore", None)
+    return calls
+
+
+def test_critique_retries(monkeypatch):
+    async def no_wait(attempt, jitter=False):
+        pass
+
+    monkeypatch.setattr(ai_critique, "backoff", no_wait)
+    calls = _fake_openai(monkeypatch, [429, 503])
+    assert asyncio.run(critique("Is Paris right?", "sk-test")) == "Is Paris right?"
+    assert len(calls) == 3
+    assert calls[0].url.path.endswith("/completions")
+    assert calls[0].headers["authorization"] == "Bearer sk-test"
+
+
+@pytest.mark.parametrize(
+    "status, error", [(401, AICritiqueAuthError), (400, AICritiqueError)]
+)
+def test_critique_errors(monkeypatch, status, error):
+    calls = _fake_openai(monkeypatch, [status])
+    with pytest.raises(error):
+        asyncio.run(critique("Is Paris right?", "sk-test"))
+    assert len(calls) == 1
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from agenta_backend.services import ai_critique_cache
+from agenta_backend.services.ai_critique import AICritiqueError
+from agenta_backend.services.ai_critique_cache import (
+    cached_critique,
+    critique_cache_key,
+)
+
+
+def test_critique_cache_key():
+    key = critique_cache_key("Is Paris right?", 0.9)
+    assert key == critique_cache_key("Is Paris right?", 0.9)
+    assert key != critique_cache_key("Is Paris right?", 0.0)
+    assert key != critique_cache_key("Is Lyon right?", 0.9)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Replaces the verdicts collection with a dict."""
+
+    verdicts = {}
+
+    async def get_cached_verdict(key):
+        return verdicts.get(key)
+
+    async def cache_verdict(key, verdict):
+        verdicts[key] = verdict
+
+    monkeypatch.setattr(ai_critique_cache, "get_cached_verdict", get_cached_verdict)
+    monkeypatch.setattr(ai_critique_cache, "cache_verdict", cache_verdict)
+    return verdicts
+
+
+def test_cached_critique(cache):
+    calls = []
+
+    async def critique():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "correct"
+
+    async def critique_twice():
+        # The second call waits for the completion of the first one
+        together = await asyncio.gather(
+            cached_critique("key", critique), cached_critique("key", critique)
+        )
+        return together, await cached_critique("key", critique)
+
+    together, later = asyncio.run(critique_twice())
+    assert together == ["correct", "correct"]
+    assert later == "correct"
+    assert len(calls) == 1
+    assert cache == {"key": "correct"}
+
+
+def test_cached_critique_error(cache):
+    async def critique():
+        raise AICritiqueError("AI critique failed: status 503")
+
+    async def critique_twice():
+        return await asyncio.gather(
+            cached_critique("key", critique),
+            cached_critique("key", critique),
+            return_exceptions=True,
+        )
+
+    errors = asyncio.run(critique_twice())
+    assert all(isinstance(error, AICritiqueError) for error in errors)
+    assert cache == {}
+
+
+def test_cached_critique_cancelled(cache):
+    calls = []
+
+    async def critique():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "correct"
+
+    async def cancel_first():
+        first = asyncio.create_task(cached_critique("key", critique))
+        await asyncio.sleep(0.01)
+        # The second call takes over the completion of the cancelled one
+        second = asyncio.create_task(cached_critique("key", critique))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(cancel_first()) == "correct"
+    assert len(calls) == 2
+    assert cache == {"key": "correct"}
+
+
+def test_cached_critique_bypass(cache):
+    cache["key"] = "incorrect"
+
+    async def critique():
+        return "correct"
+
+    async def rescore():
+        return await cached_critique("key", critique, bypass=True)
+
+    assert asyncio.run(rescore()) == "correct"
+    assert cache == {"key": "correct"}
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import (
+    EvaluationScenarioDB,
+    EvaluationTypeSettings,
+)
+from agenta_backend.services import auto_evaluators, results_service
+from agenta_backend.services.auto_evaluators import (
+    AutoEvaluationError,
+    build_scorer,
+    score_evaluation,
+    score_pairs,
+    similarity,
+)
+
+
+def test_similarity():
+    assert similarity("the cat sat", "the cat") == 2 / 3
+    assert similarity("Paris", "Paris") == 1.0
+    assert similarity("Paris", "") == 0.0
+
+
+def test_exact_match_scorer():
+    score = build_scorer("auto_exact_match", EvaluationTypeSettings())
+    assert score("Paris", "Paris") == "correct"
+    assert score("paris", "Paris") == "wrong"
+
+
+def test_similarity_scorer():
+    score = build_scorer(
+        "auto_similarity_match", EvaluationTypeSettings(similarity_threshold=0.5)
+    )
+    assert score("the cat sat", "the cat") == "true"
+    assert score("a dog", "the cat") == "false"
+
+
+@pytest.mark.parametrize(
+    "should_match, expected", [(True, "correct"), (False, "wrong"), (None, "correct")]
+)
+def test_regex_scorer(should_match, expected):
+    score = build_scorer(
+        "auto_regex_test",
+        EvaluationTypeSettings(regex_pattern="^paris", regex_should_match=should_match),
+    )
+    assert score("Paris is the capital", "") == expected
+
+
+def test_invalid_scorers():
+    with pytest.raises(AutoEvaluationError):
+        build_scorer("auto_regex_test", EvaluationTypeSettings(regex_pattern="("))
+    with pytest.raises(AutoEvaluationError):
+        build_scorer("human_a_b_testing", EvaluationTypeSettings())
+
+
+def test_score_pairs_budget():
+    score = build_scorer("auto_exact_match", EvaluationTypeSettings())
+    pairs = [("Paris", "Paris"), ("Lyon", "Paris")]
+    assert score_pairs(score, pairs, time.monotonic() + 60) == ["correct", "wrong"]
+    with pytest.raises(AutoEvaluationError):
+        score_pairs(score, pairs, time.monotonic() - 1)
+
+
+def test_score_regex_evaluation(test_db_engine, monkeypatch):
+    monkeypatch.setattr(auto_evaluators, "engine", test_db_engine)
+    monkeypatch.setattr(results_service, "engine", test_db_engine)
+    monkeypatch.setattr(settings, "evaluation_scenarios_batch_size", 2)
+    evaluation = SimpleNamespace(
+        id=ObjectId(),
+        user=SimpleNamespace(id=ObjectId()),
+        evaluation_type="auto_regex_test",
+        evaluation_type_settings=EvaluationTypeSettings(regex_pattern="^paris"),
+        archived=False,
+    )
+    outputs = ["Paris", "Lyon", "paris, France", None]
+
+    async def score(budget_seconds):
+        monkeypatch.setattr(
+            settings, "auto_evaluation_regex_budget_seconds", budget_seconds
+        )
+        return await score_evaluation(evaluation)
+
+    async def score_twice():
+        await test_db_engine.get_collection(EvaluationScenarioDB).insert_many(
+            [
+                {
+                    "evaluation_id": str(evaluation.id),
+                    "user": evaluation.user.id,
+                    "outputs": []
+                    if output is None
+                    else [{"variant_name": "v1", "variant_output": output}],
+                    "score": None,
+                }
+                for output in outputs
+            ]
+        )
+        with pytest.raises(AutoEvaluationError):
+            await score(0.0)
+        return await score(60.0)
+
+    assert asyncio.run(score_twice()) == {"scored": 3, "changed": 3}
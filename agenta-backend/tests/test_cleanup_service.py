@@ -0,0 +1,148 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from agenta_backend.config import settings
+from agenta_backend.models import db_models
+from agenta_backend.models.db_models import (
+    EvaluationDB,
+    EvaluationResultsDB,
+    EvaluationScenarioDB,
+)
+from agenta_backend.services import cleanup_service, db_manager, testset_service
+from agenta_backend.services.cleanup_service import (
+    clean_orphans,
+    fail_stale_materializations,
+)
+from agenta_backend.services.testset_service import (
+    CONTENT_ROWS_VERSION,
+    iter_stored_rows,
+    store_rows,
+)
+
+
+def test_fail_stale_materializations(test_db_engine, monkeypatch):
+    monkeypatch.setattr(cleanup_service, "engine", test_db_engine)
+    now = datetime.utcnow()
+
+    async def fail_stale():
+        evaluations = test_db_engine.get_collection(EvaluationDB)
+        scenarios = test_db_engine.get_collection(EvaluationScenarioDB)
+        results = test_db_engine.get_collection(EvaluationResultsDB)
+        leases = {
+            "stopped": now - timedelta(minutes=1),
+            "running": now + timedelta(minutes=1),
+            # Materializing before the leases, not updated for long
+            "legacy": None,
+        }
+        ids = {}
+        for name, lease_expires_at in leases.items():
+            ids[name] = ObjectId()
+            await evaluations.insert_one(
+                {
+                    "_id": ids[name],
+                    "status": "EVALUATION_MATERIALIZING",
+                    "materialization": {
+                        "total": 10,
+                        "materialized": 2,
+                        "lease_expires_at": lease_expires_at,
+                    },
+                    "updated_at": now - timedelta(days=1),
+                }
+            )
+            await scenarios.insert_many(
+                [{"evaluation_id": str(ids[name])} for _ in range(2)]
+            )
+            await results.insert_one({"evaluation_id": str(ids[name])})
+
+        assert await fail_stale_materializations() == 2
+        assert await fail_stale_materializations() == 0
+        for name, evaluation_id in ids.items():
+            evaluation = await evaluations.find_one({"_id": evaluation_id})
+            filters = {"evaluation_id": str(evaluation_id)}
+            if name == "running":
+                assert evaluation["status"] == "EVALUATION_MATERIALIZING"
+                assert await scenarios.count_documents(filters) == 2
+                assert await results.count_documents(filters) == 1
+            else:
+                assert evaluation["status"] == "EVALUATION_FAILED"
+                assert evaluation["materialization"]["materialized"] == 0
+                assert await scenarios.count_documents(filters) == 0
+                assert await results.count_documents(filters) == 0
+
+    asyncio.run(fail_stale())
+
+
+def test_clean_orphans_spares_uploads(test_db_engine, monkeypatch):
+    monkeypatch.setattr(cleanup_service, "engine", test_db_engine)
+    monkeypatch.setattr(testset_service, "engine", test_db_engine)
+    # Every chunk is old enough to be cleaned up
+    monkeypatch.setattr(settings, "orphan_cleanup_grace_seconds", -60.0)
+    monkeypatch.setattr(settings, "testset_rows_chunk_size", 1)
+    now = datetime.utcnow()
+
+    async def upload():
+        chunks = test_db_engine.get_collection(db_models.TestSetRowsChunkDB)
+        orphan, stopped = ObjectId(), ObjectId()
+        for key in (orphan, stopped):
+            await chunks.insert_one(
+                {"testset_id": key, "version": 0, "first_row": 0, "rows": [{}]}
+            )
+        await test_db_engine.get_collection(db_models.TestSetUploadDB).insert_one(
+            {
+                "rows_key": stopped,
+                "lease_expires_at": now - timedelta(minutes=1),
+                "created_at": now - timedelta(hours=1),
+            }
+        )
+        deleted = []
+
+        async def rows():
+            for index in range(3):
+                yield {"index": str(index)}
+                if index == 1:
+                    deleted.append(await clean_orphans())
+
+        content_id, row_count, _ = await store_rows(rows())
+        stored = [
+            row async for row in iter_stored_rows(content_id, CONTENT_ROWS_VERSION)
+        ]
+        remaining = await chunks.count_documents({"testset_id": {"$ne": content_id}})
+        return deleted[0], row_count, stored, remaining
+
+    deleted, row_count, stored, remaining = asyncio.run(upload())
+    assert deleted["testset_uploads"] == 1
+    assert deleted["testset_rows"] == 2
+    assert row_count == 3
+    assert stored == [{"index": str(index)} for index in range(3)]
+    assert remaining == 0
+
+
+def test_clean_soft_deleted_variants_scoped(test_db_engine, monkeypatch):
+    monkeypatch.setattr(db_manager, "engine", test_db_engine)
+
+    user, other_user = ObjectId(), ObjectId()
+
+    async def sweep():
+        variants = test_db_engine.get_collection(db_models.AppVariantDB)
+        # Soft-deleted variants whose image no live variant uses
+        owners = [(user, "app"), (user, "other"), (other_user, "app")]
+        for owner, app_name in owners:
+            await variants.insert_one(
+                {
+                    "app_name": app_name,
+                    "variant_name": "v1",
+                    "image": ObjectId(),
+                    "user": owner,
+                    "is_deleted": True,
+                }
+            )
+        deleted = await db_manager.clean_soft_deleted_variants(user, "app")
+        remaining = [
+            (doc["user"], doc["app_name"]) async for doc in variants.find({})
+        ]
+        return deleted, remaining
+
+    deleted, remaining = asyncio.run(sweep())
+    assert deleted == 1
+    assert sorted(remaining) == sorted([(user, "other"), (other_user, "app")])
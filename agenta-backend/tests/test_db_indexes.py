@@ -0,0 +1,33 @@
+import asyncio
+
+from bson import ObjectId
+from agenta_backend.models import db_models
+from agenta_backend.services import db_indexes
+
+
+def test_ensure_indexes_survives_duplicates(test_db_engine, monkeypatch):
+    monkeypatch.setattr(db_indexes, "engine", test_db_engine)
+
+    async def ensure():
+        users = test_db_engine.get_collection(db_models.UserDB)
+        for uid in ("1", "2"):
+            await users.insert_one(
+                {
+                    "uid": uid,
+                    "username": uid,
+                    "email": "demo@agenta.ai",
+                    "org": ObjectId(),
+                }
+            )
+        failures = await db_indexes.ensure_indexes()
+        # Indexes of the models after the users are still created
+        chunks = test_db_engine.get_collection(db_models.TestSetRowsChunkDB)
+        return failures, await chunks.index_information()
+
+    failures, chunk_indexes = asyncio.run(ensure())
+    assert [(failure["collection"], failure["index"]) for failure in failures] == [
+        ("users", "email_1")
+    ]
+    assert failures[0]["duplicates"] == 1
+    assert failures[0]["sample"] == [{"email": "demo@agenta.ai"}]
+    assert "testset_id_1_version_1_first_row_1" in chunk_indexes
@@ -0,0 +1,241 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from agenta_backend.config import settings
+from agenta_backend.models.api.evaluation_model import (
+    EvaluationScenarioUpdate,
+    EvaluationType,
+)
+from agenta_backend.models.db_models import (
+    EvaluationArchiveChunkDB,
+    EvaluationDB,
+    EvaluationScenarioDB,
+)
+from agenta_backend.services import (
+    evaluation_archive,
+    evaluation_service,
+    results_service,
+)
+from agenta_backend.services.evaluation_archive import (
+    EvaluationArchiveError,
+    archive_evaluation,
+    archive_finished_evaluations,
+    decode_scenarios,
+    encode_scenarios,
+    fetch_archive,
+    restore_evaluation,
+)
+
+
+def _scenario(inputs, outputs, **fields):
+    document = {
+        "_id": ObjectId(),
+        "inputs": [
+            {"input_name": name, "input_value": value} for name, value in inputs
+        ],
+        "outputs": [
+            {"variant_name": name, "variant_output": value} for name, value in outputs
+        ],
+        "evaluation_id": "evaluation",
+        "user": "user",
+        "vote": None,
+        "score": None,
+        "evaluation": None,
+        "correct_answer": None,
+        "created_at": datetime(2023, 9, 1, 12, 30, 0, 250000),
+        "updated_at": None,
+    }
+    document.update(fields)
+    return document
+
+
+def test_encode_decode_scenarios():
+    input_names, variant_names = [], []
+    first = [
+        _scenario([("country", "France")], [("v1", "Paris")], score=0.5),
+        _scenario([("country", "Japon")], [("v1", "Tokyo")], vote="v1"),
+    ]
+    second = [
+        _scenario(
+            [("country", "Pérou"), ("language", "es")],
+            [("v1", ""), ("v2", "Lima")],
+            score="correct",
+            correct_answer="Lima",
+        )
+    ]
+
+    chunks = []
+    for documents in (first, second):
+        ids, data = encode_scenarios(documents, input_names, variant_names)
+        chunks.append(
+            {
+                "evaluation_id": "evaluation",
+                "count": len(documents),
+                "ids": ids,
+                "data": data,
+            }
+        )
+    assert input_names == ["country", "language"]
+    assert variant_names == ["v1", "v2"]
+
+    archive = {
+        "input_names": input_names,
+        "variant_names": variant_names,
+        "user": "user",
+    }
+    decoded = [
+        document for chunk in chunks for document in decode_scenarios(chunk, archive)
+    ]
+    assert decoded == first + second
+
+
+def test_interrupted_restore_keeps_the_archive(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_archive, "engine", test_db_engine)
+    monkeypatch.setattr(settings, "evaluation_scenarios_batch_size", 2)
+    monkeypatch.setattr(settings, "evaluation_archive_after_seconds", 0.0)
+    iter_archived_scenarios = evaluation_archive.iter_archived_scenarios
+
+    async def interrupted(evaluation_id):
+        # The restore stops after its first batch
+        count = 0
+        async for document in iter_archived_scenarios(evaluation_id):
+            if count == 2:
+                raise RuntimeError("interrupted")
+            count += 1
+            yield document
+
+    async def archive_and_restore():
+        evaluations = test_db_engine.get_collection(EvaluationDB)
+        scenarios = test_db_engine.get_collection(EvaluationScenarioDB)
+        evaluation_id, user_id = ObjectId(), ObjectId()
+        await evaluations.insert_one(
+            {
+                "_id": evaluation_id,
+                "status": "EVALUATION_FINISHED",
+                "archived": False,
+                "user": user_id,
+                "updated_at": datetime(2023, 9, 1),
+            }
+        )
+        documents = [
+            _scenario([("country", country)], [("v1", country)])
+            for country in ("France", "Japon", "Pérou", "Chili", "Inde")
+        ]
+        for document in documents:
+            document.update(evaluation_id=str(evaluation_id), user=user_id)
+        await scenarios.insert_many(documents)
+        assert await archive_finished_evaluations() == 1
+
+        monkeypatch.setattr(evaluation_archive, "iter_archived_scenarios", interrupted)
+        with pytest.raises(RuntimeError):
+            await restore_evaluation(str(evaluation_id))
+        monkeypatch.setattr(
+            evaluation_archive, "iter_archived_scenarios", iter_archived_scenarios
+        )
+
+        # Neither archived again nor read from the partial scenarios
+        assert await archive_finished_evaluations() == 0
+        with pytest.raises(EvaluationArchiveError):
+            await archive_evaluation(str(evaluation_id))
+        evaluation = await evaluations.find_one({"_id": evaluation_id})
+        assert evaluation["archived"] and evaluation["restoring"]
+        assert (await fetch_archive(str(evaluation_id)))["scenario_count"] == 5
+
+        assert await restore_evaluation(str(evaluation_id)) == 5
+        evaluation = await evaluations.find_one({"_id": evaluation_id})
+        assert not evaluation["archived"] and not evaluation["restoring"]
+        assert evaluation["updated_at"] > datetime.utcnow() - timedelta(minutes=1)
+        assert await fetch_archive(str(evaluation_id)) is None
+        restored = [
+            document
+            async for document in scenarios.find(
+                {"evaluation_id": str(evaluation_id)}, sort=[("_id", 1)]
+            )
+        ]
+        assert restored == documents
+
+        # Not archived again right after being restored
+        monkeypatch.setattr(settings, "evaluation_archive_after_seconds", 3600.0)
+        assert await archive_finished_evaluations() == 0
+
+    asyncio.run(archive_and_restore())
+
+
+def test_scenario_updated_while_archived(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_archive, "engine", test_db_engine)
+    monkeypatch.setattr(evaluation_service, "engine", test_db_engine)
+    monkeypatch.setattr(results_service, "engine", test_db_engine)
+    monkeypatch.setattr(settings, "evaluation_archive_chunk_size", 2)
+    user_id = ObjectId()
+
+    async def get_user_object(uid):
+        return type("User", (), {"id": user_id})
+
+    monkeypatch.setattr(evaluation_service, "get_user_object", get_user_object)
+    get_collection = test_db_engine.get_collection
+
+    async def archive_and_update():
+        evaluations = get_collection(EvaluationDB)
+        scenarios = get_collection(EvaluationScenarioDB)
+        evaluation_id = ObjectId()
+        await evaluations.insert_one(
+            {"_id": evaluation_id, "status": "EVALUATION_FINISHED", "user": user_id}
+        )
+        documents = [
+            _scenario([("country", country)], [("v1", country)])
+            for country in ("France", "Japon", "Pérou")
+        ]
+        for document in documents:
+            document.update(evaluation_id=str(evaluation_id), user=user_id)
+        await scenarios.insert_many(documents)
+        first_id = str(documents[0]["_id"])
+
+        # The first scenario is scored once its chunk is written
+        chunks = get_collection(EvaluationArchiveChunkDB)
+        insert_chunk = chunks.insert_one
+
+        async def insert_chunk_then_score(document):
+            await insert_chunk(document)
+            if document["first_id"] == documents[0]["_id"]:
+                await evaluation_service.update_evaluation_scenario_score(
+                    first_id, 1.0, uid="42"
+                )
+
+        def get_scoring_collection(model):
+            if model is EvaluationArchiveChunkDB:
+                return chunks
+            return get_collection(model)
+
+        chunks.insert_one = insert_chunk_then_score
+        monkeypatch.setattr(test_db_engine, "get_collection", get_scoring_collection)
+        with pytest.raises(EvaluationArchiveError):
+            await archive_evaluation(str(evaluation_id))
+        evaluation = await evaluations.find_one({"_id": evaluation_id})
+        assert not evaluation["archived"]
+        assert await fetch_archive(str(evaluation_id)) is None
+        assert await scenarios.count_documents({"score": 1.0}) == 1
+
+        chunks.insert_one = insert_chunk
+        assert await archive_evaluation(str(evaluation_id)) == 3
+        vote = EvaluationScenarioUpdate(
+            vote="v1", outputs=[{"variant_name": "v1", "variant_output": "Paris"}]
+        )
+        with pytest.raises(EvaluationArchiveError):
+            await evaluation_service.update_evaluation_scenario(
+                str(evaluation_id),
+                first_id,
+                vote,
+                EvaluationType.human_a_b_testing,
+                uid="42",
+            )
+        archived = [
+            document
+            async for document in evaluation_archive.iter_archived_scenarios(
+                str(evaluation_id)
+            )
+        ]
+        assert [document["score"] for document in archived] == [1.0, None, None]
+
+    asyncio.run(archive_and_update())
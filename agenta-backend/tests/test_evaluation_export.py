@@ -0,0 +1,135 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import (
+    EvaluationDB,
+    EvaluationScenarioDB,
+    EvaluationTypeSettings,
+    OrganizationDB,
+    UserDB,
+)
+from agenta_backend.services import evaluation_archive, evaluation_export
+from agenta_backend.services.evaluation_export import (
+    flatten_scenario,
+    iter_evaluation_export,
+)
+
+
+def test_flatten_scenario():
+    scenario_id = ObjectId()
+    record = flatten_scenario(
+        {
+            "_id": scenario_id,
+            "inputs": [
+                {"input_name": "country", "input_value": "France"},
+                {"input_name": "language", "input_value": "fr"},
+            ],
+            "outputs": [{"variant_name": "v1", "variant_output": "Paris"}],
+            "score": 0.5,
+            "created_at": datetime(2023, 9, 1, 12, 30),
+        }
+    )
+    assert record == {
+        "id": str(scenario_id),
+        "inputs.country": "France",
+        "inputs.language": "fr",
+        "outputs.v1": "Paris",
+        "vote": None,
+        "score": 0.5,
+        "evaluation": None,
+        "correct_answer": None,
+        "created_at": "2023-09-01T12:30:00",
+        "updated_at": None,
+    }
+
+
+# Country, answer of the variant and verdict of the AI critique
+CRITIQUED = (("France", "Paris", "correct"), ("Japon", "Kyoto", "wrong"))
+
+
+def test_iter_evaluation_export(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_export, "engine", test_db_engine)
+    monkeypatch.setattr(evaluation_archive, "engine", test_db_engine)
+    # Flushed several times per export
+    monkeypatch.setattr(settings, "evaluation_export_flush_bytes", 64)
+    user = UserDB(uid="42", organization_id=OrganizationDB())
+
+    async def export():
+        evaluations = test_db_engine.get_collection(EvaluationDB)
+        scenarios = test_db_engine.get_collection(EvaluationScenarioDB)
+        exports = {}
+        for archived in (False, True):
+            evaluation = EvaluationDB(
+                status="EVALUATION_FINISHED",
+                evaluation_type="auto_ai_critique",
+                evaluation_type_settings=EvaluationTypeSettings(),
+                llm_app_prompt_template="",
+                variants=["v1"],
+                app_name="app",
+                testset={"_id": "t", "name": "t"},
+                user=user,
+            )
+            await evaluations.insert_one(evaluation.doc())
+            documents = [
+                {
+                    "_id": ObjectId(),
+                    "evaluation_id": str(evaluation.id),
+                    "user": user.id,
+                    "inputs": [{"input_name": "country", "input_value": country}],
+                    "outputs": [{"variant_name": "v1", "variant_output": capital}],
+                    "evaluation": verdict,
+                    "correct_answer": capital,
+                    "created_at": datetime(2023, 9, 1, 12, 30),
+                }
+                for country, capital, verdict in CRITIQUED
+            ]
+            await scenarios.insert_many(documents)
+            if archived:
+                await evaluation_archive.archive_evaluation(str(evaluation.id))
+                evaluation.archived = True
+            for export_format in ("csv", "jsonl"):
+                for compress in (False, True):
+                    pieces = [
+                        piece
+                        async for piece in iter_evaluation_export(
+                            evaluation, export_format, compress
+                        )
+                    ]
+                    exports[archived, export_format, compress] = (
+                        [str(document["_id"]) for document in documents],
+                        b"".join(pieces),
+                    )
+        return exports
+
+    for (archived, export_format, compress), (ids, data) in asyncio.run(
+        export()
+    ).items():
+        if compress:
+            data = gzip.decompress(data)
+        text = data.decode("utf-8")
+        if export_format == "csv":
+            records = list(csv.DictReader(io.StringIO(text)))
+            empty = ""
+        else:
+            records = [json.loads(line) for line in text.splitlines()]
+            empty = None
+        assert records == [
+            {
+                "id": scenario_id,
+                "inputs.country": country,
+                "outputs.v1": capital,
+                "vote": empty,
+                "score": empty,
+                "evaluation": verdict,
+                "correct_answer": capital,
+                "created_at": "2023-09-01T12:30:00",
+                "updated_at": empty,
+            }
+            for scenario_id, (country, capital, verdict) in zip(ids, CRITIQUED)
+        ], (archived, export_format, compress)
@@ -0,0 +1,309 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from bson import ObjectId
+
+from agenta_backend.config import settings
+from agenta_backend.models.db_models import EvaluationDB, EvaluationScenarioDB
+from agenta_backend.services import evaluation_runner
+from agenta_backend.services.evaluation_runner import (
+    EvaluationRunError,
+    VariantCallError,
+    VariantEndpoint,
+    call_variant,
+    claim_run,
+    execute_run,
+    generate_parameters,
+    process_scenarios,
+)
+
+OPENAPI = {
+    "paths": {
+        "/generate": {
+            "post": {
+                "requestBody": {
+                    "content": {
+                        "application/json": {
+                            "schema": {"$ref": "#/components/schemas/Body_generate"}
+                        }
+                    }
+                }
+            }
+        }
+    },
+    "components": {
+        "schemas": {
+            "Body_generate": {
+                "properties": {
+                    "country": {"type": "string"},
+                    "inputs": {"x-parameter": "dict", "default": ["language"]},
+                    "temperature": {"x-parameter": "float", "default": 0.7},
+                    "prompt": {"x-parameter": "text", "default": "Capital of"},
+                    "stop": {"x-parameter": "text", "default": ""},
+                }
+            }
+        }
+    },
+}
+
+INPUTS = [
+    {"input_name": "country", "input_value": "France"},
+    {"input_name": "language", "input_value": "fr"},
+]
+
+
+def test_generate_parameters():
+    parameters, dict_inputs = generate_parameters(OPENAPI, {"prompt": "Capitale de"})
+    assert parameters == {"temperature": 0.7, "prompt": "Capitale de"}
+    assert dict_inputs == {"language"}
+
+    _, dict_inputs = generate_parameters(OPENAPI, {"inputs": [{"name": "city"}]})
+    assert dict_inputs == {"city"}
+
+
+def test_payload():
+    parameters, dict_inputs = generate_parameters(OPENAPI, {})
+    endpoint = VariantEndpoint("v1", "http://variant", parameters, dict_inputs)
+    assert endpoint.payload(INPUTS) == {
+        "inputs": {"language": "fr"},
+        "country": "France",
+        "temperature": 0.7,
+        "prompt": "Capital of",
+    }
+
+
+def _stub_variant(statuses):
+    """Answers a /generate call with the next status, the body echoed."""
+
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        status = statuses.pop(0) if statuses else 200
+        return httpx.Response(status, json=json.loads(request.content))
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), calls
+
+
+def test_call_variant_retries(monkeypatch):
+    async def no_wait(attempt):
+        pass
+
+    monkeypatch.setattr(evaluation_runner, "backoff", no_wait)
+    client, calls = _stub_variant([503, 502])
+    endpoint = VariantEndpoint("v1", "http://variant", {}, set())
+    output = asyncio.run(call_variant(client, endpoint, INPUTS[:1]))
+    assert json.loads(output) == {"inputs": {}, "country": "France"}
+    assert len(calls) == 3
+    assert calls[0].url == "http://variant/generate"
+
+
+def test_call_variant_error():
+    client, calls = _stub_variant([500])
+    endpoint = VariantEndpoint("v1", "http://variant", {}, set())
+    with pytest.raises(VariantCallError):
+        asyncio.run(call_variant(client, endpoint, INPUTS))
+    assert len(calls) == 1
+
+
+async def _create_evaluation(engine, countries, answered=()):
+    """Creates a human A/B evaluation with a scenario per country, the
+    answered ones holding the output of v1 already."""
+
+    evaluation = SimpleNamespace(
+        id=ObjectId(),
+        user=SimpleNamespace(id=ObjectId()),
+        status="EVALUATION_INITIALIZED",
+        evaluation_type="human_a_b_testing",
+        variants=["v1"],
+        archived=False,
+    )
+    await engine.get_collection(EvaluationDB).insert_one(
+        {"_id": evaluation.id, "status": evaluation.status, "user": evaluation.user.id}
+    )
+    await engine.get_collection(EvaluationScenarioDB).insert_many(
+        [
+            {
+                "evaluation_id": str(evaluation.id),
+                "user": evaluation.user.id,
+                "inputs": [{"input_name": "country", "input_value": country}],
+                "outputs": [{"variant_name": "v1", "variant_output": "Paris"}]
+                if country in answered
+                else [],
+            }
+            for country in countries
+        ]
+    )
+    return evaluation
+
+
+def test_process_scenarios_handler_cancelled(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_runner, "engine", test_db_engine)
+
+    async def handle(document):
+        if document["inputs"][0]["input_value"] == "Japon":
+            raise asyncio.CancelledError()
+        return {"evaluation": "correct"}, False
+
+    async def process():
+        evaluation = await _create_evaluation(
+            test_db_engine, ["France", "Japon", "Pérou"]
+        )
+        token = await claim_run(evaluation)
+        with pytest.raises(EvaluationRunError):
+            # Ends instead of waiting for the cancelled worker
+            await asyncio.wait_for(
+                process_scenarios(
+                    evaluation, token, "run", {"inputs": 1}, bool, handle, 2
+                ),
+                timeout=5,
+            )
+        return await test_db_engine.get_collection(EvaluationDB).find_one(
+            {"_id": evaluation.id}
+        )
+
+    evaluation = asyncio.run(process())
+    assert evaluation["status"] == "EVALUATION_FAILED"
+    assert evaluation["run"]["lease_expires_at"] == evaluation["run"]["finished_at"]
+
+
+def test_process_scenarios_cancelled(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_runner, "engine", test_db_engine)
+
+    async def handle(document):
+        await asyncio.sleep(10)
+        return {"evaluation": "correct"}, False
+
+    async def process():
+        evaluation = await _create_evaluation(test_db_engine, ["France", "Japon"])
+        token = await claim_run(evaluation)
+        run = asyncio.create_task(
+            process_scenarios(evaluation, token, "run", {"inputs": 1}, bool, handle, 2)
+        )
+        await asyncio.sleep(0.1)
+        run.cancel()
+        # The cancellation of the run is not taken for a stopped worker
+        with pytest.raises(asyncio.CancelledError):
+            await run
+
+    asyncio.run(process())
+
+
+class _RecordedCollection:
+    """Delegates to a collection, recording the size of its bulk writes."""
+
+    def __init__(self, collection, writes):
+        self._collection = collection
+        self._writes = writes
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def bulk_write(self, operations, **kwargs):
+        self._writes.append(len(operations))
+        return await self._collection.bulk_write(operations, **kwargs)
+
+
+def test_execute_run(test_db_engine, monkeypatch):
+    writes = []
+
+    def get_collection(model):
+        collection = test_db_engine.get_collection(model)
+        if model is EvaluationScenarioDB:
+            return _RecordedCollection(collection, writes)
+        return collection
+
+    monkeypatch.setattr(
+        evaluation_runner, "engine", SimpleNamespace(get_collection=get_collection)
+    )
+    monkeypatch.setattr(settings, "evaluation_runner_concurrency", 2)
+    monkeypatch.setattr(settings, "evaluation_runner_write_batch_size", 2)
+
+    calls = []
+    down = {"Japon"}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        country = json.loads(request.content)["country"]
+        calls.append(country)
+        if country in down:
+            return httpx.Response(500, text="down")
+        return httpx.Response(200, json=f"Capital of {country}")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    endpoint = VariantEndpoint("v1", "http://variant", {}, set())
+    evaluations = test_db_engine.get_collection(EvaluationDB)
+    scenarios = test_db_engine.get_collection(EvaluationScenarioDB)
+
+    async def run():
+        evaluation = await _create_evaluation(
+            test_db_engine,
+            ["France", "Japon", "Pérou", "Chili", "Inde"],
+            answered={"France"},
+        )
+
+        # The answered scenario is skipped, the failed one left without output
+        token = await claim_run(evaluation)
+        progress = await execute_run(evaluation, token, [endpoint], client)
+        assert progress == {"total": 5, "completed": 4, "failed": 1}
+        assert sorted(calls) == ["Chili", "Inde", "Japon", "Pérou"]
+        assert sum(writes) == 3 and max(writes) <= 2
+        document = await evaluations.find_one({"_id": evaluation.id})
+        assert document["status"] == "EVALUATION_FAILED"
+
+        # Run again, only the failed scenario is sent
+        calls.clear()
+        down.clear()
+        token = await claim_run(evaluation)
+        progress = await execute_run(evaluation, token, [endpoint], client)
+        assert progress == {"total": 5, "completed": 5, "failed": 0}
+        assert calls == ["Japon"]
+        document = await evaluations.find_one({"_id": evaluation.id})
+        assert document["status"] == "EVALUATION_FINISHED"
+        outputs = {
+            document["inputs"][0]["input_value"]: document["outputs"]
+            async for document in scenarios.find(
+                {"evaluation_id": str(evaluation.id)}, sort=[("_id", 1)]
+            )
+        }
+        assert outputs["Japon"] == [
+            {"variant_name": "v1", "variant_output": "Capital of Japon"}
+        ]
+        assert all(len(value) == 1 for value in outputs.values())
+
+    asyncio.run(run())
+
+
+def test_execute_run_lease_lost(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_runner, "engine", test_db_engine)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json="Paris")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    endpoint = VariantEndpoint("v1", "http://variant", {}, set())
+    evaluations = test_db_engine.get_collection(EvaluationDB)
+
+    async def run():
+        evaluation = await _create_evaluation(test_db_engine, ["France", "Japon"])
+        token = await claim_run(evaluation)
+        # The lease expired and the evaluation was claimed again elsewhere
+        await evaluations.update_one(
+            {"_id": evaluation.id}, {"$set": {"run.token": ObjectId()}}
+        )
+        with pytest.raises(EvaluationRunError):
+            await execute_run(evaluation, token, [endpoint], client)
+        scenarios = test_db_engine.get_collection(EvaluationScenarioDB)
+        written = await scenarios.count_documents(
+            {"evaluation_id": str(evaluation.id), "outputs": {"$ne": []}}
+        )
+        return await evaluations.find_one({"_id": evaluation.id}), written
+
+    document, written = asyncio.run(run())
+    # Left to the run holding the lease
+    assert written == 0
+    assert document["status"] == "EVALUATION_STARTED"
+    assert document["run"]["finished_at"] is None
+    assert document["run"]["completed"] == 0
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from agenta_backend.models.api.evaluation_model import (
+    EvaluationStatusEnum,
+    EvaluationUpdate,
+)
+from agenta_backend.models.db_models import (
+    EvaluationDB,
+    EvaluationTypeSettings,
+    OrganizationDB,
+    UserDB,
+)
+from agenta_backend.services import evaluation_service
+from agenta_backend.services.evaluation_service import (
+    EvaluationMaterializingError,
+    update_evaluation,
+)
+
+
+def test_update_evaluation_while_materializing(test_db_engine, monkeypatch):
+    monkeypatch.setattr(evaluation_service, "engine", test_db_engine)
+
+    async def update():
+        organization = await test_db_engine.save(OrganizationDB())
+        user = await test_db_engine.save(
+            UserDB(uid="42", organization_id=organization)
+        )
+
+        async def get_user_object(uid):
+            return user
+
+        monkeypatch.setattr(evaluation_service, "get_user_object", get_user_object)
+        evaluation = await test_db_engine.save(
+            EvaluationDB(
+                status=EvaluationStatusEnum.EVALUATION_MATERIALIZING.value,
+                evaluation_type="auto_exact_match",
+                evaluation_type_settings=EvaluationTypeSettings(),
+                llm_app_prompt_template="",
+                variants=["v1"],
+                app_name="app",
+                testset={"_id": "t", "name": "t"},
+                user=user,
+            )
+        )
+        evaluation_id = str(evaluation.id)
+        started = EvaluationUpdate(status=EvaluationStatusEnum.EVALUATION_STARTED)
+        with pytest.raises(EvaluationMaterializingError):
+            await update_evaluation(evaluation_id, started, uid="42")
+
+        evaluations = test_db_engine.get_collection(EvaluationDB)
+        await evaluations.update_one(
+            {"_id": evaluation.id},
+            {
+                "$set": {
+                    "status": EvaluationStatusEnum.EVALUATION_INITIALIZED.value,
+                    "materialization.materialized": 3,
+                }
+            },
+        )
+        materializing = EvaluationUpdate(
+            status=EvaluationStatusEnum.EVALUATION_MATERIALIZING
+        )
+        with pytest.raises(EvaluationMaterializingError):
+            await update_evaluation(evaluation_id, materializing, uid="42")
+
+        updated = await update_evaluation(evaluation_id, started, uid="42")
+        assert updated.status == EvaluationStatusEnum.EVALUATION_STARTED
+        stored = await evaluations.find_one({"_id": evaluation.id})
+        assert stored["status"] == EvaluationStatusEnum.EVALUATION_STARTED.value
+        assert stored["materialization"]["materialized"] == 3
+
+    asyncio.run(update())
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from agenta_backend.models.db_models import EvaluationDB, EvaluationScenarioDB
+from agenta_backend.services import results_service
+from agenta_backend.services.results_service import (
+    convert_legacy_scores,
+    decode_counter_key,
+    encode_counter_key,
+    percentile_rank,
+)
+
+
+@pytest.mark.parametrize("value", ["", "0", "v2", "app.v1", "$price", "50%.", None])
+def test_counter_keys_round_trip(value):
+    key = encode_counter_key(value)
+    assert "." not in key and not key.startswith("$")
+    assert decode_counter_key(key) == value
+
+
+def test_counter_keys_do_not_collide():
+    values = ["a.b", "a%2Eb", "%00", None]
+    assert len({encode_counter_key(value) for value in values}) == len(values)
+
+
+def test_percentile_rank_uses_nearest_rank():
+    assert percentile_rank(50, 4) == 2
+    assert percentile_rank(95, 20) == 19
+    assert percentile_rank(99, 20) == 20
+    assert percentile_rank(0, 5) == 1
+    assert percentile_rank(25, 1) == 1
+
+
+def test_convert_legacy_scores(test_db_engine, monkeypatch):
+    monkeypatch.setattr(results_service, "engine", test_db_engine)
+    scores = ["0.5", " 1", "1e-1", "abc", "", "nan", 0.7, None]
+
+    async def convert():
+        evaluation_id = ObjectId()
+        await test_db_engine.get_collection(EvaluationDB).insert_one(
+            {"_id": evaluation_id, "evaluation_type": "human_scoring"}
+        )
+        scenarios = test_db_engine.get_collection(EvaluationScenarioDB)
+        await scenarios.insert_many(
+            [
+                {"_id": index, "evaluation_id": str(evaluation_id), "score": score}
+                for index, score in enumerate(scores)
+            ]
+        )
+        converted = await convert_legacy_scores()
+        documents = await scenarios.find({}, sort=[("_id", 1)]).to_list(None)
+        return converted, [document["score"] for document in documents]
+
+    converted, converted_scores = asyncio.run(convert())
+    assert converted == 2
+    # Only the numeric strings are converted
+    assert converted_scores == [0.5, " 1", 0.1, "abc", "", "nan", 0.7, None]
@@ -0,0 +1,59 @@
+import pytest
+
+for module in ("jsonschema", "numpy", "requests"):
+    pytest.importorskip(module)
+
+from agenta_backend.services.security import sandbox
+from agenta_backend.services.security.sandbox import (
+    compile_evaluator,
+    execute_code_safely,
+)
+
+CODE = """
+def evaluate(app_params, inputs, correct_answer, output):
+    return 1.0 if output == correct_answer else 0.0
+"""
+
+EDITED_CODE = """
+def evaluate(app_params, inputs, correct_answer, output):
+    return 0.5
+"""
+
+
+@pytest.fixture
+def compilations(monkeypatch):
+    sandbox.evaluator_cache.clear()
+    calls = []
+    compile_evaluator = sandbox.compile_evaluator
+
+    def counted(code):
+        calls.append(code)
+        return compile_evaluator(code)
+
+    monkeypatch.setattr(sandbox, "compile_evaluator", counted)
+    yield calls
+    sandbox.evaluator_cache.clear()
+
+
+def test_evaluator_compiled_once(compilations):
+    assert execute_code_safely({}, {}, "Paris", "Paris", CODE, "e1") == 1.0
+    assert execute_code_safely({}, {}, "Lyon", "Paris", CODE, "e1") == 0.0
+    assert len(compilations) == 1
+
+
+def test_evaluator_recompiled_on_edit(compilations):
+    execute_code_safely({}, {}, "Paris", "Paris", CODE, "e1")
+    assert execute_code_safely({}, {}, "Paris", "Paris", EDITED_CODE, "e1") == 0.5
+    assert len(compilations) == 2
+    # The previous version of the evaluation is dropped
+    assert len(sandbox.evaluator_cache) == 1
+
+
+def test_evaluators_builtins_not_shared():
+    first, second = compile_evaluator(CODE), compile_evaluator(CODE)
+    assert first.__globals__["__builtins__"] is not second.__globals__["__builtins__"]
+
+
+def test_result_out_of_range():
+    code = "def evaluate(app_params, inputs, correct_answer, output):\n    return 2.0\n"
+    assert execute_code_safely({}, {}, "Paris", "Paris", code) is None
@@ -0,0 +1,87 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import pytest
+from agenta_backend.config import settings
+from agenta_backend.services import testset_columnar, testset_parsers
+
+pa = pytest.importorskip("pyarrow")
+ipc = pytest.importorskip("pyarrow.ipc")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+class Upload:
+    def __init__(self, data: bytes):
+        self.file = io.BytesIO(data)
+
+
+def read(data: bytes, file_format: str):
+    async def collect():
+        upload = Upload(data)
+        return [
+            row
+            async for row in testset_columnar.iter_columnar_rows(upload, file_format)
+        ]
+
+    return asyncio.run(collect())
+
+
+TABLE = pa.table(
+    {
+        "question": ["a", "b", None],
+        "count": [1, 2, 3],
+        "tags": [["x"], [], None],
+    }
+)
+
+ROWS = [
+    {"question": "a", "count": "1", "tags": '["x"]'},
+    {"question": "b", "count": "2", "tags": "[]"},
+    {"question": "", "count": "3", "tags": ""},
+]
+
+
+def test_parquet_rows_as_strings():
+    sink = io.BytesIO()
+    pq.write_table(TABLE, sink, row_group_size=2)
+    assert read(sink.getvalue(), "parquet") == ROWS
+
+
+@pytest.mark.parametrize("new_writer", [ipc.new_file, ipc.new_stream])
+def test_arrow_file_and_stream(new_writer):
+    sink = pa.BufferOutputStream()
+    writer = new_writer(sink, TABLE.schema)
+    for batch in TABLE.to_batches(max_chunksize=1):
+        writer.write_batch(batch)
+    writer.close()
+    assert read(sink.getvalue().to_pybytes(), "arrow") == ROWS
+
+
+def test_invalid_file():
+    with pytest.raises(testset_parsers.TestSetParsingError):
+        read(b"not a parquet file", "parquet")
+
+
+def export(testset, file_format: str) -> bytes:
+    async def collect():
+        parts = testset_columnar.iter_columnar_export(testset, file_format)
+        return b"".join([part async for part in parts])
+
+    return asyncio.run(collect())
+
+
+def test_export_by_chunk(monkeypatch):
+    monkeypatch.setattr(settings, "testset_rows_chunk_size", 2)
+    rows = [{"country": country, "correct_answer": "Paris"} for country in "abcde"]
+    # Inline rows, exported in slices of the chunk size
+    testset = SimpleNamespace(rows_version=0, csvdata=rows)
+
+    table = pq.read_table(io.BytesIO(export(testset, "parquet")))
+    assert table.to_pylist() == rows
+    assert pq.ParquetFile(io.BytesIO(export(testset, "parquet"))).num_row_groups == 3
+
+    reader = ipc.open_stream(export(testset, "arrow"))
+    batches = list(reader)
+    assert [batch.num_rows for batch in batches] == [2, 2, 1]
+    assert pa.Table.from_batches(batches).to_pylist() == rows
@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+import pytest
+from agenta_backend.services import testset_parsers
+from agenta_backend.services.testset_parsers import (
+    check_columns,
+    iter_csv_rows,
+    iter_json_rows,
+)
+
+
+async def byte_chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+def parse(parser, data: bytes, size: int = 3):
+    async def collect():
+        return [row async for row in parser(byte_chunks(data, size))]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 1024])
+def test_csv_rows_split_across_chunks(size):
+    data = 'country,answer\r\nFrance,"Paris, ""the"" capital\nof France"\n\nÉire,Dublin'
+    rows = parse(iter_csv_rows, data.encode("utf-8"), size)
+    assert rows == [
+        {"country": "France", "answer": 'Paris, "the" capital\nof France'},
+        {"country": "Éire", "answer": "Dublin"},
+    ]
+
+
+def test_csv_drops_byte_order_mark():
+    rows = parse(iter_csv_rows, "﻿country\nFrance\n".encode("utf-8"))
+    assert rows == [{"country": "France"}]
+
+
+def test_csv_rejects_rows_with_missing_values():
+    with pytest.raises(testset_parsers.TestSetParsingError, match="Row 3"):
+        parse(iter_csv_rows, b"country,answer\nFrance,Paris\nSpain\n")
+
+
+@pytest.mark.parametrize("size", [1, 4, 1024])
+def test_json_array_and_json_lines(size):
+    rows = [{"country": "France", "answer": "Paris [1]"}, {"country": "Spain", "n": 12}]
+    array = json.dumps(rows, indent=2).encode("utf-8")
+    lines = "\n".join(json.dumps(row) for row in rows).encode("utf-8")
+    assert parse(iter_json_rows, array, size) == rows
+    assert parse(iter_json_rows, lines, size) == rows
+    assert parse(iter_json_rows, b" [ ] ", size) == []
+
+
+@pytest.mark.parametrize(
+    "data", [b'"a"', b"[1, 2]", b'[{"a": 1} {"a": 2}]', b'[{"a": 1}', b'[{"a": 1}] x']
+)
+def test_json_rejects_malformed_files(data):
+    with pytest.raises(testset_parsers.TestSetParsingError):
+        parse(iter_json_rows, data)
+
+
+def test_check_columns_rejects_inconsistent_rows():
+    async def collect():
+        rows = check_columns(iter_json_rows(byte_chunks(b'[{"a": 1}, {"b": 2}]', 4)))
+        return [row async for row in rows]
+
+    with pytest.raises(testset_parsers.TestSetParsingError, match="Row 2"):
+        asyncio.run(collect())
@@ -0,0 +1,45 @@
+import pytest
+from agenta_backend.models.api import testset_model
+from agenta_backend.services.testset_selection import (
+    RowsSelectionError,
+    allocate_strata,
+    row_filter_condition,
+)
+
+
+def test_allocate_strata_is_proportional():
+    quotas = allocate_strata({"en": 300, "fr": 300, "de": 300, "es": 100}, 10)
+    assert quotas == {"en": 3, "fr": 3, "de": 3, "es": 1}
+
+
+def test_allocate_strata_hands_out_the_remainders():
+    quotas = allocate_strata({"a": 5, "b": 3, "c": 2}, 3)
+    assert sum(quotas.values()) == 3
+    assert quotas == {"a": 1, "b": 1, "c": 1}
+
+
+def test_allocate_strata_keeps_small_test_sets_whole():
+    assert allocate_strata({"a": 2, None: 1}, 10) == {"a": 2, None: 1}
+
+
+def test_row_filter_conditions():
+    assert row_filter_condition(testset_model.TestsetRowFilter(column="lang", value="fr")) == {
+        "row.lang": "fr"
+    }
+    assert row_filter_condition(
+        testset_model.TestsetRowFilter(column="lang", operator="not_in", value=["fr", "es"])
+    ) == {"row.lang": {"$nin": ["fr", "es"]}}
+    assert row_filter_condition(
+        testset_model.TestsetRowFilter(column="text", operator="contains", value="a.b")
+    ) == {"row.text": {"$regex": r"a\.b"}}
+
+
+@pytest.mark.parametrize("column", ["a.b", "$where", ""])
+def test_row_filter_rejects_field_paths(column):
+    with pytest.raises(RowsSelectionError):
+        row_filter_condition(testset_model.TestsetRowFilter(column=column, value="x"))
+
+
+def test_row_filter_rejects_lists_for_single_value_operators():
+    with pytest.raises(RowsSelectionError):
+        row_filter_condition(testset_model.TestsetRowFilter(column="lang", value=["fr"]))
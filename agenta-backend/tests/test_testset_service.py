@@ -0,0 +1,154 @@
+import asyncio
+
+from agenta_backend.config import settings
+from agenta_backend.models import db_models
+from agenta_backend.models.db_models import OrganizationDB, UserDB
+from agenta_backend.services import testset_service
+from agenta_backend.services.testset_service import (
+    create_testset,
+    estimate_row_size,
+    hash_rows,
+    patch_testset_rows,
+    read_testset_rows,
+    rows_location,
+    store_rows,
+    write_rows_version,
+)
+
+ROWS = [{"question": str(index)} for index in range(10)]
+
+
+def test_patch_keeps_content_hash(test_db_engine, monkeypatch):
+    monkeypatch.setattr(testset_service, "engine", test_db_engine)
+
+    async def patch():
+        user = UserDB(uid="1", organization_id=OrganizationDB())
+        testset = await create_testset("t", "app", ROWS, user)
+        shared = await create_testset("u", "app", ROWS, user)
+        assert shared.content_id == testset.content_id
+
+        await patch_testset_rows(
+            testset,
+            updates=[(0, {"question": "first"})],
+            deletes=[5],
+            inserts=[(2, {"question": "inserted"}), (None, {"question": "last"})],
+        )
+        rows = await read_testset_rows(testset)
+        document = await test_db_engine.get_collection(db_models.TestSetDB).find_one(
+            {"_id": testset.id}
+        )
+        return testset, shared, rows, document["content_hash"]
+
+    testset, shared, rows, content_hash = asyncio.run(patch())
+    expected = [
+        {"question": "first"},
+        {"question": "1"},
+        {"question": "inserted"},
+        *ROWS[2:5],
+        *ROWS[6:],
+        {"question": "last"},
+    ]
+    assert rows == expected
+    # Copied on write, the shared content is left as it was
+    assert testset.rows_key != shared.content_id
+    assert shared.content_hash == asyncio.run(hash_rows(ROWS))
+    # Hashed again from the hashes of the rows
+    assert content_hash == testset.content_hash == asyncio.run(hash_rows(expected))
+
+
+def test_content_hash_ignores_chunking(test_db_engine, monkeypatch):
+    monkeypatch.setattr(testset_service, "engine", test_db_engine)
+    monkeypatch.setattr(settings, "testset_rows_chunk_size", 2)
+
+    async def patch():
+        user = UserDB(uid="1", organization_id=OrganizationDB())
+        testset = await create_testset("t", "app", ROWS[:4], user)
+        # Grows the first chunk past the chunk size, which splits it
+        await patch_testset_rows(
+            testset,
+            inserts=[(1, {"question": str(index)}) for index in "abcd"],
+        )
+        rows_key, rows_version = rows_location(testset)
+        chunk_sizes = [
+            len(chunk["rows"])
+            async for chunk in test_db_engine.get_collection(
+                db_models.TestSetRowsChunkDB
+            ).find({"testset_id": rows_key, "version": rows_version})
+        ]
+        rows = await read_testset_rows(testset)
+
+        # The same rows stored in chunks of another size
+        monkeypatch.setattr(settings, "testset_rows_chunk_size", 4)
+        _, _, stored_hash = await store_rows(rows)
+        return testset, rows, chunk_sizes, stored_hash
+
+    testset, rows, chunk_sizes, stored_hash = asyncio.run(patch())
+    assert rows == [
+        ROWS[0],
+        *[{"question": str(index)} for index in "dcba"],
+        *ROWS[1:4],
+    ]
+    assert chunk_sizes == [2, 2, 2, 2]
+    assert testset.content_hash == stored_hash == asyncio.run(hash_rows(rows))
+
+
+def test_patch_writes_new_version(test_db_engine, monkeypatch):
+    monkeypatch.setattr(testset_service, "engine", test_db_engine)
+    monkeypatch.setattr(settings, "testset_rows_chunk_size", 100)
+    monkeypatch.setattr(settings, "testset_rows_chunk_bytes", 200)
+    chunks = test_db_engine.get_collection(db_models.TestSetRowsChunkDB)
+    large = [{"question": str(index) * 60} for index in range(6)]
+
+    async def patch():
+        user = UserDB(uid="1", organization_id=OrganizationDB())
+        testset = await create_testset("t", "app", ROWS, user)
+        stored = await chunks.find({}).to_list(None)
+
+        # Rows inserted in one chunk are split by size
+        await patch_testset_rows(testset, inserts=[(3, row) for row in large])
+        rows_key, rows_version = rows_location(testset)
+        chunk_rows = [
+            chunk["rows"]
+            async for chunk in chunks.find(
+                {"testset_id": rows_key, "version": rows_version}
+            )
+        ]
+        rows = await read_testset_rows(testset)
+
+        # A patch of rows replaced since they were read is not applied
+        stale = testset.copy()
+        await write_rows_version(testset.id, ROWS[:2])
+        try:
+            await patch_testset_rows(stale, deletes=[0])
+        except testset_service.TestSetPatchConflict:
+            conflict = True
+        else:
+            conflict = False
+        document = await test_db_engine.get_collection(db_models.TestSetDB).find_one(
+            {"_id": testset.id}
+        )
+        for field in ("csvdata", "rows_version", "rows_key", "row_count"):
+            setattr(testset, field, document[field])
+        return (
+            stored,
+            chunk_rows,
+            rows,
+            conflict,
+            await read_testset_rows(testset),
+            await chunks.find({}).to_list(None),
+            testset,
+        )
+
+    stored, chunk_rows, rows, conflict, current, remaining, testset = asyncio.run(
+        patch()
+    )
+    assert rows == [*ROWS[:3], *reversed(large), *ROWS[3:]]
+    assert len(chunk_rows) > 2
+    for chunk in chunk_rows:
+        assert sum(estimate_row_size(row) for row in chunk[:-1]) < 200
+    # The previous chunks were released, not edited in place
+    assert all(chunk["testset_id"] != testset.rows_key for chunk in stored)
+    assert conflict
+    assert current == ROWS[:2]
+    # The rows of the conflicting patch were released
+    assert {chunk["testset_id"] for chunk in remaining} == {testset.rows_key}
@@ -0,0 +1,96 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from bson import ObjectId
+from agenta_backend.models.db_models import OrganizationDB, UserDB
+from agenta_backend.services import db_manager
+from agenta_backend.services.helpers import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    db_manager.user_cache.clear()
+    db_manager.organization_cache.clear()
+    yield
+    db_manager.user_cache.clear()
+    db_manager.organization_cache.clear()
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=2, ttl=-1)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_get_user_object_hits_database_once():
+    user = UserDB(uid="42", organization_id=OrganizationDB())
+    with patch.object(
+        db_manager.engine, "find_one", AsyncMock(return_value=user)
+    ) as find_one:
+
+        async def resolve_twice():
+            token = db_manager.begin_request_scope()
+            try:
+                await db_manager.get_user_object("42")
+                return await db_manager.get_user_object("42")
+            finally:
+                db_manager.end_request_scope(token)
+
+        assert asyncio.run(resolve_twice()) == user
+        assert asyncio.run(db_manager.get_user_object("42")) == user
+        assert find_one.await_count == 1
+
+
+def test_cached_objects_are_copies():
+    org = OrganizationDB(name="agenta")
+    user = UserDB(uid="42", organization_id=org)
+    db_manager.user_cache.set("42", user)
+    db_manager.organization_cache.set(str(org.id), org)
+
+    first = asyncio.run(db_manager.get_user_object("42"))
+    first.username = "changed"
+    first.organization_id.name = "changed"
+    second = asyncio.run(db_manager.get_user_object("42"))
+    assert second.username == user.username != "changed"
+    assert second.organization_id.name == "agenta"
+
+    organization = asyncio.run(db_manager.get_organization_object(str(org.id)))
+    organization.name = "changed"
+    assert asyncio.run(db_manager.get_organization_object(str(org.id))).name == "agenta"
+
+
+def test_cached_variant_parameters_are_copies():
+    user_id = ObjectId()
+    db_manager.variant_parameters_cache.set(
+        (str(user_id), "app", "v1"), {"temperature": 0.5, "prompt": {"system": "a"}}
+    )
+
+    parameters = asyncio.run(db_manager.get_variant_parameters(user_id, "app", "v1"))
+    parameters["prompt"]["system"] = "changed"
+    parameters = asyncio.run(db_manager.get_variant_parameters(user_id, "app", "v1"))
+    assert parameters == {"temperature": 0.5, "prompt": {"system": "a"}}
+    db_manager.variant_parameters_cache.clear()
+
+
+def test_invalidate_organization_cache_drops_its_users():
+    org = OrganizationDB()
+    db_manager.user_cache.set("42", UserDB(uid="42", organization_id=org))
+    db_manager.organization_cache.set(str(org.id), org)
+
+    db_manager.invalidate_organization_cache(str(org.id))
+
+    assert db_manager.user_cache.get("42") is None
+    assert db_manager.organization_cache.get(str(org.id)) is None